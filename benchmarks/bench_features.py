@@ -0,0 +1,97 @@
+"""
+    Benchmarks for feature extraction in src/features/build_features.py
+"""
+from conftest import make_raw, measure
+from src.features.build_features import spectral_features, spectral_epochs, stream_spectral_epochs, \
+    epoch_array, epoch_windows, batch_spectral_features
+import mne
+import numpy as np
+import pytest
+
+
+def n_epochs(raw, epoch_size: int = 60) -> int:
+    return len(epoch_windows(raw, epoch_size, 8)[1])
+
+
+def bench_spectral_features(benchmark, raw):
+    """One 60s epoch through the original MNE filter/resample/psd_welch path"""
+
+    epochs = mne.Epochs(raw, mne.make_fixed_length_events(raw, duration=60), tmin=0., tmax=60,
+                        baseline=None, detrend=1, decim=8, preload=True)
+    measure(benchmark, lambda: spectral_features(epochs[0], max_freq=74), items=1, unit='epochs')
+
+
+@pytest.mark.parametrize('batch', [True, False], ids=['batch', 'per_epoch'])
+def bench_spectral_epochs(benchmark, raw, batch):
+    labels, features = measure(benchmark, spectral_epochs, 'S1', raw, 60, max_freq=74, batch=batch,
+                               items=n_epochs(raw), unit='epochs')
+    if benchmark.stats is not None:
+        benchmark.extra_info['recordings_per_s'] = 1 / benchmark.stats.stats.mean
+
+
+@pytest.mark.parametrize('recording', ['fixture', 'hcp_rate'])
+@pytest.mark.parametrize('annotated', [False, True], ids=['clean', 'bad_annotations'])
+def bench_batch_equivalence(benchmark, raw, recording, annotated):
+    """The batched and streamed features equal those of the per-epoch MNE path
+    (mne.Epochs and psd_welch) to within 1e-6 in the log domain, with and without
+    a BAD annotation. At the HCP sampling rate the last epoch is truncated by the
+    end of the recording, which mne.Epochs keeps."""
+
+    if recording == 'hcp_rate':
+        raw = make_raw(16, 2034.5, 300.)
+    if annotated:
+        raw = raw.copy().set_annotations(mne.Annotations([70.], [5.], ['BAD_segment']))
+    labels, features = measure(benchmark, spectral_epochs, 'S1', raw, 60, max_freq=74,
+                               items=n_epochs(raw), unit='epochs')
+    expected_labels, expected = spectral_epochs('S1', raw, 60, max_freq=74, batch=False)
+    streamed = [epoch for label, epoch in stream_spectral_epochs('S1', raw, 60, max_freq=74)]
+
+    assert labels == expected_labels and len(streamed) == len(expected)
+    np.testing.assert_allclose(np.concatenate(features), np.concatenate(expected), rtol=0, atol=1e-6)
+    np.testing.assert_allclose(np.concatenate(streamed), np.concatenate(expected), rtol=0, atol=1e-6)
+
+
+def bench_stream_spectral_epochs(benchmark, raw):
+    measure(benchmark, lambda: list(stream_spectral_epochs('S1', raw, 60, max_freq=74)),
+            items=n_epochs(raw), unit='epochs')
+
+
+def bench_epoch_array(benchmark, raw):
+    measure(benchmark, epoch_array, raw, 60, items=n_epochs(raw), unit='epochs')
+
+
+def bench_batch_spectral_features(benchmark, raw):
+    data, sfreq = epoch_array(raw, 60)
+    measure(benchmark, batch_spectral_features, data, sfreq, max_freq=74, items=len(data), unit='epochs')
+
+
+@pytest.mark.parametrize('estimator, n_fft, options', [
+    ('welch', 48, None),
+    ('welch', 148, None),
+    ('multitaper', 148, {'bandwidth': 4.}),
+    ('bandpower', 148, None),
+], ids=['welch-48', 'welch-148', 'multitaper-148', 'bandpower-148'])
+def bench_estimators(benchmark, raw, estimator, n_fft, options):
+    """Spectral estimators on filtered and resampled epochs, 148 points is 1Hz resolution at 2*74Hz"""
+
+    data, sfreq = epoch_array(raw, 60)
+    measure(benchmark, batch_spectral_features, data, sfreq, max_freq=74, n_fft=n_fft, estimator=estimator,
+            estimator_options=options, items=len(data), unit='epochs')
+
+
+@pytest.mark.parametrize('backend', ['numpy', 'numba'])
+@pytest.mark.parametrize('filter', [False, True], ids=['unfiltered', 'filtered'])
+def bench_backends(benchmark, raw, backend, filter):
+    """spectral_epochs with the numpy and compiled Welch kernels. Unfiltered (as camcan),
+    the kernel also detrends and decimates each epoch"""
+
+    if backend == 'numba':
+        pytest.importorskip('numba')
+    labels, features = measure(benchmark, spectral_epochs, 'S1', raw, 60, max_freq=74, filter=filter,
+                               backend=backend, items=n_epochs(raw), unit='epochs')
+    # both give the same features as the numpy batch path and the per-epoch MNE path
+    expected = spectral_epochs('S1', raw, 60, max_freq=74, filter=filter)[1]
+    np.testing.assert_allclose(np.concatenate(features), np.concatenate(expected), rtol=0, atol=1e-6)
+    expected_labels, expected = spectral_epochs('S1', raw, 60, max_freq=74, filter=filter, batch=False)
+    assert labels == expected_labels
+    np.testing.assert_allclose(np.concatenate(features), np.concatenate(expected), rtol=0, atol=1e-6)
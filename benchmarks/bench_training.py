@@ -0,0 +1,51 @@
+"""
+    Benchmarks for loading features and training in src/data and src/models
+"""
+import os
+import numpy as np
+from conftest import measure
+from sklearn import svm
+from src.data.make_dataset import load_dataset
+from src.data.store import consolidate
+from src.data.make_dataset import load_subjects
+from src.features.assemble import design_matrix
+from src.models.train_model import transform_data, CHANNELS
+
+
+def bench_load_dataset_npy(benchmark, feature_folder):
+    folder, csvfile = feature_folder
+    dataset = measure(benchmark, load_dataset, folder, csvfile, items=len(os.listdir(folder)) - 1, unit='records')
+    assert len(dataset['data']) > 0
+
+
+def bench_load_dataset_store(benchmark, feature_folder, tmp_path):
+    folder, csvfile = feature_folder
+    store = str(tmp_path / 'store')
+    consolidate(folder, load_subjects(csvfile), store)
+    # touch every value so the memory mapped records are actually read
+    measure(benchmark, lambda: sum(d.sum() for d in load_dataset(store, csvfile)['data']),
+            items=len(os.listdir(folder)) - 1, unit='records')
+
+
+def bench_transform_data(benchmark, feature_records):
+    data, ages = feature_records
+    measure(benchmark, transform_data, {'data': data}, CHANNELS, items=len(data), unit='records')
+
+
+def bench_design_matrix_stacked(benchmark, feature_records):
+    data, ages = feature_records
+    stacked = np.stack(data)
+    measure(benchmark, design_matrix, stacked, CHANNELS, items=len(data), unit='records')
+
+
+def bench_svm_fit(benchmark, feature_records):
+    data, ages = feature_records
+    features = transform_data({'data': data}, CHANNELS)
+    measure(benchmark, svm.SVC(gamma=0.01, C=10.).fit, features, ages, items=len(data), unit='records')
+
+
+def bench_svm_predict(benchmark, feature_records):
+    data, ages = feature_records
+    features = transform_data({'data': data}, CHANNELS)
+    model = svm.SVC(gamma=0.01, C=10.).fit(features, ages)
+    measure(benchmark, model.predict, features, items=len(data), unit='records')
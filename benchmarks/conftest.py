@@ -0,0 +1,96 @@
+"""
+    Shared fixtures for the benchmark suite.
+
+    Benchmarks run on synthetic recordings built with mne.io.RawArray. The size of
+    the recording can be set on the command line, eg.
+
+    pytest benchmarks --channels 248 --sfreq 2034.5 --duration 600
+
+    Besides the timings collected by pytest-benchmark, each benchmark records its
+    peak traced memory and a throughput figure in extra_info.
+"""
+import os
+import tracemalloc
+import numpy as np
+import mne
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+mne.set_log_level('ERROR')
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('synthetic data')
+    group.addoption('--channels', type=int, default=64, help='Channels in the synthetic recordings')
+    group.addoption('--sfreq', type=float, default=1200., help='Sampling frequency of the synthetic recordings')
+    group.addoption('--duration', type=float, default=300., help='Duration (s) of the synthetic recordings')
+    group.addoption('--records', type=int, default=2000, help='Feature records in the synthetic training set')
+
+
+def make_raw(channels: int, sfreq: float, duration: float, seed: int = 0) -> mne.io.RawArray:
+    """A synthetic MEG recording: white noise plus a 10Hz rhythm on every channel"""
+
+    rng = np.random.RandomState(seed)
+    info = mne.create_info(['MEG{:03d}'.format(i) for i in range(channels)], sfreq, 'mag')
+    times = np.arange(int(duration * sfreq)) / sfreq
+    data = 1e-12 * (rng.randn(channels, len(times)) + np.sin(2 * np.pi * 10 * times))
+    return mne.io.RawArray(data, info, verbose=False)
+
+
+@pytest.fixture(scope='session')
+def raw(request) -> mne.io.RawArray:
+    config = request.config
+    return make_raw(config.getoption('channels'), config.getoption('sfreq'), config.getoption('duration'))
+
+
+@pytest.fixture(scope='session')
+def feature_records(request):
+    """Synthetic (1, channels, 24) feature records with ages for training"""
+
+    rng = np.random.RandomState(0)
+    n = request.config.getoption('records')
+    ages = rng.choice(['22-25', '26-30', '31-35', '36+'], n)
+    offsets = {'22-25': 0., '26-30': 0.2, '31-35': 0.4, '36+': 0.6}
+    data = [rng.randn(1, 64, 24) + offsets[age] for age in ages]
+    return data, list(ages)
+
+
+@pytest.fixture(scope='session')
+def feature_folder(tmp_path_factory, feature_records):
+    """The synthetic feature records saved as .npy files with a subjects csv,
+    four records per subject"""
+
+    folder = tmp_path_factory.mktemp('processed')
+    data, ages = feature_records
+    csvfile = os.path.join(str(folder), 'subjects.csv')
+    with open(csvfile, 'w') as fd:
+        fd.write("Subject,Age,Gender\n")
+        for i in range(0, len(data), 4):
+            subject = 'S{:05d}'.format(i // 4)
+            fd.write("{},{},F\n".format(subject, ages[i]))
+            for epoch, record in enumerate(data[i:i + 4]):
+                np.save(os.path.join(str(folder), '{}-{}.npy'.format(subject, epoch)), record)
+    return str(folder), csvfile
+
+
+def measure(benchmark, func, *args, items: int = None, unit: str = 'items', **kwargs):
+    """Benchmark func(*args, **kwargs) and record memory and throughput.
+
+    Peak memory is measured with tracemalloc on one extra call outside the
+    timed rounds, so tracing does not slow down the timings. It counts the
+    allocations of that call only, not memory held by earlier benchmarks.
+    Throughput isn't recorded with --benchmark-disable, which collects no timings.
+    """
+
+    result = benchmark(func, *args, **kwargs)
+
+    tracemalloc.start()
+    func(*args, **kwargs)
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    benchmark.extra_info['peak_traced_mb'] = peak / 1e6
+    if items is not None and benchmark.stats is not None:
+        benchmark.extra_info[unit + '_per_s'] = items / benchmark.stats.stats.mean
+    return result
@@ -0,0 +1,101 @@
+"""
+    Import-time budget for the command line entry points.
+
+    Each entry point is imported in a fresh interpreter with `python -X importtime`
+    and the cumulative time of its top-level imports is compared with its budget.
+    The heavy dependencies that it must not import at load time (MNE, the HCP
+    reader, scipy, sklearn) are checked too; they should only be imported by the
+    code paths that use them.
+
+    python benchmarks/importtime.py            # check all entry points
+    python benchmarks/importtime.py --verbose  # also list the slowest imports
+
+    Budgets are in milliseconds, the median of --runs runs, and leave room for a
+    slower machine; measured times on a workstation are in the README.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+PROJECT_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+
+HEAVY = ['mne', 'hcp', 'scipy', 'sklearn', 'joblib']
+
+# entry point: (budget in ms, heavy modules it may import at load time)
+BUDGETS: Dict[str, Tuple[float, List[str]]] = {
+    'src.data.make_dataset': (250, []),
+    'src.data.store': (250, []),
+    'src.data.catalog': (250, []),
+    'src.data.export': (250, []),
+    'src.data.preprocess': (250, []),
+    'src.models.score_results': (250, []),
+    'src.models.train_model': (250, []),
+    'src.models.predict_model': (250, []),
+    'src.models.train_incremental': (250, []),
+    'src.models.tune_model': (250, []),
+    'src.models.check_storage': (250, []),
+}
+
+
+def import_times(module: str) -> Tuple[float, List[Tuple[float, str]]]:
+    """Import module in a new interpreter, return the total import time (ms)
+    and the (cumulative ms, name) of every module imported"""
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            cwd=PROJECT_DIR, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                            universal_newlines=True, check=True)
+    total = 0.
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        milliseconds = int(cumulative) / 1000.
+        modules.append((milliseconds, name.strip()))
+        # nested imports are indented, the top-level ones add up to the total
+        if not name[1:].startswith(' '):
+            total += milliseconds
+    return total, modules
+
+
+def check(module: str, budget: float, allowed: List[str], runs: int = 5,
+          verbose: bool = False) -> bool:
+    """Measure one entry point and print the result, return True if it is within budget"""
+
+    totals = []
+    for _ in range(runs):
+        total, modules = import_times(module)
+        totals.append(total)
+    median = statistics.median(totals)
+    names = set(name for _, name in modules)
+    heavy = [name for name in HEAVY if name in names and name not in allowed]
+    ok = median <= budget and not heavy
+    print("{:32s} {:8.1f} ms  budget {:6.0f} ms  {}{}".format(
+        module, median, budget, 'ok' if ok else 'FAIL',
+        '  imports ' + ', '.join(heavy) if heavy else ''))
+    if verbose:
+        for milliseconds, name in sorted(modules, reverse=True)[:10]:
+            print("    {:8.1f} ms  {}".format(milliseconds, name))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument('modules', nargs='*', help='Entry points to check (default all)')
+    parser.add_argument('--runs', type=int, default=5, help='Runs per entry point, the median is used')
+    parser.add_argument('--verbose', '-v', action='store_true', help='List the slowest imports')
+    args = parser.parse_args()
+
+    ok = True
+    for module in args.modules or BUDGETS:
+        budget, allowed = BUDGETS.get(module, (float('inf'), HEAVY))
+        ok = check(module, budget, allowed, args.runs, args.verbose) and ok
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+
+    main()
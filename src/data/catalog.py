@@ -0,0 +1,307 @@
+"""
+    Subject catalog for a folder of processed features.
+
+    Rather than parsing the subject CSV files and globbing for each subject's
+    .npy files every time a dataset is loaded, <output>/catalog.sqlite keeps:
+
+    subjects  subject, dataset, age, gender (the latest metadata seen for a subject)
+    members   the subjects listed in each CSV file, in order, with the age and
+              gender given in that file
+    sources   path, mtime and size of each CSV file imported, so a file is only
+              parsed again when it changes
+    records   id, subject, dataset, run, epoch and either the .npy filename or, for a
+              feature store, the offset and channel count of every epoch
+
+    .npy filenames are relative to the folder, so it can be read from any working
+    directory or after it has been moved.
+
+    Tables are indexed by subject, age, gender and dataset so lookups and
+    filtered selections don't scan everything. make_dataset adds records as
+    they are written; an existing folder or store can be catalogued with:
+
+    python -m src.data.catalog data/processed/hcp data/hcp-speakers.csv --dataset hcp
+"""
+import click
+import csv
+import logging
+import os
+import sqlite3
+import numpy as np
+from typing import Dict, List, Optional, Sequence
+
+from src.data.store import is_store, parse_id, read_index
+
+CATALOG = 'catalog.sqlite'
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS subjects (subject TEXT PRIMARY KEY, dataset TEXT, age TEXT, gender TEXT);
+CREATE TABLE IF NOT EXISTS members (source TEXT, position INTEGER, subject TEXT, age TEXT, gender TEXT,
+                                    PRIMARY KEY (source, position));
+CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, mtime REAL, size INTEGER);
+CREATE TABLE IF NOT EXISTS records (id TEXT PRIMARY KEY, subject TEXT, dataset TEXT, run INTEGER, epoch INTEGER,
+                                    path TEXT, offset INTEGER, channels INTEGER);
+CREATE INDEX IF NOT EXISTS subjects_age ON subjects (age);
+CREATE INDEX IF NOT EXISTS subjects_gender ON subjects (gender);
+CREATE INDEX IF NOT EXISTS subjects_dataset ON subjects (dataset);
+CREATE INDEX IF NOT EXISTS members_subject ON members (subject);
+CREATE INDEX IF NOT EXISTS records_subject ON records (subject, run, epoch);
+"""
+
+
+def catalog_path(data_folder: str) -> str:
+    return os.path.join(data_folder, CATALOG)
+
+
+def has_catalog(data_folder: str) -> bool:
+    """Return True if data_folder has a catalog"""
+
+    return os.path.exists(catalog_path(data_folder))
+
+
+class Catalog:
+    """A catalog of the subjects and records in a folder of processed features"""
+
+    def __init__(self, data_folder: str):
+        self.data_folder = data_folder
+        os.makedirs(data_folder, exist_ok=True)
+        self.db = sqlite3.connect(catalog_path(data_folder))
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def import_csv(self, csvfile: str, dataset: Optional[str] = None) -> None:
+        """Add the subjects in a CSV file (see make_dataset.load_subjects), unless
+        it has not changed since it was last imported"""
+
+        path = os.path.abspath(csvfile)
+        stat = os.stat(path)
+        row = self.db.execute("SELECT mtime, size FROM sources WHERE path = ?", (path,)).fetchone()
+        if row is not None and (row['mtime'], row['size']) == (stat.st_mtime, stat.st_size):
+            return
+
+        with open(csvfile, 'r', encoding='utf-8-sig') as fd:
+            rows = list(csv.DictReader(fd))
+        with self.db:
+            self.db.execute("DELETE FROM members WHERE source = ?", (path,))
+            for position, row in enumerate(rows):
+                age, gender = row.get('Age'), row.get('Gender')
+                self.db.execute("INSERT INTO members VALUES (?, ?, ?, ?, ?)",
+                                (path, position, row['Subject'], age, gender))
+                self._add_subjects([row['Subject']], dataset)
+                if age is not None:
+                    self.db.execute("UPDATE subjects SET age = ?, gender = ? WHERE subject = ?",
+                                    (age, gender, row['Subject']))
+            self.db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?)", (path, stat.st_mtime, stat.st_size))
+
+    def _add_subjects(self, subjects: Sequence[str], dataset: Optional[str]) -> None:
+        self.db.executemany("INSERT OR IGNORE INTO subjects (subject) VALUES (?)", [(s,) for s in subjects])
+        if dataset is not None:
+            self.db.executemany("UPDATE subjects SET dataset = ? WHERE subject = ?", [(dataset, s) for s in subjects])
+
+    def subjects(self, csvfile: str) -> Dict:
+        """The subjects of a CSV file in the same form as make_dataset.load_subjects,
+        importing the file first if needed"""
+
+        self.import_csv(csvfile)
+        result: Dict = {}
+        for row in self.db.execute("SELECT subject, age, gender FROM members WHERE source = ? ORDER BY position",
+                                   (os.path.abspath(csvfile),)):
+            result[row['subject']] = {} if row['age'] is None else {'age': row['age'], 'gender': row['gender']}
+        return result
+
+    def add_records(self, dataset: Optional[str], subject: str, run: Optional[int], names: Sequence[str],
+                    offsets: Optional[Dict[str, int]] = None, channels: Optional[int] = None) -> None:
+        """Record the outputs written for one recording: .npy filenames, or store
+        ids with their offsets"""
+
+        with self.db:
+            self._add_subjects([subject], dataset)
+            for name in names:
+                record_id = os.path.splitext(os.path.basename(name))[0]
+                parsed = parse_id(record_id, subject)
+                if parsed is None:
+                    continue
+                path = os.path.basename(name) if name.endswith('.npy') else None
+                offset = offsets.get(name) if offsets is not None else None
+                self.db.execute("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                (record_id, subject, dataset, run, parsed[1], path, offset, channels))
+
+    def scan(self, dataset: Optional[str] = None, names: Optional[Sequence[str]] = None) -> int:
+        """Add every record in the folder (or store) to the catalog with a single
+        directory listing, or only the .npy files in `names`, return the number of
+        records found"""
+
+        records = []
+        if is_store(self.data_folder) and names is None:
+            for record in read_index(self.data_folder):
+                records.append((record['id'], record['subject'], dataset, record['run'], record['epoch'], None,
+                                record['offset'], record['channels']))
+        else:
+            if names is None:
+                names = [entry.name for entry in os.scandir(self.data_folder)]
+            for name in names:
+                if not name.endswith('.npy'):
+                    continue
+                parsed = parse_id(name[:-len('.npy')])
+                if parsed is not None:
+                    subject, epoch, run = parsed
+                    records.append((name[:-len('.npy')], subject, dataset, run, epoch, name, None, None))
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?)", records)
+            self._add_subjects(sorted(set(record[1] for record in records)), dataset)
+        return len(records)
+
+    def uncatalogued(self) -> List[str]:
+        """The .npy records in the folder that aren't in the catalog, eg. written by
+        something other than make_dataset after the catalog was created"""
+
+        if is_store(self.data_folder):
+            return []
+        known = set(os.path.basename(row['path'])
+                    for row in self.db.execute("SELECT path FROM records WHERE path IS NOT NULL"))
+        return sorted(entry.name for entry in os.scandir(self.data_folder)
+                      if entry.name.endswith('.npy') and entry.name not in known
+                      and parse_id(entry.name[:-len('.npy')]) is not None)
+
+    def refresh(self) -> int:
+        """Add the uncatalogued .npy records in the folder to the catalog, with a
+        warning, return the number added"""
+
+        names = self.uncatalogued()
+        if names:
+            logger.warning("{} .npy records in {} were not in the catalog, adding them".format(
+                len(names), self.data_folder))
+            self.scan(names=names)
+        return len(names)
+
+    def merge(self, data_folder: str, offsets: Optional[Dict[str, int]] = None) -> None:
+        """Add the subjects, CSV files and records of the catalog in another folder,
+        whose .npy files have been moved here or whose store records have been
+        appended with new `offsets` (see src.data.shard). Store records missing
+        from `offsets` were already merged, so they are not replaced."""
+
+        other = sqlite3.connect(catalog_path(data_folder))
+        other.row_factory = sqlite3.Row
+        try:
+            with self.db:
+                for row in other.execute("SELECT * FROM subjects"):
+                    self._add_subjects([row['subject']], row['dataset'])
+                    if row['age'] is not None:
+                        self.db.execute("UPDATE subjects SET age = ?, gender = ? WHERE subject = ?",
+                                        (row['age'], row['gender'], row['subject']))
+                self.db.executemany("INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?)",
+                                    [tuple(row) for row in other.execute("SELECT * FROM members")])
+                self.db.executemany("INSERT OR REPLACE INTO sources VALUES (?, ?, ?)",
+                                    [tuple(row) for row in other.execute("SELECT * FROM sources")])
+                records = []
+                for row in other.execute("SELECT * FROM records"):
+                    record = dict(row)
+                    if record['path'] is not None:
+                        record['path'] = os.path.basename(record['path'])
+                    if offsets is not None and record['offset'] is not None:
+                        if record['id'] not in offsets:
+                            continue
+                        record['offset'] = offsets[record['id']]
+                    records.append(tuple(record.values()))
+                self.db.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?)", records)
+        finally:
+            other.close()
+
+    def records(self, csvfile: Optional[str] = None, subjects: Optional[Sequence[str]] = None,
+                ages: Optional[Sequence[str]] = None, genders: Optional[Sequence[str]] = None,
+                datasets: Optional[Sequence[str]] = None) -> List[Dict]:
+        """Select records, optionally only those of the subjects in a CSV file or a
+        list, and of the given age bands, genders and datasets. Records are ordered
+        by subject (in CSV order if a CSV file is given), run and epoch."""
+
+        tables = "records LEFT JOIN subjects ON subjects.subject = records.subject"
+        columns = "records.*, subjects.age AS age, subjects.gender AS gender"
+        conditions: List[str] = []
+        params: List = []
+        order = "records.subject, records.run, records.epoch"
+        if csvfile is not None:
+            self.import_csv(csvfile)
+            tables += " JOIN members ON members.subject = records.subject AND members.source = ?"
+            params.append(os.path.abspath(csvfile))
+            order = "members.position, records.run, records.epoch"
+        for column, values in (('records.subject', subjects), ('subjects.age', ages),
+                               ('subjects.gender', genders), ('subjects.dataset', datasets)):
+            if values is not None:
+                conditions.append("{} IN ({})".format(column, ",".join("?" * len(values))))
+                params.extend(values)
+        query = "SELECT {} FROM {}".format(columns, tables)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY " + order
+        return [self._resolve(dict(row)) for row in self.db.execute(query, params)]
+
+    def _resolve(self, record: Dict) -> Dict:
+        """The record with its .npy path joined to the folder (basename, for
+        catalogs that stored paths relative to the working directory)"""
+
+        if record['path'] is not None:
+            record['path'] = os.path.join(self.data_folder, os.path.basename(record['path']))
+        return record
+
+    def subject(self, subject: str) -> Optional[Dict]:
+        """Metadata for one subject, with the number of records, or None"""
+
+        row = self.db.execute("SELECT subjects.*, (SELECT COUNT(*) FROM records WHERE records.subject = ?) AS records "
+                              "FROM subjects WHERE subject = ?", (subject, subject)).fetchone()
+        return dict(row) if row is not None else None
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+@click.command()
+@click.argument('data_folder', type=click.Path(exists=True))
+@click.argument('csvfiles', nargs=-1, type=click.Path(exists=True))
+@click.option('--dataset', type=click.Choice(['hcp', 'mous', 'camcan']), help='Dataset the subjects belong to')
+def main(data_folder, csvfiles, dataset):
+    """Catalog the records in DATA_FOLDER and the subjects in CSVFILES"""
+
+    with Catalog(data_folder) as catalog:
+        for csvfile in csvfiles:
+            catalog.import_csv(csvfile, dataset)
+        count = catalog.scan(dataset)
+    print("Catalogued {} records in {}".format(count, data_folder))
+
+
+def load_catalog(data_folder: str, csvfile: str) -> Dict:
+    """Load the .npy records of the subjects in csvfile, in the same format as
+    make_dataset.load_dataset, using the catalog to find them"""
+
+    result: Dict = {
+        'id': [],
+        'age': [],
+        'gender': [],
+        'data': [],
+    }
+    with Catalog(data_folder) as catalog:
+        catalog.refresh()
+        subjects = catalog.subjects(csvfile)
+        records = catalog.records(csvfile)
+
+    for record in records:
+        if record['path'] is None:
+            continue
+        result['id'].append(record['id'])
+        if 'age' in subjects[record['subject']]:
+            result['age'].append(subjects[record['subject']]['age'])
+            result['gender'].append(subjects[record['subject']]['gender'])
+        result['data'].append(np.load(record['path']))
+
+    return result
+
+
+if __name__ == '__main__':
+
+    main()
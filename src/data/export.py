@@ -0,0 +1,223 @@
+"""
+    Export a dataset of features to a single binary file.
+
+    All records of the subjects in a CSV file are written, with their id,
+    subject, age and gender, to one file that other tools can load in a single
+    vectorized read:
+
+    parquet, arrow  a table with one row per record: id, subject, age, gender,
+                    channels and features, a list of channels * n_freq values
+                    (needs pyarrow; .arrow is the Arrow IPC file format)
+    npz             arrays id, subject, age, gender, channels and features,
+                    the (rows, n_freq) features of the records stacked, each
+                    record being the next `channels` rows
+
+    Records are read and written in chunks so memory use depends on the chunk
+    size, not the size of the dataset. With --jobs the records of upcoming
+    chunks are read by a pool of threads while earlier chunks are written.
+    In the npz file each chunk is saved as a separate member (features-00000.npy,
+    ...); read_export puts them back together.
+
+    python -m src.data.export data/processed/hcp data/hcp-speakers.csv hcp.parquet
+"""
+import click
+import os
+import zipfile
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional
+
+from src.data.make_dataset import load_subjects
+from src.data.records import Record, dataset_records
+
+FORMATS = {'.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow', '.npz': 'npz'}
+METADATA = ['id', 'subject', 'age', 'gender', 'channels']
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet and Arrow export need pyarrow, install it or export to .npz")
+    return pyarrow
+
+
+def export_format(path: str, fmt: Optional[str] = None) -> str:
+    """The format of an export file, given explicitly or by its extension"""
+
+    fmt = fmt or FORMATS.get(os.path.splitext(path)[1].lower())
+    if fmt not in FORMATS.values():
+        raise ValueError("Can't tell the format of {}, use .parquet, .arrow or .npz".format(path))
+    if fmt != 'npz':
+        _pyarrow()
+    return fmt
+
+
+def _subject(record_id: str, subjects: Dict) -> str:
+    # ids are <subject>-<epoch>[-<run>] and subjects may contain '-'
+    for parts in (1, 2):
+        subject = record_id.rsplit('-', parts)[0]
+        if subject in subjects:
+            return subject
+    return record_id.split('-', 1)[0]
+
+
+def read_chunk(records: List[Record], subjects: Dict, dtype) -> Dict:
+    """Read the features of a list of records into one chunk of columns"""
+
+    features = [loader()[0] for _, _, loader in records]
+    ids = [record_id for record_id, _, _ in records]
+    names = [_subject(record_id, subjects) for record_id in ids]
+    return {
+        'id': np.array(ids, dtype=str),
+        'subject': np.array(names, dtype=str),
+        'age': np.array([subjects[s].get('age', '') for s in names], dtype=str),
+        'gender': np.array([subjects[s].get('gender', '') for s in names], dtype=str),
+        'channels': np.array([f.shape[0] for f in features], dtype=np.int32),
+        'features': np.concatenate(features).astype(dtype, copy=False) if features else np.empty((0, 0), dtype),
+    }
+
+
+def iter_chunks(records: List[Record], subjects: Dict, chunk_size: int = 256, jobs: int = 1,
+                dtype=np.float64) -> Iterator[Dict]:
+    """Generate chunks of records in order. With more than one job, up to
+    2 * jobs chunks are read ahead by a thread pool."""
+
+    starts = range(0, len(records), chunk_size)
+    if jobs <= 1:
+        for start in starts:
+            yield read_chunk(records[start:start + chunk_size], subjects, dtype)
+        return
+    with ThreadPoolExecutor(jobs) as pool:
+        pending = []
+        for start in starts:
+            pending.append(pool.submit(read_chunk, records[start:start + chunk_size], subjects, dtype))
+            if len(pending) >= 2 * jobs:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+class NpzExporter:
+    """Write chunks as members of one .npz file"""
+
+    def __init__(self, path: str):
+        self.zip = zipfile.ZipFile(path, 'w', allowZip64=True)
+        self.chunks = 0
+
+    def _save(self, name: str, array: np.ndarray) -> None:
+        with self.zip.open(name + '.npy', 'w', force_zip64=True) as fd:
+            np.lib.format.write_array(fd, np.ascontiguousarray(array), allow_pickle=False)
+
+    def write(self, chunk: Dict) -> None:
+        for name, array in chunk.items():
+            self._save('{}-{:05d}'.format(name, self.chunks), array)
+        self.chunks += 1
+
+    def close(self) -> None:
+        self._save('chunks', np.array(self.chunks))
+        self.zip.close()
+
+
+class ArrowExporter:
+    """Write chunks as record batches of a Parquet or Arrow IPC file"""
+
+    def __init__(self, path: str, fmt: str):
+        self.pa = _pyarrow()
+        self.path = path
+        self.fmt = fmt
+        self.schema = None
+        self.writer = None
+
+    def write(self, chunk: Dict) -> None:
+        pa = self.pa
+        features = chunk['features']
+        lengths = chunk['channels'].astype(np.int64) * features.shape[1]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int32)
+        columns = [pa.array(chunk[name]) for name in METADATA]
+        columns.append(pa.ListArray.from_arrays(pa.array(offsets), pa.array(features.ravel())))
+        if self.writer is None:
+            fields = [pa.field(name, column.type) for name, column in zip(METADATA + ['features'], columns)]
+            self.schema = pa.schema(fields, metadata={'n_freq': str(features.shape[1])})
+            if self.fmt == 'parquet':
+                self.writer = pa.parquet.ParquetWriter(self.path, self.schema)
+            else:
+                self.writer = pa.ipc.new_file(self.path, self.schema)
+        self.writer.write_table(pa.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+
+
+def export_dataset(data_folder: str, csvfile: str, path: str, fmt: Optional[str] = None, chunk_size: int = 256,
+                   jobs: int = 1, dtype=np.float64) -> int:
+    """Export the records of the subjects in csvfile from data_folder (.npy files
+    or a store) to path, return the number of records written"""
+
+    fmt = export_format(path, fmt)
+    subjects = load_subjects(csvfile)
+    records = dataset_records(data_folder, csvfile)
+    exporter = NpzExporter(path) if fmt == 'npz' else ArrowExporter(path, fmt)
+    try:
+        for chunk in iter_chunks(records, subjects, chunk_size, jobs, dtype):
+            exporter.write(chunk)
+    finally:
+        exporter.close()
+    return len(records)
+
+
+def read_export(path: str, fmt: Optional[str] = None) -> Dict:
+    """Read an exported file in the same format as make_dataset.load_dataset,
+    plus 'subject' and 'features', the stacked (rows, n_freq) features that
+    the (1, channels, n_freq) 'data' arrays are views of"""
+
+    fmt = export_format(path, fmt)
+    if fmt == 'npz':
+        with np.load(path) as npz:
+            chunks = range(int(npz['chunks']))
+            columns = {name: np.concatenate([npz['{}-{:05d}'.format(name, i)] for i in chunks])
+                       if chunks else np.empty(0) for name in METADATA}
+            features = [npz['features-{:05d}'.format(i)] for i in chunks]
+            features = np.concatenate(features) if features else np.empty((0, 0))
+    else:
+        pa = _pyarrow()
+        table = pa.parquet.read_table(path) if fmt == 'parquet' else pa.ipc.open_file(path).read_all()
+        columns = {name: table.column(name).to_numpy() for name in METADATA}
+        n_freq = int(table.schema.metadata[b'n_freq'])
+        values = table.column('features').combine_chunks().flatten().to_numpy()
+        features = values.reshape(-1, n_freq) if n_freq else values.reshape(0, 0)
+
+    offsets = np.concatenate([[0], np.cumsum(columns['channels'])]).astype(np.intp)
+    result = {name: list(columns[name]) for name in ('id', 'subject', 'age', 'gender')}
+    result['data'] = [features[start:end][np.newaxis] for start, end in zip(offsets[:-1], offsets[1:])]
+    result['features'] = features
+    return result
+
+
+@click.command()
+@click.argument('data_folder', type=click.Path(exists=True))
+@click.argument('csvfile', type=click.Path(exists=True))
+@click.argument('output', type=click.Path())
+@click.option('--format', 'fmt', type=click.Choice(sorted(set(FORMATS.values()))),
+              help='Output format (default from the extension of OUTPUT)')
+@click.option('--chunk-size', default=256, type=click.IntRange(min=1), help='Records read and written at a time')
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=1), help='Threads reading records')
+@click.option('--dtype', type=click.Choice(['float64', 'float32']), default='float64', help='Type of the features')
+def main(data_folder, csvfile, output, fmt, chunk_size, jobs, dtype):
+    """Export the features of the subjects in CSVFILE from DATA_FOLDER to one file"""
+
+    try:
+        fmt = export_format(output, fmt)
+    except (ValueError, ImportError) as exc:
+        raise click.BadParameter(str(exc), param_hint='--format')
+
+    count = export_dataset(data_folder, csvfile, output, fmt, chunk_size, jobs, np.dtype(dtype))
+    print("Exported {} records to {}".format(count, output))
+
+
+if __name__ == '__main__':
+
+    main()
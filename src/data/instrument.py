@@ -0,0 +1,204 @@
+"""
+    Per-stage instrumentation for dataset builds.
+
+    Code that does a unit of work wraps each step in `stage(name)`. While a task is
+    being measured (see `measure_task`) the time spent in each stage is accumulated;
+    otherwise `stage` does nothing. Each task produces a record like:
+
+    {"task": "100307/0", "seconds": 41.2, "peak_rss_bytes": 2104975360,
+     "process_max_rss_bytes": 2104975360, "bytes_read": 1073741824, "bytes_written": 40128,
+     "stages": {"read": 20.1, "epoch": 1.2, "filter": 12.0, "resample": 5.1, "psd": 0.4, "write": 0.01}}
+
+    which `MetricsWriter` saves as JSON lines or, for a .prom file, in the
+    Prometheus text exposition format.
+
+    peak_rss_bytes is the largest RSS sampled while the task ran (None without
+    psutil). process_max_rss_bytes is the process high-water mark (ru_maxrss),
+    which includes earlier tasks run by the same process.
+"""
+import cProfile
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+_task: Optional[Dict] = None
+_profiler: Dict = {'dir': None, 'kind': 'cprofile'}
+
+
+def configure_profiler(profile_dir: Optional[str], kind: str = 'cprofile') -> None:
+    """Profile every measured task, saving one profile per task in profile_dir.
+    kind is 'cprofile' (.prof files for pstats/snakeviz) or 'pyinstrument' (.html)"""
+
+    _profiler['dir'] = profile_dir
+    _profiler['kind'] = kind
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+
+
+@contextmanager
+def stage(name: str):
+    """Add the time spent in this block to the named stage of the current task"""
+
+    if _task is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages = _task['stages']
+        stages[name] = stages.get(name, 0.) + time.perf_counter() - start
+
+
+class RssSampler:
+    """Sample the resident memory of this process from a background thread every
+    `interval` seconds, keeping the largest value (None if psutil isn't installed)"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak: Optional[int] = None
+        self.stopped = threading.Event()
+        try:
+            import psutil
+        except ImportError:
+            self.process = None
+            return
+        self.process = psutil.Process()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self) -> None:
+        rss = self.process.memory_info().rss
+        self.peak = rss if self.peak is None else max(self.peak, rss)
+
+    def _run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        if self.process is not None:
+            self._sample()
+            self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        if self.process is not None:
+            self.stopped.set()
+            self.thread.join()
+            self._sample()
+
+
+def _start_profiler():
+    if not _profiler['dir']:
+        return None
+    if _profiler['kind'] == 'pyinstrument':
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    return profiler
+
+
+def _stop_profiler(profiler, key: str) -> None:
+    if profiler is None:
+        return
+    basename = os.path.join(_profiler['dir'], key.replace('/', '-'))
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        profiler.dump_stats(basename + '.prof')
+    else:
+        profiler.stop()
+        with open(basename + '.html', 'w') as fd:
+            fd.write(profiler.output_html())
+
+
+@contextmanager
+def measure_task(key: str):
+    """Measure a task, yields the metrics dictionary that is filled in as it runs.
+
+    Peak memory is sampled while the task runs (see RssSampler), so it is per
+    task even when a process runs several. The process high-water mark is
+    recorded as well.
+    """
+
+    global _task
+    metrics: Dict = {'task': key, 'stages': {}, 'bytes_read': 0, 'bytes_written': 0}
+    _task = metrics
+    profiler = _start_profiler()
+    start = time.perf_counter()
+    sampler = RssSampler()
+    try:
+        with sampler:
+            yield metrics
+    finally:
+        metrics['seconds'] = time.perf_counter() - start
+        metrics['peak_rss_bytes'] = sampler.peak
+        # ru_maxrss is in kilobytes on Linux
+        metrics['process_max_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        _stop_profiler(profiler, key)
+        _task = None
+
+
+class MetricsWriter:
+    """Save task metrics as JSON lines, or as Prometheus text if the filename ends in .prom.
+    JSON lines are written as each task completes, the Prometheus file on close."""
+
+    def __init__(self, path: str, labels: Dict = None):
+        self.path = path
+        self.labels = labels or {}
+        self.prometheus = path.endswith('.prom')
+        self.records: List[Dict] = []
+        if not self.prometheus:
+            self.fd = open(path, 'a')
+
+    def write(self, metrics: Dict) -> None:
+        record = dict(self.labels, **metrics)
+        if self.prometheus:
+            self.records.append(record)
+        else:
+            self.fd.write(json.dumps(record) + "\n")
+            self.fd.flush()
+
+    def prometheus_text(self) -> str:
+        lines = []
+        metrics = [
+            ('make_dataset_task_seconds', 'Wall time of each task', lambda r: [({}, r['seconds'])]),
+            ('make_dataset_stage_seconds', 'Wall time in each stage of a task',
+             lambda r: [({'stage': name}, value) for name, value in sorted(r['stages'].items())]),
+            ('make_dataset_bytes_read', 'Bytes of raw data read by a task', lambda r: [({}, r['bytes_read'])]),
+            ('make_dataset_bytes_written', 'Bytes of features written by a task',
+             lambda r: [({}, r['bytes_written'])]),
+            ('make_dataset_peak_rss_bytes', 'Peak resident memory sampled while a task ran',
+             lambda r: [({}, r['peak_rss_bytes'])] if r['peak_rss_bytes'] is not None else []),
+            ('make_dataset_process_max_rss_bytes',
+             'High-water mark of resident memory of the process running a task, including earlier tasks',
+             lambda r: [({}, r['process_max_rss_bytes'])]),
+        ]
+        for name, help_text, samples in metrics:
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} gauge'.format(name))
+            for record in self.records:
+                base = dict(self.labels, task=record['task'])
+                for extra, value in samples(record):
+                    labels = ','.join('{}="{}"'.format(k, v) for k, v in dict(base, **extra).items())
+                    lines.append('{}{{{}}} {}'.format(name, labels, value))
+        return "\n".join(lines) + "\n"
+
+    def close(self) -> None:
+        if self.prometheus:
+            with open(self.path + '.tmp', 'w') as fd:
+                fd.write(self.prometheus_text())
+            os.replace(self.path + '.tmp', self.path)
+        else:
+            self.fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,14 +1,27 @@
 # -*- coding: utf-8 -*-
 import click
 import logging
+import logging.handlers
+import multiprocessing
 import csv
 import numpy as np
 import os
-from typing import Dict
-import mne
+import tempfile
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 import glob
 
-from src.features.build_features import spectral_epochs, read_hcp, read_mous, read_camcan
+from src.data.store import CODECS, STORAGE_DTYPES, NpyWriter, StoreWriter, check_codec, is_store, load_store, parse_id
+from src.data.catalog import Catalog, has_catalog, load_catalog
+from src.data.manifest import code_version, fingerprint, task_key, task_digest, load_manifest, record_task, is_current
+from src.data.instrument import stage, measure_task, configure_profiler, MetricsWriter
+from src.data.prefetch import Prefetcher, parse_size
+from src.data.shared import is_shared, load_shared
+from src.data.shard import QUEUE, MergedOutputs, WorkQueue, merge_shards, parse_shard, select_shard, \
+    shard_folder, shard_manifest, worker_name
+
+if TYPE_CHECKING:
+    import mne
 
 PROJECT_DIR = os.path.abspath(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 
@@ -20,18 +33,61 @@ MOUS_DATA_FOLDER = '/var/syndisk/MEG/Donders_MEG/'
 CAMCAN_DATA_FOLDER = "/var/syndisk/MEG/CANCAM/camcan43/cc700/meg/pipeline/release004/data/aamod_meg_get_fif_00001/"
 
 
-EPOCH_DURATION = 60  # duration of recording (s) for each processed data point 
-                     # recordings are cut up into chunks of this size 
+# duration of recording (s) for each processed data point,
+# recordings are cut up into chunks of this size
+EPOCH_DURATION = 60
+
+# parameters passed to spectral_epochs for each dataset, also recorded in the build manifest
+# estimator is 'welch', 'multitaper' or 'bandpower' (see src.features.spectral), with
+# estimator_options eg. {'bandwidth': 2.} for multitaper. 'antialias': True low-pass filters
+# epochs before they are decimated. 'backend': 'numba' computes Welch PSDs with the compiled
+# kernels in src.features.kernels, it doesn't change the features so it isn't part of the manifest digest
+FEATURE_PARAMS: Dict = {
+    'hcp': {'epoch_size': EPOCH_DURATION, 'max_freq': 74, 'n_fft': 48, 'filter': True, 'decim': 8,  # to match MOUS
+            'estimator': 'welch'},
+    'mous': {'epoch_size': EPOCH_DURATION, 'max_freq': 74, 'n_fft': 48, 'filter': True, 'decim': 8,
+             'estimator': 'welch'},
+    'camcan': {'epoch_size': EPOCH_DURATION, 'max_freq': 100, 'n_fft': 48, 'filter': False, 'decim': 8,
+               'estimator': 'welch'},
+}
+
+# src.features.spectral.ESTIMATORS and src.features.kernels.BACKENDS, not imported here so that
+# --help doesn't load scipy
+ESTIMATORS = ('welch', 'multitaper', 'bandpower')
+BACKENDS = ('numpy', 'numba')
 
 log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 logging.basicConfig(level=logging.ERROR, format=log_fmt)
-mne.set_log_level('ERROR')
 logger = logging.getLogger()
 
 
+def features():
+    """The feature extraction module, imported along with MNE (and the HCP reader)
+    when recordings are first processed rather than when this module is loaded,
+    so that loading datasets and --help don't pay for them"""
+
+    import mne
+    from src.features import build_features
+
+    mne.set_log_level('ERROR')
+    return build_features
+
+
 def load_dataset(data_folder: str, csvfile: str) -> Dict:
     """Load a dataset given a csv file containing subject ids and metadata
-    Return a dictionary with keys 'target' and 'data' suitable for training a model"""
+    Return a dictionary with keys 'target' and 'data' suitable for training a model
+
+    data_folder is either a folder of .npy files or a consolidated store
+    written with make_dataset --store. If the folder has a catalog (see
+    src.data.catalog) it is used to find the records of each subject. As
+    shm:<name> it is a dataset served in shared memory (see src.data.shared)."""
+
+    if is_shared(data_folder):
+        return load_shared(data_folder, load_subjects(csvfile))
+    if is_store(data_folder):
+        return load_store(data_folder, load_subjects(csvfile))
+    if has_catalog(data_folder):
+        return load_catalog(data_folder, csvfile)
 
     result = {
         'id': [],
@@ -40,24 +96,32 @@ def load_dataset(data_folder: str, csvfile: str) -> Dict:
         'data': [],
     }
     subjects: Dict = load_subjects(csvfile)
-    
+
     for subject in subjects:
-        # get all files matching this speaker
-        pattern = os.path.join(data_folder, subject+"*")
-        for filename in glob.glob(pattern):
+        for filename in subject_files(data_folder, subject):
             data = np.load(filename)
             result['id'].append(os.path.splitext(os.path.basename(filename))[0])
             if 'age' in subjects[subject]:
-                result['age'].append(subjects[subject]['age'])  
-                result['gender'].append(subjects[subject]['gender'])  
+                result['age'].append(subjects[subject]['age'])
+                result['gender'].append(subjects[subject]['gender'])
             result['data'].append(data)
-    
+
     return result
 
 
+def subject_files(data_folder: str, subject: str) -> List[str]:
+    """Return the .npy feature files for a subject in data_folder"""
+
+    # get all files for this speaker, <subject>-<N>[-<run>].npy, but not
+    # those of other subjects whose id starts with the same characters
+    pattern = os.path.join(data_folder, glob.escape(subject) + "-*.npy")
+    return [filename for filename in sorted(glob.glob(pattern))
+            if parse_id(os.path.splitext(os.path.basename(filename))[0], subject) is not None]
+
+
 def load_subjects(csvfile: str) -> Dict:
     """Load a list of subjects from a csv file along with metadata
-    
+
     Subject,Age,Gender,Acquisition,Release
     195041,31-35,F,Q07,S500
     ...
@@ -76,72 +140,466 @@ def load_subjects(csvfile: str) -> Dict:
 
     return result
 
-def make_hcp_dataset(csvfile: str, output_filepath: str) -> None:
-    """Process the hcp dataset"""
 
-    subjects = load_subjects(csvfile)
+def feature_params(dataset: str, estimator: Optional[str] = None, n_fft: Optional[int] = None,
+                   bandwidth: Optional[float] = None, antialias: bool = False, backend: str = 'numpy') -> Dict:
+    """The feature parameters for a dataset (FEATURE_PARAMS) with a different
+    spectral estimator, FFT length or multitaper bandwidth if given, with an
+    anti-alias filter if `antialias` and with the compiled kernels if backend is 'numba'"""
+
+    params = dict(FEATURE_PARAMS[dataset])
+    if estimator is not None and estimator != params.get('estimator', 'welch'):
+        params['estimator'] = estimator
+        params.pop('estimator_options', None)
+    if n_fft is not None:
+        params['n_fft'] = n_fft
+    if bandwidth is not None:
+        params['estimator_options'] = dict(params.get('estimator_options', {}), bandwidth=bandwidth)
+    if antialias:
+        params['antialias'] = True
+    if backend != 'numpy':
+        params['backend'] = backend
+    return params
+
+
+def compute_features(dataset: str, subject: str, raw: 'mne.io.Raw', stream: bool = False,
+                     params: Optional[Dict] = None) -> List[np.ndarray]:
+    """Compute features for one recording with the parameters for this dataset
+    (or `params`, see feature_params)
+
+    With `stream` the recording is processed one epoch at a time, use with a raw
+    that is not preloaded to keep memory use independent of recording length."""
+
+    params = params or FEATURE_PARAMS[dataset]
+    if stream:
+        return [epoch for label, epoch in features().stream_spectral_epochs(subject, raw, **params)]
+    labels, epochs = features().spectral_epochs(subject, raw, **params)
+    return epochs
+
+
+def process_hcp_run(subject: str, run_index: int, stream: bool = False, params: Optional[Dict] = None,
+                    data_folder: str = None) -> Tuple[str, Optional[int], List[np.ndarray]]:
+    """Compute features for one run of one HCP subject"""
+
+    with stage('read'):
+        raw = features().read_hcp(subject, data_folder or HCP_DATA_FOLDER, run_index)
+    return subject, run_index, compute_features('hcp', subject, raw, stream, params)
+
+
+def process_mous_subject(subject: str, stream: bool = False, params: Optional[Dict] = None,
+                         data_folder: str = None) -> Tuple[str, Optional[int], List[np.ndarray]]:
+    """Compute features for one MOUS subject"""
+
+    print("Subject", subject)
+    with stage('read'):
+        raw = features().read_mous(subject, data_folder or MOUS_DATA_FOLDER, preload=not stream)
+    print("read raw...")
+    if raw:
+        return subject, None, compute_features('mous', subject, raw, stream, params)
+    else:
+        logger.error("Missing: {}".format(subject))
+        return subject, None, []
+
 
-    for subject in subjects:
-        print(os.path.join(HCP_DATA_FOLDER, subject))
-        if os.path.exists(os.path.join(HCP_DATA_FOLDER, subject)):
-            for run_index in range(3):
-                raw = read_hcp(subject, HCP_DATA_FOLDER, run_index)
-                labels, features = spectral_epochs(subject, raw, EPOCH_DURATION, max_freq=74)  # to match MOUS
-                for i in range(len(labels)):
-                    fname = os.path.join(output_filepath, labels[i] + "-" + str(run_index) + ".npy")
-                    np.save(fname, features[i])
-                    logger.info("Wrote {}".format(fname))
-        else:
-            logger.error("Missing: {}".format(subject))
+def process_camcan_subject(subject: str, stream: bool = False, params: Optional[Dict] = None,
+                           data_folder: str = None) -> Tuple[str, Optional[int], List[np.ndarray]]:
+    """Compute features for one CAMCAN subject"""
 
+    print("Subject", subject)
+    with stage('read'):
+        raw = features().read_camcan(subject, data_folder or CAMCAN_DATA_FOLDER, preload=not stream)
+    print("read raw...")
+    if raw:
+        return subject, None, compute_features('camcan', subject, raw, stream, params)
+    else:
+        logger.error("Missing: {}".format(subject))
+        return subject, None, []
 
-def make_mous_dataset(csvfile: str, output_filepath: str) -> None:
-    """Process the MOUS dataset"""
 
-    subjects = load_subjects(csvfile)
+def dataset_tasks(dataset: str, subjects: Dict, stream: bool = False, params: Optional[Dict] = None) -> List[Tuple]:
+    """Return a list of (function, args, subject, run, source files) tasks to build a dataset.
+    The last argument of each task is the folder its source files are read from,
+    the one before it the feature parameters (None for those in FEATURE_PARAMS)."""
 
+    tasks = []
     for subject in subjects:
-        print("Subject", subject)
-        raw = read_mous(subject, MOUS_DATA_FOLDER)
-        print("read raw...")
-        if raw:
-            labels, features = spectral_epochs(subject, raw, EPOCH_DURATION, max_freq=74)
-            for i in range(len(labels)):
-                fname = os.path.join(output_filepath, labels[i] + ".npy")
-                np.save(fname, features[i])
-                print("Wrote {}".format(fname))
-                logger.info("Wrote {}".format(fname))
+        if dataset == 'hcp':
+            print(os.path.join(HCP_DATA_FOLDER, subject))
+            if os.path.exists(os.path.join(HCP_DATA_FOLDER, subject)):
+                for run_index in range(3):
+                    tasks.append((process_hcp_run, (subject, run_index, stream, params, HCP_DATA_FOLDER),
+                                  subject, run_index, features().hcp_files(subject, HCP_DATA_FOLDER, run_index)))
+            else:
+                logger.error("Missing: {}".format(subject))
+        elif dataset == 'mous':
+            tasks.append((process_mous_subject, (subject, stream, params, MOUS_DATA_FOLDER), subject, None,
+                          features().mous_files(subject, MOUS_DATA_FOLDER)))
+        elif dataset == 'camcan':
+            tasks.append((process_camcan_subject, (subject, stream, params, CAMCAN_DATA_FOLDER), subject, None,
+                          features().camcan_files(subject, CAMCAN_DATA_FOLDER)))
+    return tasks
+
+
+def _init_worker(log_queue, profile_dir: Optional[str], profiler: str) -> None:
+    """Pool initializer: route all log records from a worker back to the parent"""
+
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    configure_profiler(profile_dir, profiler)
+
+
+def _run_task(task: Tuple) -> Tuple[Tuple[str, Optional[int], List[np.ndarray]], Dict]:
+    func, args, key = task[:3]
+    with measure_task(key) as metrics:
+        result = func(*args)
+    return result, metrics
+
+
+def run_tasks(tasks: List[Tuple], writer, jobs: int = 1, profile_dir: Optional[str] = None,
+              profiler: str = 'cprofile', prefetcher: Optional[Prefetcher] = None,
+              sources: Optional[Dict[str, List[str]]] = None) -> List[str]:
+    """Run a list of (function, args, key) tasks, in a process pool if jobs > 1,
+    and save the features they return with `writer` (see src.data.store)
+
+    Each worker handles a single task and is then replaced (maxtasksperchild=1)
+    so that memory held by a preloaded raw recording is returned to the OS
+    before the next subject is read. Peak memory is therefore bounded by
+    `jobs` recordings. Results are written by the parent in task order and log
+    records from the workers are handled by the parent's logging handlers.
+
+    Every task is measured (see src.data.instrument) and, if profile_dir is
+    given, profiled. Tasks may carry a fourth element, a callback run in the
+    parent with the names written and the task metrics once results are saved.
+
+    With a prefetcher the source files of upcoming tasks (`sources`, by task
+    key) are copied to local scratch space while earlier tasks run, and each
+    copy is released once the task's results are written.
+    """
+
+    written: List[str] = []
+    staged = prefetcher.staged(tasks, sources or {}) if prefetcher is not None else iter(tasks)
+    if jobs <= 1:
+        configure_profiler(profile_dir, profiler)
+        for task in staged:
+            written.extend(_write_result(writer, task, _run_task(task)))
+            if prefetcher is not None:
+                prefetcher.release(task[2])
+        return written
+
+    log_queue = multiprocessing.Queue()
+    listener = logging.handlers.QueueListener(log_queue, *logging.getLogger().handlers,
+                                              respect_handler_level=True)
+    listener.start()
+    try:
+        with multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(log_queue, profile_dir, profiler),
+                                  maxtasksperchild=1) as pool:
+            results = pool.imap(_run_task, (task[:3] for task in staged), chunksize=1)
+            for task, result in zip(tasks, results):
+                written.extend(_write_result(writer, task, result))
+                if prefetcher is not None:
+                    prefetcher.release(task[2])
+    finally:
+        listener.stop()
+    return written
+
+
+def run_queue(tasks: List[Tuple], writer, queue: WorkQueue, worker: str, profile_dir: Optional[str] = None,
+              profiler: str = 'cprofile') -> List[str]:
+    """Run tasks claimed from a work queue (see src.data.shard) one at a time until
+    none of them are left, and save their features with `writer`. A task that
+    raises is marked as failed, to be retried by this or another worker. The
+    features of a task whose lease expired while it ran (so it was handed to
+    another worker) are not written."""
+
+    configure_profiler(profile_dir, profiler)
+    by_key = {task[2]: task for task in tasks}
+    written: List[str] = []
+    while True:
+        key = queue.claim(worker, by_key)
+        if key is None:
+            return written
+        task = by_key[key]
+        try:
+            with queue.keep_alive(key, worker):
+                result = _run_task(task)
+        except Exception as exc:
+            logger.exception("Task {} failed".format(key))
+            queue.fail(key, worker, "{}: {}".format(type(exc).__name__, exc))
+            continue
+        if not queue.owns(key, worker):
+            logger.warning("Lost the lease on task {}, another worker is running it".format(key))
+            continue
+        written.extend(_write_result(writer, task, result))
+        queue.done(key, worker)
+
+
+def _write_result(writer, task: Tuple, result: Tuple) -> List[str]:
+    (subject, run, features), metrics = result
+    start = time.perf_counter()
+    bytes_written = writer.bytes_written
+    written = writer.write(subject, run, features)
+    metrics['stages']['write'] = time.perf_counter() - start
+    metrics['bytes_written'] = writer.bytes_written - bytes_written
+    for name in written:
+        logger.info("Wrote {}".format(name))
+    if len(task) > 3:
+        task[3](written, metrics)
+    return written
+
+
+def open_catalog(dataset: str, csvfile: str, output_filepath: str) -> Catalog:
+    """The catalog of output_filepath with the subjects in csvfile, created from the
+    outputs already there if the folder has none yet"""
+
+    new_catalog = not has_catalog(output_filepath)
+    catalog = Catalog(output_filepath)
+    if new_catalog:
+        # outputs written before there was a catalog
+        catalog.scan(dataset)
+    catalog.import_csv(csvfile, dataset)
+    return catalog
+
+
+def build_dataset(dataset: str, csvfile: str, output_filepath: str, writer, jobs: int = 1,
+                  incremental: bool = False, stream: bool = False, metrics: Optional[MetricsWriter] = None,
+                  profile_dir: Optional[str] = None, profiler: str = 'cprofile',
+                  prefetcher: Optional[Prefetcher] = None, shard: Optional[Tuple[int, int]] = None,
+                  queue: Optional[WorkQueue] = None, worker: Optional[str] = None,
+                  merged: Optional[str] = None, params: Optional[Dict] = None) -> None:
+    """Process a dataset, recording each completed task in the build manifest
+    and its outputs in the catalog (see src.data.catalog).
+
+    With `incremental` tasks whose source files, feature parameters and feature
+    code are unchanged since they were recorded, and whose outputs still exist,
+    are skipped. With `stream` recordings are read one epoch at a time.
+    Per-stage timings, bytes read and written and peak memory of each task are
+    saved to `metrics` if given, and each task is profiled if `profile_dir` is.
+    With a `prefetcher` raw files are copied to scratch space ahead of the tasks
+    that read them.
+
+    With a `shard` (index, count) only that part of the subjects is processed,
+    with a `queue` tasks are claimed from it as `worker` (see src.data.shard).
+    `merged` is the folder earlier shards were merged into, --incremental
+    also skips the tasks whose outputs are there.
+
+    Features are computed with `params` (see feature_params), by default those
+    in FEATURE_PARAMS for the dataset.
+    """
+
+    catalog = open_catalog(dataset, csvfile, output_filepath)
+    subjects = catalog.subjects(csvfile)
+    if shard is not None:
+        subjects = select_shard(subjects, *shard)
+    if merged is not None:
+        manifest = shard_manifest(merged, output_filepath) if incremental else {}
+        outputs = MergedOutputs(merged, writer)
+    else:
+        manifest = load_manifest(output_filepath) if incremental else {}
+        outputs = writer
+    params = params or FEATURE_PARAMS[dataset]
+    # the backend doesn't change the features
+    feature_digest_params = {key: value for key, value in params.items() if key != 'backend'}
+    version = code_version()
+
+    tasks = []
+    task_sources = {}
+    skipped = 0
+    for func, args, subject, run, sources in dataset_tasks(dataset, subjects, stream, params):
+        key = task_key(subject, run)
+        files = fingerprint(sources)
+        digest = task_digest(dataset, files, feature_digest_params, version)
+        if incremental and is_current(manifest, key, digest, outputs):
+            skipped += 1
+            continue
+
+        def done(written, task_metrics, key=key, digest=digest, files=files, subject=subject, run=run):
+            record_task(output_filepath, key, digest, files, written, dataset, feature_digest_params)
+            catalog.add_records(dataset, subject, run, written, getattr(writer, 'offsets', None))
+            if metrics is not None:
+                task_metrics['bytes_read'] = sum(f['size'] or 0 for f in files)
+                metrics.write(task_metrics)
+
+        tasks.append((func, args, key, done))
+        task_sources[key] = sources
+
+    if incremental:
+        logger.info("Skipping {} unchanged tasks, {} to run".format(skipped, len(tasks)))
+    try:
+        if queue is not None:
+            queue.add([task[2] for task in tasks])
+            run_queue(tasks, writer, queue, worker, profile_dir, profiler)
         else:
-            logger.error("Missing: {}".format(subject))
+            run_tasks(tasks, writer, jobs, profile_dir, profiler, prefetcher, task_sources)
+    finally:
+        catalog.close()
 
 
+def make_hcp_dataset(csvfile: str, output_filepath: str, writer, **options) -> None:
+    """Process the hcp dataset, one task per subject and run, options are passed to build_dataset"""
 
-def make_camcan_dataset(csvfile: str, output_filepath: str) -> None:
-    """Process the CAMCAN dataset"""
+    build_dataset('hcp', csvfile, output_filepath, writer, **options)
 
-    subjects = load_subjects(csvfile)
 
-    for subject in subjects:
-        print("Subject", subject)
-        raw = read_camcan(subject, CAMCAN_DATA_FOLDER)
-        print("read raw...")
-        if raw:
-            labels, features = spectral_epochs(subject, raw, EPOCH_DURATION, filter=False)
-            for i in range(len(labels)):
-                fname = os.path.join(output_filepath, labels[i] + ".npy")
-                np.save(fname, features[i])
-                print("Wrote {}".format(fname))
-                logger.info("Wrote {}".format(fname))
-        else:
-            logger.error("Missing: {}".format(subject))
+def make_mous_dataset(csvfile: str, output_filepath: str, writer, **options) -> None:
+    """Process the MOUS dataset, options are passed to build_dataset"""
+
+    build_dataset('mous', csvfile, output_filepath, writer, **options)
+
 
+def make_camcan_dataset(csvfile: str, output_filepath: str, writer, **options) -> None:
+    """Process the CAMCAN dataset, options are passed to build_dataset"""
+
+    build_dataset('camcan', csvfile, output_filepath, writer, **options)
+
+
+def make_writer(path: str, store: bool = False, dtype: str = 'float64', compression: Optional[str] = None):
+    """The writer for an output folder, a StoreWriter or an NpyWriter"""
+
+    os.makedirs(path, exist_ok=True)
+    return StoreWriter(path, dtype, compression) if store else NpyWriter(path, dtype)
+
+
+def queue_worker(dataset: str, csvfile: str, output_filepath: str, worker: str, writer_options: Dict,
+                 queue_options: Dict, metrics_file: Optional[str] = None, **options) -> None:
+    """Build a dataset from a work queue in output_filepath until it is empty,
+    writing to the worker's own shard folder"""
+
+    folder = shard_folder(output_filepath, worker)
+    metrics = MetricsWriter(metrics_file, {'dataset': dataset, 'worker': worker}) if metrics_file else None
+    try:
+        with WorkQueue(os.path.join(output_filepath, QUEUE), **queue_options) as queue, \
+                make_writer(folder, **writer_options) as writer:
+            build_dataset(dataset, csvfile, folder, writer, metrics=metrics, queue=queue, worker=worker,
+                          merged=output_filepath, **options)
+    finally:
+        if metrics is not None:
+            metrics.close()
+
+
+def _shard(ctx, param, value):
+    try:
+        return parse_shard(value) if value else None
+    except ValueError as exc:
+        raise click.BadParameter(str(exc))
+
+
+def _check_options(store: bool, dtype: str, compression: Optional[str], shard: Optional[Tuple[int, int]],
+                   queue: bool, prefetch: int, jobs: int, metrics_file: Optional[str]) -> None:
+    """Raise a click error for combinations of options that aren't supported"""
+
+    if not store and (dtype == 'int16' or compression):
+        raise click.UsageError("--dtype int16 and --compress are only supported with --store")
+    try:
+        check_codec(compression)
+    except ImportError as exc:
+        raise click.BadParameter(str(exc), param_hint='--compress')
+
+    if queue and shard:
+        raise click.UsageError("--shard and --queue can't be used together")
+    if queue and prefetch:
+        raise click.UsageError("--prefetch is not supported with --queue")
+    if queue and jobs > 1 and metrics_file and metrics_file.endswith('.prom'):
+        raise click.UsageError("Use a JSON lines --metrics file with --queue and several jobs")
+
+
+def make_prefetcher(prefetch: int, prefetch_budget: str, scratch: Optional[str], jobs: int) -> Optional[Prefetcher]:
+    """A Prefetcher for --prefetch tasks ahead of the running ones, None if prefetch is 0"""
+
+    if not prefetch:
+        return None
+    try:
+        budget = parse_size(prefetch_budget)
+    except ValueError as exc:
+        raise click.BadParameter(str(exc), param_hint='--prefetch-budget')
+    # files for the tasks running in each job plus `prefetch` more
+    return Prefetcher(scratch or tempfile.mkdtemp(prefix='prefetch-'), budget, tasks=jobs + prefetch)
+
+
+def run_queue_workers(dataset: str, csvfile: str, output_filepath: str, jobs: int, writer_options: Dict,
+                      queue_options: Dict, metrics_file: Optional[str], options: Dict) -> None:
+    """Run `jobs` queue_worker processes until the work queue in output_filepath is empty,
+    then print the number of tasks in each state"""
+
+    logger = logging.getLogger(__name__)
+    workers = [multiprocessing.Process(target=queue_worker, args=(dataset, csvfile, output_filepath,
+                                                                  worker_name(job), writer_options,
+                                                                  queue_options, metrics_file),
+                                       kwargs=options)
+               for job in range(jobs)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+        if process.exitcode:
+            logger.error("Queue worker {} exited with code {}".format(process.pid, process.exitcode))
+    with WorkQueue(os.path.join(output_filepath, QUEUE), **queue_options) as work:
+        print("\nTasks:", ", ".join("{} {}".format(count, state) for state, count in work.status().items()))
+
+
+def build_folder(dataset: str, csvfile: str, output_filepath: str, jobs: int, writer_options: Dict,
+                 metrics_file: Optional[str], prefetcher: Optional[Prefetcher], shard: Optional[Tuple[int, int]],
+                 options: Dict) -> None:
+    """Build a dataset (or one shard of it) with a pool of `jobs` processes, see build_dataset"""
+
+    folder = shard_folder(output_filepath, 'shard-{}-of-{}'.format(*shard)) if shard else output_filepath
+    metrics = MetricsWriter(metrics_file, {'dataset': dataset}) if metrics_file else None
+    try:
+        with make_writer(folder, **writer_options) as writer:
+            build_dataset(dataset, csvfile, folder, writer, jobs=jobs, metrics=metrics, prefetcher=prefetcher,
+                          shard=shard, merged=output_filepath if shard else None, **options)
+    finally:
+        if metrics is not None:
+            metrics.close()
+        if prefetcher is not None:
+            prefetcher.close()
 
 
 @click.command()
 @click.argument('dataset', type=click.STRING)
 @click.argument('csvfile', type=click.Path(exists=True))
 @click.argument('output_filepath', type=click.Path())
-def main(dataset, csvfile, output_filepath):
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=1,
+              help='Number of worker processes (default 1, no pool)')
+@click.option('--store', is_flag=True,
+              help='Write a consolidated feature store instead of one .npy file per epoch')
+@click.option('--incremental', is_flag=True,
+              help='Skip subjects whose inputs and parameters are unchanged since the last build')
+@click.option('--stream', is_flag=True,
+              help='Read recordings one epoch at a time instead of loading them into memory')
+@click.option('--metrics', 'metrics_file', type=click.Path(),
+              help='Save per-task stage timings, bytes and memory as JSON lines (or Prometheus text for .prom)')
+@click.option('--profile', 'profile_dir', type=click.Path(), help='Save a profile of every task in this folder')
+@click.option('--profiler', type=click.Choice(['cprofile', 'pyinstrument']), default='cprofile',
+              help='Profiler used with --profile')
+@click.option('--filter-cache', 'filter_cache', type=click.Path(),
+              help='Keep designed filter kernels in this folder between runs')
+@click.option('--prefetch', type=click.IntRange(min=0), default=0,
+              help='Copy raw files for up to this many upcoming tasks to scratch space (default 0, off)')
+@click.option('--prefetch-budget', default='16G', help='Most scratch space used by prefetched files (eg. 500M, 16G)')
+@click.option('--scratch', type=click.Path(), help='Scratch folder for prefetched files (default a temporary folder)')
+@click.option('--dtype', type=click.Choice(STORAGE_DTYPES), default='float64',
+              help='Storage type of the features, int16 needs --store')
+@click.option('--compress', 'compression', type=click.Choice(CODECS), help='Compress each record, needs --store')
+@click.option('--shard', callback=_shard, metavar='I/N',
+              help='Process only shard I of N (0 <= I < N) of the subjects, into OUTPUT_FILEPATH/shards')
+@click.option('--queue', is_flag=True,
+              help='Take tasks from a work queue in OUTPUT_FILEPATH shared with other machines, --jobs workers')
+@click.option('--retries', default=3, type=click.IntRange(min=1), help='Attempts at each task with --queue')
+@click.option('--lease', default=600., help='Seconds before a task of an unresponsive worker is handed on (--queue)')
+@click.option('--merge', is_flag=True, help='Merge all shards into OUTPUT_FILEPATH when done')
+@click.option('--estimator', type=click.Choice(ESTIMATORS),
+              help='Spectral estimator (default the one in FEATURE_PARAMS for the dataset, welch)')
+@click.option('--n-fft', 'n_fft', type=click.IntRange(min=0),
+              help='FFT segment length (default 48), 0 for the whole epoch with multitaper or 1Hz bins with bandpower')
+@click.option('--bandwidth', type=click.FloatRange(min=0, min_open=True),
+              help='Multitaper bandwidth in Hz (default a time-half-bandwidth product of 4)')
+@click.option('--antialias', is_flag=True, help='Low-pass filter each epoch before it is decimated')
+@click.option('--backend', type=click.Choice(BACKENDS), default='numpy',
+              help='Compute Welch PSDs with numpy (default) or compiled numba kernels (numpy, with a '
+                   'warning, if numba is not installed)')
+def main(dataset, csvfile, output_filepath, jobs, store, incremental, stream, metrics_file, profile_dir, profiler,
+         filter_cache, prefetch, prefetch_budget, scratch, dtype, compression, shard, queue, retries, lease, merge,
+         estimator, n_fft, bandwidth, antialias, backend):
     """ Runs data processing scripts to turn raw data from (../raw) into
         cleaned data ready to be analyzed (saved in ../processed).
     """
@@ -151,17 +609,35 @@ def main(dataset, csvfile, output_filepath):
     if not os.path.exists(output_filepath):
         os.makedirs(output_filepath)
 
-    if dataset == 'hcp':
-        make_hcp_dataset(csvfile, output_filepath)
-    elif dataset == 'mous':
-        make_mous_dataset(csvfile, output_filepath)
-    elif dataset == 'camcan':
-        make_camcan_dataset(csvfile, output_filepath)
-    else:
+    if dataset not in ('hcp', 'mous', 'camcan'):
         print("Unknown dataset name", dataset)
+        return
+
+    _check_options(store, dtype, compression, shard, queue, prefetch, jobs, metrics_file)
+
+    if filter_cache:
+        from src.features.filters import set_cache_dir
+        set_cache_dir(filter_cache)
+
+    params = feature_params(dataset, estimator, n_fft, bandwidth, antialias, backend)
+    if n_fft == 0 and params['estimator'] == 'welch':
+        raise click.BadParameter("0 is only allowed with multitaper or bandpower", param_hint='--n-fft')
+
+    writer_options = {'store': store, 'dtype': dtype, 'compression': compression}
+    options = {'incremental': incremental, 'stream': stream, 'profile_dir': profile_dir, 'profiler': profiler,
+               'params': params}
+    if queue:
+        run_queue_workers(dataset, csvfile, output_filepath, jobs, writer_options, {'lease': lease, 'retries': retries},
+                          metrics_file, options)
+    else:
+        build_folder(dataset, csvfile, output_filepath, jobs, writer_options, metrics_file,
+                     make_prefetcher(prefetch, prefetch_budget, scratch, jobs), shard, options)
+    if merge:
+        print("Merged {} records".format(merge_shards(output_filepath)))
 
     print("\nDone")
 
+
 if __name__ == '__main__':
 
     main()
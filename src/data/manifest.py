@@ -0,0 +1,118 @@
+"""
+    Build manifest for incremental dataset builds.
+
+    Every task (a subject, or a subject and run for HCP) that make_dataset completes
+    is recorded in <output>/manifest.jsonl with a digest of its inputs: the path,
+    mtime and size of each source file, the feature parameters and the version of
+    the feature code. A later run with --incremental skips any task whose digest
+    is unchanged and whose outputs still exist. Each entry also keeps the dataset
+    and feature parameters, so build_params can tell what a folder was built with.
+
+    The manifest is append-only, one JSON object per line, so a crash can lose at
+    most the task being written; later lines for a key replace earlier ones.
+"""
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+MANIFEST = 'manifest.jsonl'
+
+FEATURE_CODE = [os.path.join(os.path.dirname(os.path.dirname(__file__)), 'features', name)
+                for name in ('build_features.py', 'filters.py', 'spectral.py', 'kernels.py')]
+
+
+def code_version() -> str:
+    """Digest of the feature extraction code, changes whenever it is edited"""
+
+    digest = hashlib.sha1()
+    for path in FEATURE_CODE:
+        with open(path, 'rb') as fd:
+            digest.update(fd.read())
+    return digest.hexdigest()
+
+
+def fingerprint(paths: List[str]) -> List[Dict]:
+    """Return path, mtime and size for every file in paths, directories are walked"""
+
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    result.extend(fingerprint([os.path.join(dirpath, filename)]))
+        elif os.path.exists(path):
+            stat = os.stat(path)
+            result.append({'path': path, 'mtime': stat.st_mtime, 'size': stat.st_size})
+        else:
+            result.append({'path': path, 'mtime': None, 'size': None})
+    return result
+
+
+def task_key(subject: str, run: Optional[int] = None) -> str:
+    return subject if run is None else "{}/{}".format(subject, run)
+
+
+def task_digest(dataset: str, sources: List[Dict], params: Dict, version: str) -> str:
+    """Content address of a task: changes if any input or parameter changes"""
+
+    description = {'dataset': dataset, 'sources': sources, 'params': params, 'version': version}
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def load_manifest(output_filepath: str) -> Dict:
+    """Read the manifest, return a dictionary of the latest entry for each task key"""
+
+    result: Dict = {}
+    path = os.path.join(output_filepath, MANIFEST)
+    if not os.path.exists(path):
+        return result
+    with open(path) as fd:
+        for line in fd:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # a partial line left by a crash
+                continue
+            result[entry['key']] = entry
+    return result
+
+
+def record_task(output_filepath: str, key: str, digest: str, sources: List[Dict], outputs: List[str],
+                dataset: Optional[str] = None, params: Optional[Dict] = None) -> Dict:
+    """Append a completed task to the manifest"""
+
+    entry = {'key': key, 'digest': digest, 'sources': sources, 'outputs': outputs, 'dataset': dataset,
+             'params': params}
+    with open(os.path.join(output_filepath, MANIFEST), 'a') as fd:
+        fd.write(json.dumps(entry) + "\n")
+    return entry
+
+
+def build_params(output_filepath: str, subjects: Optional[Dict] = None) -> Tuple[str, Dict]:
+    """The dataset and feature parameters the tasks in the manifest (only those of
+    `subjects`, if given) were built with. Raises ValueError if there are none,
+    if any task doesn't record them or if they differ between tasks."""
+
+    found = {}
+    for key, entry in load_manifest(output_filepath).items():
+        if subjects is not None and key.split('/')[0] not in subjects:
+            continue
+        if entry.get('params') is None:
+            raise ValueError("Task {} in {} doesn't record its feature parameters, rebuild the folder "
+                             "with this version of make_dataset".format(key, output_filepath))
+        found[json.dumps([entry['dataset'], entry['params']], sort_keys=True)] = (entry['dataset'], entry['params'])
+    if not found:
+        raise ValueError("No build manifest for these records in {}".format(output_filepath))
+    if len(found) > 1:
+        raise ValueError("The records in {} were built with different feature parameters: {}".format(
+            output_filepath, "; ".join(sorted(found))))
+    return next(iter(found.values()))
+
+
+def is_current(manifest: Dict, key: str, digest: str, writer) -> bool:
+    """True if the task was completed with the same inputs and its outputs exist"""
+
+    entry = manifest.get(key)
+    return entry is not None and entry['digest'] == digest and writer.exists(entry['outputs'])
@@ -0,0 +1,131 @@
+"""
+    Prefetch raw recordings to local scratch space.
+
+    The raw data is on network storage, so a task that reads its recording
+    straight from there keeps the CPU idle while the file streams in. A
+    Prefetcher copies the source files of upcoming tasks to a scratch folder
+    in a background thread, in task order, while earlier tasks are computing.
+    Each task is only handed on once its files are local, and it then reads
+    them from the scratch copy.
+
+    Copies are limited by a byte budget and a number of tasks: a task's files
+    are not copied until enough of the tasks already holding scratch space have
+    released it (`release`, called once a task's results are written). A single
+    task larger than the whole budget is still copied, but only when nothing
+    else is staged.
+"""
+import logging
+import os
+import queue
+import re
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from src.data.manifest import fingerprint
+
+logger = logging.getLogger(__name__)
+
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(size: str) -> int:
+    """Parse a byte count such as 500M or 16G"""
+
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*', size.upper())
+    if match is None:
+        raise ValueError("Invalid size {}, expected eg. 500M or 16G".format(size))
+    return int(float(match.group(1)) * UNITS[match.group(2)])
+
+
+class Prefetcher:
+    """Copy the files of upcoming tasks to scratch space ahead of time.
+
+    Tasks are (function, args, key, ...) tuples whose last argument is the data
+    folder their files are read from; `sources` gives the files (or
+    directories) each task reads, which must be inside that folder. Staged
+    tasks are returned with the data folder replaced by their scratch copy.
+    At most `tasks` tasks (those running and those waiting) hold copies at once.
+    """
+
+    def __init__(self, scratch: str, budget: int, tasks: int = 2, threads: int = 4):
+        self.scratch = scratch
+        self.budget = budget
+        self.tasks = tasks
+        self.threads = threads
+        self.used = 0
+        self.held: Dict[str, Tuple[int, str]] = {}
+        self.condition = threading.Condition()
+        os.makedirs(scratch, exist_ok=True)
+
+    def _acquire(self, key: str, size: int, folder: str) -> None:
+        with self.condition:
+            self.condition.wait_for(lambda: not self.held or (self.used + size <= self.budget and
+                                                              len(self.held) < self.tasks))
+            self.used += size
+            self.held[key] = (size, folder)
+
+    def release(self, key: str) -> None:
+        """Delete the scratch copy of a task's files and return its bytes to the budget"""
+
+        with self.condition:
+            size, folder = self.held.pop(key, (0, None))
+            self.used -= size
+            self.condition.notify_all()
+        if folder:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def _copy(self, task: Tuple, sources: List[str]) -> Tuple:
+        func, args, key = task[:3]
+        data_folder = args[-1]
+        files = [f for f in fingerprint(sources) if f['size'] is not None]
+        if not files or any(os.path.relpath(f['path'], data_folder).startswith('..') for f in files):
+            return task
+        folder = os.path.join(self.scratch, key.replace('/', '-'))
+        self._acquire(key, sum(f['size'] for f in files), folder)
+
+        def copy(path: str) -> None:
+            target = os.path.join(folder, os.path.relpath(path, data_folder))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(path, target)
+
+        try:
+            with ThreadPoolExecutor(self.threads) as pool:
+                list(pool.map(copy, [f['path'] for f in files]))
+        except OSError as exc:
+            # read from the original location instead
+            logger.warning("Prefetch of {} failed: {}".format(key, exc))
+            self.release(key)
+            return task
+        return (func, args[:-1] + (folder,), key) + tuple(task[3:])
+
+    def staged(self, tasks: Iterable[Tuple], sources: Dict[str, List[str]]) -> Iterator[Tuple]:
+        """Generate the tasks in order, each once its files have been copied.
+        sources maps each task key to the files it reads."""
+
+        ready: queue.Queue = queue.Queue()
+        done = object()
+
+        def worker():
+            try:
+                for task in tasks:
+                    ready.put(self._copy(task, sources.get(task[2], [])))
+            except BaseException as exc:
+                ready.put(exc)
+            ready.put(done)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        while True:
+            item = ready.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def close(self) -> None:
+        """Remove the scratch folder"""
+
+        shutil.rmtree(self.scratch, ignore_errors=True)
@@ -1,22 +1,185 @@
 """
     Preprocess data ready for feeding to the model.
+
+    Design matrices (see src.features.assemble) have channels * freqs columns,
+    so a full SVD of all the records gets slow and memory hungry as channels,
+    frequency bins and epochs are added. A Reduction is a linear projection onto
+    the top principal components, fitted with one of three back ends:
+
+    randomized   PCA with a randomized truncated SVD, the whole matrix in memory
+    incremental  IncrementalPCA, reading batch_size records at a time, so memory
+                 use doesn't depend on the number of records
+    full         PCA with a full SVD, for comparison
+
+    Unless the number of components is given, it is the smallest that explains
+    `variance` of the total variance in a randomized SVD of a sample of at most
+    SAMPLE records. A fitted reduction is saved as an .npz file (mean,
+    components, explained variance and the channels it was fitted on) and
+    applied without sklearn, batch_size records at a time:
+
+    python -m src.data.preprocess data/processed/hcp data/hcp-train.csv models/pca-hcp.npz --channels 20
 """
-from sklearn.decomposition import PCA
-from typing import Dict, Tuple
+import click
+import json
+import numpy as np
+from typing import Dict, List, Optional, Tuple, Union
+
+from src.data.records import Record, dataset_records
+from src.features.assemble import dataset_matrix, design_matrix
+
+METHODS = ('randomized', 'incremental', 'full')
+
+# records in the sample used to choose the number of components
+SAMPLE = 2000
+
+Rows = Union[np.ndarray, List[Record]]
+
+
+def _matrix(rows: Rows, index, channels: Optional[int] = None) -> np.ndarray:
+    """Rows of a design matrix, or the design matrix of some records from dataset_records"""
+
+    if isinstance(rows, np.ndarray):
+        return np.asarray(rows[index], dtype=np.float64)
+    selected = rows[index] if isinstance(index, slice) else [rows[i] for i in index]
+    return design_matrix([loader() for _, _, loader in selected], channels, dtype=np.float64)
+
+
+def choose_components(sample: np.ndarray, variance: float = 0.95, max_components: Optional[int] = None,
+                      seed: int = 0) -> int:
+    """The smallest number of components explaining `variance` of the total
+    variance of sample (at most max_components).
+
+    Randomized SVDs of 32, 64, 128... components are computed until enough of
+    the variance is explained, so the cost grows with the number of components
+    needed rather than with the number of features."""
+    from sklearn.utils.extmath import randomized_svd
+
+    centered = sample - sample.mean(axis=0)
+    total = np.sum(centered ** 2)
+    limit = min(max_components or sample.shape[1], *sample.shape)
+    if total == 0:
+        return 1
+    k = min(32, limit)
+    while True:
+        _, singular, _ = randomized_svd(centered, k, random_state=seed)
+        explained = np.cumsum(singular ** 2) / total
+        if explained[-1] >= variance or k == limit:
+            return int(min(np.searchsorted(explained, variance) + 1, k))
+        k = min(2 * k, limit)
+
+
+class Reduction:
+    """A fitted projection of design matrix rows onto principal components,
+    (X - mean) @ components.T as sklearn's PCA.transform"""
+
+    def __init__(self, mean: np.ndarray, components: np.ndarray, explained_variance: np.ndarray,
+                 method: str = 'randomized', channels: Optional[int] = None):
+        self.mean = mean
+        self.components = components
+        self.explained_variance = explained_variance
+        self.method = method
+        self.channels = channels
+
+    @property
+    def n_components(self) -> int:
+        return len(self.components)
+
+    def transform(self, X: np.ndarray, batch_size: int = 4096, dtype=np.float64) -> np.ndarray:
+        """Project the rows of X, batch_size rows at a time into one output array"""
+
+        out = np.empty((len(X), self.n_components), dtype=dtype)
+        for start in range(0, len(X), batch_size):
+            block = np.asarray(X[start:start + batch_size], dtype=np.float64) - self.mean
+            out[start:start + batch_size] = np.dot(block, self.components.T)
+        return out
+
+    def transform_records(self, records: List[Record], batch_size: int = 4096, dtype=np.float64) -> np.ndarray:
+        """Project records from dataset_records, reading batch_size of them at a time"""
+
+        out = np.empty((len(records), self.n_components), dtype=dtype)
+        for start in range(0, len(records), batch_size):
+            block = _matrix(records, slice(start, start + batch_size), self.channels)
+            out[start:start + batch_size] = self.transform(block, batch_size)
+        return out
+
+    def save(self, path: str) -> None:
+        meta = {'method': self.method, 'channels': self.channels}
+        np.savez(path, mean=self.mean, components=self.components, explained_variance=self.explained_variance,
+                 meta=np.array(json.dumps(meta)))
+
+    @classmethod
+    def load(cls, path: str) -> 'Reduction':
+        with np.load(path, allow_pickle=False) as saved:
+            meta = json.loads(str(saved['meta']))
+            return cls(saved['mean'], saved['components'], saved['explained_variance'], **meta)
+
+
+def fit_reduction(rows: Rows, channels: Optional[int] = None, method: str = 'randomized',
+                  n_components: Optional[int] = None, variance: float = 0.95, batch_size: int = 1024,
+                  seed: int = 0) -> Reduction:
+    """Fit a reduction to a design matrix or to records from dataset_records
+    (using their first `channels` channels), see the module docstring"""
+    from sklearn.decomposition import PCA, IncrementalPCA
+
+    if method not in METHODS:
+        raise ValueError("Unknown reduction method {}, expected one of {}".format(method, ', '.join(METHODS)))
+    n_rows = len(rows)
+    if n_components is None:
+        sample = _matrix(rows, np.unique(np.linspace(0, n_rows - 1, min(n_rows, SAMPLE)).astype(int)), channels)
+        n_components = choose_components(sample, variance, seed=seed)
+
+    if method == 'incremental':
+        # every batch must have at least n_components rows, a short last batch joins the one before
+        batch_size = max(batch_size, n_components)
+        starts = list(range(0, n_rows, batch_size))
+        if len(starts) > 1 and n_rows - starts[-1] < n_components:
+            starts.pop()
+        estimator = IncrementalPCA(n_components=n_components)
+        for i, start in enumerate(starts):
+            stop = starts[i + 1] if i + 1 < len(starts) else n_rows
+            estimator.partial_fit(_matrix(rows, slice(start, stop), channels))
+    else:
+        estimator = PCA(n_components=n_components, svd_solver=method, random_state=seed)
+        estimator.fit(_matrix(rows, slice(None), channels))
+    return Reduction(estimator.mean_, estimator.components_, estimator.explained_variance_, method, channels)
+
+
+def run_pca(dataset: Dict, channels: Optional[int] = None, **options) -> Tuple[Dict, Reduction]:
+    """Apply PCA to a dataset from load_dataset, using the first `channels` channels
+    of each record (default all). Options are passed to fit_reduction.
 
-def run_pca(dataset: Dict) -> Tuple[Dict, PCA]:
-    """Apply PCA to a dataset"""
+    Returns the dataset with 'data' replaced by the (records, components) matrix
+    and the fitted reduction, which can be applied to other data with transform."""
 
-    pca = PCA(n_components='mle')
+    X = dataset_matrix(dataset, channels, dtype=np.float64)
+    reduction = fit_reduction(X, channels, **options)
+    result = {key: value for key, value in dataset.items() if key not in ('data', 'store', 'offsets')}
+    result['data'] = reduction.transform(X)
+    return result, reduction
 
-    transformed_data = pca.fit_transform(dataset['data'])
 
-    result = {
-        'data': transformed_data,
-        'target': dataset['target']
-    }
+@click.command()
+@click.argument('data_folder', type=click.Path(exists=True))
+@click.argument('csvfile', type=click.Path(exists=True))
+@click.argument('output_file', type=click.Path())
+@click.option('--channels', default=10, type=click.IntRange(min=1), help='Channels of each record used (default 10)')
+@click.option('--method', type=click.Choice(METHODS), default='randomized', help='Back end used to fit')
+@click.option('--components', 'n_components', type=click.IntRange(min=1),
+              help='Number of components (default chosen by --variance)')
+@click.option('--variance', default=0.95, type=click.FloatRange(0, 1, min_open=True),
+              help='Fraction of the variance the components explain')
+@click.option('--batch-size', default=1024, type=click.IntRange(min=1), help='Records read at a time by incremental')
+@click.option('--seed', default=0, help='Random seed for the randomized SVDs')
+def main(data_folder, csvfile, output_file, channels, method, n_components, variance, batch_size, seed):
+    """Fit a reduction to the records in DATA_FOLDER of the subjects in CSVFILE and save it in OUTPUT_FILE"""
 
-    return result, pca
+    records = dataset_records(data_folder, csvfile)
+    reduction = fit_reduction(records, channels, method, n_components, variance, batch_size, seed)
+    reduction.save(output_file)
+    print("{} components from {} records of {} features, saved in {}".format(
+        reduction.n_components, len(records), len(reduction.mean), output_file))
 
 
+if __name__ == '__main__':
 
+    main()
@@ -0,0 +1,56 @@
+"""
+    List the records of a dataset without reading their features.
+
+    Whatever the layout of a folder of processed features (.npy files, a
+    catalogued folder, a consolidated store or a shared dataset), each record is returned as
+    (id, age, loader) where calling loader() reads its (1, channels, freqs)
+    features, so callers can read them in batches with bounded memory.
+"""
+import functools
+import os
+import numpy as np
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src.data.catalog import Catalog, has_catalog
+from src.data.make_dataset import load_subjects, subject_files
+from src.data.shared import is_shared, open_shared
+from src.data.store import is_store, open_store, record_data
+
+# (id, age, loader), calling loader() reads the (1, channels, freqs) features of the record
+Record = Tuple[str, Optional[str], Callable[[], np.ndarray]]
+
+
+def _indexed_records(index: List[Dict], subjects: Dict, read: Callable[[Dict], np.ndarray]) -> List[Record]:
+    """The records of subjects in the index of a store or shared dataset, read(record) reads one"""
+
+    return [(record['id'], subjects[record['subject']].get('age'), functools.partial(read, record))
+            for record in index if record['subject'] in subjects]
+
+
+def dataset_records(data_folder: str, csvfile: str) -> List[Record]:
+    """List the records of the subjects in csvfile without reading their features.
+    data_folder is a folder of .npy files, a consolidated store or shm:<name> (see src.data.shared)"""
+
+    subjects = load_subjects(csvfile)
+    if is_shared(data_folder):
+        shared = open_shared(data_folder)
+        return _indexed_records(shared.index(), subjects, shared.record)
+    if is_store(data_folder):
+        data, index = open_store(data_folder)
+        return _indexed_records(index, subjects, functools.partial(record_data, data))
+
+    records: List[Record] = []
+    if has_catalog(data_folder):
+        with Catalog(data_folder) as catalog:
+            catalog.refresh()
+            for record in catalog.records(csvfile):
+                if record['path'] is not None:
+                    records.append((record['id'], subjects[record['subject']].get('age'),
+                                    functools.partial(np.load, record['path'])))
+        return records
+
+    for subject in subjects:
+        for filename in subject_files(data_folder, subject):
+            records.append((os.path.splitext(os.path.basename(filename))[0], subjects[subject].get('age'),
+                            functools.partial(np.load, filename)))
+    return records
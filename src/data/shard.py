@@ -0,0 +1,331 @@
+"""
+    Sharded and multi-node dataset builds.
+
+    A full rebuild can be split across machines that share the output folder
+    in two ways:
+
+    --shard i/N   each machine processes a fixed part of the subjects, those
+                  whose crc32(subject) % N == i (0 <= i < N), so the split is the
+                  same on every machine and every run
+    --queue       every machine (and every local job) pulls tasks from a work
+                  queue, <output>/queue.sqlite, until none are left. A task that
+                  raises is retried, on any worker, up to --retries times, and a
+                  task whose worker stops renewing its lease (because it crashed or
+                  was killed) is handed to another worker.
+
+    Either way each shard or worker writes to its own folder, <output>/shards/<name>,
+    with its own store or .npy files, manifest and catalog, so nothing is written
+    concurrently. Once all of them have finished, merge_shards moves their
+    outputs into <output> and combines them into one index, manifest and catalog.
+    Records whose id is already merged are skipped, so a task that ran twice
+    (after its lease expired) or a merge that is rerun after a crash doesn't
+    duplicate them:
+
+    python -m src.data.shard merge data/processed/hcp
+    python -m src.data.shard status data/processed/hcp
+
+    The queue relies on SQLite locking, which needs a shared filesystem with
+    working POSIX locks (eg. NFSv4 or Lustre with locking enabled).
+"""
+import click
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from src.data.catalog import Catalog, has_catalog
+from src.data.manifest import MANIFEST, load_manifest
+from src.data.store import StoreWriter, is_store, read_index
+
+SHARDS = 'shards'
+QUEUE = 'queue.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (key TEXT PRIMARY KEY, state TEXT, attempts INTEGER, worker TEXT,
+                                  renewed REAL, error TEXT);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state);
+"""
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """Parse a shard given as i/N"""
+
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise ValueError("Invalid shard {}, expected i/N eg. 0/4".format(value))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError("Invalid shard {}, expected 0 <= i < N".format(value))
+    return index, count
+
+
+def shard_of(subject: str, count: int) -> int:
+    """The shard a subject belongs to, the same in every process and on every machine"""
+
+    return zlib.crc32(subject.encode('utf-8')) % count
+
+
+def select_shard(subjects: Dict, index: int, count: int) -> Dict:
+    """The subjects (from load_subjects) in shard index of count"""
+
+    return {subject: value for subject, value in subjects.items() if shard_of(subject, count) == index}
+
+
+def shard_folder(output_filepath: str, name: str) -> str:
+    return os.path.join(output_filepath, SHARDS, name)
+
+
+def worker_name(job: int = 0) -> str:
+    """Name of a local queue worker, stable across runs so --incremental can
+    skip the tasks it completed before"""
+
+    return "{}-{}".format(socket.gethostname(), job)
+
+
+class WorkQueue:
+    """Tasks shared by several workers in an SQLite database.
+
+    Each task is pending, running, done or failed. claim() takes a pending task,
+    or one that has been tried fewer than `retries` times and either failed or
+    was not renewed by its worker for `lease` seconds. A worker whose lease has
+    expired no longer owns its task, so its renew, done and fail do nothing.
+    """
+
+    def __init__(self, path: str, lease: float = 600, retries: int = 3):
+        self.path = path
+        self.lease = lease
+        self.retries = retries
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = self._connect()
+        self.db.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        # autocommit, transactions are started explicitly with BEGIN IMMEDIATE
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def add(self, keys: Sequence[str]) -> None:
+        """Add tasks, keeping the state of any that are already queued"""
+
+        self.db.execute("BEGIN IMMEDIATE")
+        self.db.executemany("INSERT OR IGNORE INTO tasks VALUES (?, 'pending', 0, NULL, NULL, NULL)",
+                            [(key,) for key in keys])
+        self.db.execute("COMMIT")
+
+    def claim(self, worker: str, keys: Optional[Sequence[str]] = None) -> Optional[str]:
+        """Take the next task (one of keys, if given) for worker, return its key or None"""
+
+        now = time.time()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.db.execute(
+                "SELECT key FROM tasks WHERE state = 'pending' OR (state IN ('running', 'failed') AND attempts < ? "
+                "AND (state = 'failed' OR renewed < ?)) ORDER BY attempts, rowid",
+                (self.retries, now - self.lease)).fetchall()
+            key = next((row['key'] for row in rows if keys is None or row['key'] in keys), None)
+            if key is not None:
+                self.db.execute("UPDATE tasks SET state = 'running', attempts = attempts + 1, worker = ?, "
+                                "renewed = ? WHERE key = ?", (worker, now, key))
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        return key
+
+    def renew(self, key: str, worker: str, db: Optional[sqlite3.Connection] = None) -> None:
+        (db or self.db).execute("UPDATE tasks SET renewed = ? WHERE key = ? AND worker = ? AND state = 'running'",
+                                (time.time(), key, worker))
+
+    def owns(self, key: str, worker: str) -> bool:
+        """Return True if worker is still running the task, ie. it hasn't been
+        handed to another worker after the lease expired"""
+
+        return self.db.execute("SELECT 1 FROM tasks WHERE key = ? AND worker = ? AND state = 'running'",
+                               (key, worker)).fetchone() is not None
+
+    def done(self, key: str, worker: str) -> bool:
+        """Mark worker's task as done, return False if worker no longer owns it"""
+
+        return self.db.execute("UPDATE tasks SET state = 'done', error = NULL WHERE key = ? AND worker = ? "
+                               "AND state = 'running'", (key, worker)).rowcount > 0
+
+    def fail(self, key: str, worker: str, error: str) -> bool:
+        """Mark worker's task as failed, return False if worker no longer owns it"""
+
+        return self.db.execute("UPDATE tasks SET state = 'failed', error = ? WHERE key = ? AND worker = ? "
+                               "AND state = 'running'", (error, key, worker)).rowcount > 0
+
+    def keep_alive(self, key: str, worker: str) -> 'Lease':
+        """Context manager renewing the lease on a task while it runs"""
+
+        return Lease(self, key, worker)
+
+    def status(self) -> Dict[str, int]:
+        """Number of tasks in each state, failed tasks that will not be retried
+        are counted as 'abandoned'"""
+
+        counts = {'pending': 0, 'running': 0, 'done': 0, 'failed': 0, 'abandoned': 0}
+        for row in self.db.execute("SELECT state, attempts >= ? AS final, COUNT(*) AS n FROM tasks "
+                                   "GROUP BY state, final", (self.retries,)):
+            state = 'abandoned' if row['state'] == 'failed' and row['final'] else row['state']
+            counts[state] += row['n']
+        return counts
+
+    def failures(self) -> List[Dict]:
+        return [dict(row) for row in self.db.execute("SELECT * FROM tasks WHERE state = 'failed' ORDER BY key")]
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Lease:
+    """Renew a task's lease from a background thread every lease / 4 seconds"""
+
+    def __init__(self, queue: WorkQueue, key: str, worker: str):
+        self.queue = queue
+        self.key = key
+        self.worker = worker
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        db = self.queue._connect()
+        try:
+            while not self.stopped.wait(self.queue.lease / 4):
+                self.queue.renew(self.key, self.worker, db)
+        finally:
+            db.close()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+
+
+class MergedOutputs:
+    """Check for outputs that earlier runs have already merged into the output
+    folder, so --incremental can skip them in a shard (see manifest.is_current)"""
+
+    def __init__(self, output_filepath: str, writer):
+        self.output_filepath = output_filepath
+        self.writer = writer
+        self.ids = set(record['id'] for record in read_index(output_filepath)) \
+            if is_store(output_filepath) else set()
+
+    def exists(self, names: List[str]) -> bool:
+        merged = [os.path.join(self.output_filepath, os.path.basename(name)) if name.endswith('.npy') else name
+                  for name in names]
+        return self.writer.exists(names) or all(name in self.ids or os.path.exists(name) for name in merged)
+
+
+def shard_manifest(output_filepath: str, folder: str) -> Dict:
+    """The manifest of a shard on top of that of the merged outputs"""
+
+    manifest = load_manifest(output_filepath)
+    manifest.update(load_manifest(folder))
+    return manifest
+
+
+def _merge_outputs(folder: str, output_filepath: str) -> Tuple[int, Optional[Dict[str, int]]]:
+    """Append the store of a shard to the one in output_filepath, or move its .npy files
+    there. Returns the number of records and, for a store, their new offsets."""
+
+    if is_store(folder):
+        with open(os.path.join(folder, 'meta.json')) as fd:
+            meta = json.load(fd)
+        with StoreWriter(output_filepath, meta['dtype'], meta.get('compression')) as writer:
+            offsets = writer.append_store(folder)
+        return len(offsets), offsets
+    count = 0
+    for entry in os.scandir(folder):
+        if entry.name.endswith('.npy'):
+            os.replace(entry.path, os.path.join(output_filepath, entry.name))
+            count += 1
+    return count, None
+
+
+def _merge_manifest(folder: str, output_filepath: str) -> None:
+    """Append the manifest of a shard to the one in output_filepath, with the moved .npy outputs"""
+
+    def moved(name: str) -> str:
+        return os.path.join(output_filepath, os.path.basename(name)) if name.endswith('.npy') else name
+
+    manifest = load_manifest(folder)
+    if manifest:
+        with open(os.path.join(output_filepath, MANIFEST), 'a') as fd:
+            for entry in manifest.values():
+                entry['outputs'] = [moved(name) for name in entry['outputs']]
+                fd.write(json.dumps(entry) + "\n")
+
+
+def merge_shards(output_filepath: str) -> int:
+    """Move the outputs of every shard into output_filepath and merge their
+    indexes, manifests and catalogs, then delete the shard folders.
+    Returns the number of records merged."""
+
+    root = os.path.join(output_filepath, SHARDS)
+    folders = sorted(entry.path for entry in os.scandir(root) if entry.is_dir()) if os.path.isdir(root) else []
+    count = 0
+    catalog = Catalog(output_filepath)
+    try:
+        for folder in folders:
+            merged, offsets = _merge_outputs(folder, output_filepath)
+            count += merged
+            _merge_manifest(folder, output_filepath)
+            if has_catalog(folder):
+                catalog.merge(folder, offsets)
+            shutil.rmtree(folder)
+    finally:
+        catalog.close()
+    if folders and not os.listdir(root):
+        os.rmdir(root)
+    return count
+
+
+@click.group()
+def main():
+    """Manage sharded and queued builds of a dataset"""
+
+
+@main.command()
+@click.argument('output_filepath', type=click.Path(exists=True))
+def merge(output_filepath):
+    """Merge the shards in OUTPUT_FILEPATH/shards into OUTPUT_FILEPATH"""
+
+    count = merge_shards(output_filepath)
+    print("Merged {} records into {}".format(count, output_filepath))
+
+
+@main.command()
+@click.argument('output_filepath', type=click.Path(exists=True))
+@click.option('--retries', default=3, help='Attempts before a failed task is abandoned')
+def status(output_filepath, retries):
+    """Show the state of the work queue in OUTPUT_FILEPATH"""
+
+    path = os.path.join(output_filepath, QUEUE)
+    if not os.path.exists(path):
+        raise click.UsageError("No work queue in {}".format(output_filepath))
+    with WorkQueue(path, retries=retries) as queue:
+        print(", ".join("{} {}".format(count, state) for state, count in queue.status().items()))
+        for task in queue.failures():
+            print("{key}: {attempts} attempts, last on {worker}: {error}".format(**task))
+
+
+if __name__ == '__main__':
+
+    main()
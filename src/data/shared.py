@@ -0,0 +1,363 @@
+"""
+    Share a loaded dataset between processes.
+
+    load_dataset reads every record into the memory of the process that calls it,
+    so a dozen experiments run side by side hold a dozen copies of the features
+    and each pays the load time. Instead, a server process can load a folder of
+    features once into a block of shared memory (multiprocessing.shared_memory)
+    laid out like a feature store: (rows, n_freq) with the channels of each record
+    in consecutive rows. It then stays up until it is stopped:
+
+    python -m src.data.shared serve data/processed/hcp data/hcp-speakers.csv --name hcp
+
+    Other processes attach to it by name. Any data folder argument given as
+    shm:<name> does this, so load_dataset('shm:hcp', 'data/hcp-train.csv') returns the
+    records of the training subjects. The 'data' arrays are read-only, zero-copy
+    views of the shared block, and design matrices are gathered straight from it
+    (see src.features.assemble):
+
+    python -m src.models.tune_model --data shm:hcp
+
+    The server describes each dataset in a JSON file in the registry folder
+    (REGISTRY in $XDG_RUNTIME_DIR or the temporary folder). Every process that
+    attaches holds a lease there, a file named after its pid. The server drops
+    the leases of processes that have exited, and with --linger it also unlinks
+    the shared memory and exits that many seconds after the last lease is
+    released. If the server itself dies, Python's resource tracker unlinks the
+    memory.
+"""
+import atexit
+import click
+import json
+import os
+import signal
+import tempfile
+import threading
+import time
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, List, Optional
+
+PREFIX = 'shm:'
+REGISTRY = 'age-classifier-shared'
+
+
+def is_shared(data_folder: str) -> bool:
+    """Return True if data_folder names a shared dataset, shm:<name>"""
+
+    return data_folder.startswith(PREFIX)
+
+
+def registry_folder() -> str:
+    folder = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(), REGISTRY)
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def _meta_path(name: str) -> str:
+    return os.path.join(registry_folder(), name + '.json')
+
+
+def _lease_folder(name: str) -> str:
+    return os.path.join(registry_folder(), name + '.leases')
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read_meta(name: str) -> Optional[Dict]:
+    """The description of a shared dataset whose server is running, or None"""
+
+    try:
+        with open(_meta_path(name)) as fd:
+            meta = json.load(fd)
+    except (OSError, ValueError):
+        return None
+    return meta if _alive(meta['pid']) else None
+
+
+def _attach_memory(segment: str) -> shared_memory.SharedMemory:
+    """Open a shared memory block created by another process without registering
+    it with this process's resource tracker, which would unlink it when this process exits"""
+
+    try:
+        return shared_memory.SharedMemory(segment, track=False)
+    except TypeError:
+        # before Python 3.13 every attached block is tracked
+        memory = shared_memory.SharedMemory(segment)
+        resource_tracker.unregister(memory._name, 'shared_memory')
+        return memory
+
+
+def record_subject(record_id: str) -> str:
+    """The subject of a record id, the part before the first '-' (see src.data.store.make_id)"""
+
+    return record_id.split('-', 1)[0]
+
+
+class SharedDataset:
+    """A dataset attached from shared memory, holding a lease until it is closed
+    (or the process exits)"""
+
+    def __init__(self, name: str):
+        meta = _read_meta(name)
+        if meta is None:
+            raise ValueError("No shared dataset named {}, start one with python -m src.data.shared serve".format(name))
+        self.name = name
+        self.meta = meta
+        os.makedirs(_lease_folder(name), exist_ok=True)
+        self.lease = os.path.join(_lease_folder(name), "{}-{}".format(os.getpid(), id(self)))
+        open(self.lease, 'w').close()
+        self.memory = _attach_memory(meta['segment'])
+        self.data = np.ndarray(tuple(meta['shape']), dtype=np.dtype(meta['dtype']), buffer=self.memory.buf)
+        self.data.flags.writeable = False
+        atexit.register(self.close)
+
+    def index(self) -> List[Dict]:
+        """id, subject, age, gender, offset (first row) and channels of every record"""
+
+        columns = self.meta['records']
+        return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+    def record(self, record: Dict) -> np.ndarray:
+        """One record from index(), a (1, channels, n_freq) view of the shared block"""
+
+        return self.data[record['offset']:record['offset'] + record['channels']][np.newaxis]
+
+    def dataset(self, subjects: Optional[Dict] = None) -> Dict:
+        """The records of subjects (from load_subjects, default all), in the same
+        format as load_dataset from a store. Ages and genders come from subjects if given."""
+
+        result: Dict = {'id': [], 'age': [], 'gender': [], 'data': [], 'offsets': [], 'store': self.data,
+                        'shared': self}
+        for record in self.index():
+            info = record
+            if subjects is not None:
+                if record['subject'] not in subjects:
+                    continue
+                info = subjects[record['subject']]
+            result['id'].append(record['id'])
+            if info.get('age') is not None:
+                result['age'].append(info['age'])
+                result['gender'].append(info.get('gender'))
+            result['data'].append(self.record(record))
+            result['offsets'].append(record['offset'])
+        return result
+
+    def close(self) -> None:
+        """Release the lease. The memory stays mapped while views of it are in use."""
+
+        if os.path.exists(self.lease):
+            os.unlink(self.lease)
+        try:
+            self.memory.close()
+        except BufferError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_shared(data_folder: str) -> SharedDataset:
+    """Attach to the shared dataset shm:<name>"""
+
+    return SharedDataset(data_folder[len(PREFIX):])
+
+
+def source_folder(data_folder: str) -> str:
+    """The folder a shared dataset was loaded from, or data_folder if it isn't shm:<name>"""
+
+    if not is_shared(data_folder):
+        return data_folder
+    meta = _read_meta(data_folder[len(PREFIX):])
+    if meta is None:
+        raise ValueError("No shared dataset named {}".format(data_folder[len(PREFIX):]))
+    return meta['source']
+
+
+def load_shared(data_folder: str, subjects: Dict) -> Dict:
+    """Load the records of subjects from the shared dataset shm:<name>, see load_dataset"""
+
+    return open_shared(data_folder).dataset(subjects)
+
+
+class DataFolder(click.Path):
+    """A click parameter for a data folder that must exist, or shm:<name>"""
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, str) and is_shared(value):
+            return value
+        return super().convert(value, param, ctx)
+
+
+def active_leases(name: str) -> List[str]:
+    """The leases on a shared dataset, dropping those of processes that have exited"""
+
+    folder = _lease_folder(name)
+    leases = []
+    for lease in os.listdir(folder) if os.path.isdir(folder) else []:
+        if _alive(int(lease.split('-', 1)[0])):
+            leases.append(lease)
+        else:
+            try:
+                os.unlink(os.path.join(folder, lease))
+            except FileNotFoundError:
+                pass
+    return leases
+
+
+def share_dataset(data_folder: str, csvfile: str, name: str, dtype: str = 'float64') -> shared_memory.SharedMemory:
+    """Load the records of the subjects in csvfile into shared memory and
+    register them as name, returns the shared memory block"""
+    from src.data.make_dataset import load_dataset, load_subjects
+
+    if _read_meta(name) is not None:
+        raise ValueError("A shared dataset named {} is already being served".format(name))
+    subjects = load_subjects(csvfile)
+    dataset = load_dataset(data_folder, csvfile)
+    channels = [len(record[0]) for record in dataset['data']]
+    offsets = np.concatenate([[0], np.cumsum(channels)]).astype(int)
+    n_freq = dataset['data'][0].shape[-1] if dataset['data'] else 0
+    shape = (int(offsets[-1]), n_freq)
+    dtype = np.dtype(dtype)
+
+    memory = shared_memory.SharedMemory(name="age-{}-{}".format(name, os.getpid()), create=True,
+                                        size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+    data = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+    for record, start, stop in zip(dataset['data'], offsets[:-1], offsets[1:]):
+        data[start:stop] = record[0]
+    del data
+
+    ids = dataset['id']
+    record_subjects = [record_subject(record_id) for record_id in ids]
+    meta = {
+        'pid': os.getpid(), 'segment': memory.name, 'source': os.path.abspath(data_folder),
+        'shape': list(shape), 'dtype': dtype.str,
+        'records': {
+            'id': ids,
+            'subject': record_subjects,
+            'age': [subjects[subject].get('age') for subject in record_subjects],
+            'gender': [subjects[subject].get('gender') for subject in record_subjects],
+            'offset': offsets[:-1].tolist(),
+            'channels': channels,
+        },
+    }
+    os.makedirs(_lease_folder(name), exist_ok=True)
+    staging = _meta_path(name) + '.tmp'
+    with open(staging, 'w') as fd:
+        json.dump(meta, fd)
+    os.replace(staging, _meta_path(name))
+    return memory
+
+
+def unshare_dataset(name: str, memory: shared_memory.SharedMemory) -> None:
+    """Remove a shared dataset from the registry and free its memory"""
+
+    for path in (_meta_path(name), _meta_path(name) + '.tmp'):
+        if os.path.exists(path):
+            os.unlink(path)
+    folder = _lease_folder(name)
+    if os.path.isdir(folder):
+        for lease in os.listdir(folder):
+            os.unlink(os.path.join(folder, lease))
+        os.rmdir(folder)
+    memory.close()
+    memory.unlink()
+
+
+def serve(data_folder: str, csvfile: str, name: str, dtype: str = 'float64', linger: Optional[float] = None,
+          poll: float = 1.) -> None:
+    """Share a dataset until SIGTERM or SIGINT or, once a process has attached,
+    until no process has held a lease on it for `linger` seconds"""
+
+    memory = share_dataset(data_folder, csvfile, name, dtype)
+    stopped = threading.Event()
+    previous = signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    try:
+        print("Serving {} ({:.1f} MB) as {}{}".format(data_folder, memory.size / 2 ** 20, PREFIX, name), flush=True)
+        # the linger time only counts once a process has attached, which may
+        # have come and gone between polls but will have changed the lease folder
+        started = time.time()
+        idle_since = None
+        while not stopped.wait(poll):
+            if active_leases(name):
+                idle_since = time.time()
+            elif idle_since is None and os.stat(_lease_folder(name)).st_mtime > started:
+                idle_since = time.time()
+            elif linger is not None and idle_since is not None and time.time() - idle_since > linger:
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+        unshare_dataset(name, memory)
+
+
+def shared_datasets() -> Dict[str, Dict]:
+    """The description of every shared dataset being served, by name"""
+
+    result = {}
+    for entry in sorted(os.listdir(registry_folder())):
+        if entry.endswith('.json'):
+            meta = _read_meta(entry[:-len('.json')])
+            if meta is not None:
+                result[entry[:-len('.json')]] = meta
+    return result
+
+
+@click.group()
+def main():
+    """Share loaded datasets between processes through shared memory"""
+
+
+@main.command('serve')
+@click.argument('data_folder', type=click.Path(exists=True))
+@click.argument('csvfile', type=click.Path(exists=True))
+@click.option('--name', required=True, help='Name processes attach to, as shm:NAME')
+@click.option('--dtype', type=click.Choice(['float64', 'float32']), default='float64',
+              help='Type of the shared features')
+@click.option('--linger', type=click.FloatRange(min=0), help='Stop this many seconds after the last lease is released')
+def serve_command(data_folder, csvfile, name, dtype, linger):
+    """Load the records in DATA_FOLDER of the subjects in CSVFILE into shared memory and serve them"""
+
+    try:
+        serve(data_folder, csvfile, name, dtype, linger)
+    except ValueError as exc:
+        raise click.ClickException(str(exc))
+
+
+@main.command()
+def status():
+    """List the shared datasets being served"""
+
+    for name, meta in shared_datasets().items():
+        size = np.prod(meta['shape']) * np.dtype(meta['dtype']).itemsize
+        print("{}{}: {} records, {:.1f} MB from {}, server pid {}, {} leases".format(
+            PREFIX, name, len(meta['records']['id']), size / 2 ** 20, meta['source'], meta['pid'],
+            len(active_leases(name))))
+
+
+@main.command()
+@click.argument('name')
+def stop(name):
+    """Stop the server of the shared dataset NAME"""
+
+    meta = _read_meta(name)
+    if meta is None:
+        raise click.ClickException("No shared dataset named {}".format(name))
+    os.kill(meta['pid'], signal.SIGTERM)
+
+
+if __name__ == '__main__':
+
+    main()
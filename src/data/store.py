@@ -0,0 +1,461 @@
+"""
+    Consolidated feature store.
+
+    Instead of one small .npy file per epoch, all features for a dataset are kept
+    in a single binary file that is opened with np.memmap, plus an index:
+
+    <store>/meta.json     dtype and number of frequency bins
+    <store>/features.dat  float rows of shape (n_freq,), one row per channel
+    <store>/index.csv     id,subject,run,epoch,offset,channels
+
+    Each epoch occupies `channels` consecutive rows starting at row `offset`, so
+    recordings with different channel counts can share a store. The file is only
+    ever appended to; if an id is written twice the last entry wins.
+
+    Features can be stored as float64, float32, float16 or int16. For int16 each
+    epoch is quantized linearly between its own minimum and maximum and the
+    index holds its `scale` and `zero` point. A store can also be compressed
+    (zlib or lzma, or zstd, lz4 and blosc if numcodecs is installed), in which
+    case each epoch is one compressed block of `nbytes` bytes starting at byte
+    `offset`. Readers (`record_data`, `load_store`) decode all of these back
+    to floating point.
+"""
+import click
+import csv
+import glob
+import json
+import logging
+import lzma
+import os
+import shutil
+import zlib
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+
+STORE_META = 'meta.json'
+STORE_DATA = 'features.dat'
+STORE_INDEX = 'index.csv'
+INDEX_FIELDS = ['id', 'subject', 'run', 'epoch', 'offset', 'channels', 'nbytes', 'scale', 'zero']
+STORAGE_DTYPES = ['float64', 'float32', 'float16', 'int16']
+CODECS = ['zlib', 'lzma', 'zstd', 'lz4', 'blosc']
+
+logger = logging.getLogger(__name__)
+
+
+def is_store(path: str) -> bool:
+    """Return True if path is a consolidated feature store"""
+
+    return os.path.exists(os.path.join(path, STORE_INDEX))
+
+
+def make_id(subject: str, epoch: int, run: Optional[int] = None) -> str:
+    """Record id in the same format as the .npy filenames: <subject>-<N>[-<run>]"""
+
+    if run is None:
+        return "{}-{}".format(subject, epoch)
+    return "{}-{}-{}".format(subject, epoch, run)
+
+
+def parse_id(record_id: str, subject: Optional[str] = None) -> Optional[Tuple[str, int, Optional[int]]]:
+    """Split a record id (or .npy basename) into subject, epoch and run, the
+    inverse of make_id. If subject is given the id must belong to exactly that
+    subject (so '1000' does not match '10001-0'), otherwise the subject is the
+    part before the first '-'. Returns None if the id is not in this format."""
+
+    if subject is None:
+        subject = record_id.split('-', 1)[0]
+    if not record_id.startswith(subject + '-'):
+        return None
+    parts = record_id[len(subject) + 1:].split('-')
+    if len(parts) > 2 or not all(part.isdigit() for part in parts):
+        return None
+    return subject, int(parts[0]), int(parts[1]) if len(parts) == 2 else None
+
+
+def quantize(rows: np.ndarray) -> Tuple[np.ndarray, float, float]:
+    """Quantize rows to int16 between their minimum and maximum, returns the
+    values, scale and zero point. Non-finite values (log of a zero PSD) are
+    stored as -32768 and read back as -inf."""
+
+    finite = np.isfinite(rows)
+    low, high = (rows[finite].min(), rows[finite].max()) if finite.any() else (0., 0.)
+    zero = (high + low) / 2
+    scale = (high - low) / 65534 or 1.
+    values = np.full(rows.shape, -32768, dtype=np.int16)
+    values[finite] = np.round((rows[finite] - zero) / scale)
+    return values, float(scale), float(zero)
+
+
+def dequantize(values: np.ndarray, scale: float, zero: float) -> np.ndarray:
+    rows = values * scale + zero
+    rows[values == -32768] = -np.inf
+    return rows
+
+
+def _numcodec(codec: str):
+    try:
+        import numcodecs
+    except ImportError:
+        raise ImportError("{} compression needs numcodecs, install it or use zlib or lzma".format(codec))
+    if codec == 'blosc':
+        return numcodecs.Blosc(cname='zstd', clevel=5, shuffle=numcodecs.Blosc.SHUFFLE)
+    return numcodecs.get_codec({'id': codec})
+
+
+def check_codec(codec: Optional[str]) -> None:
+    """Raise an error if a compression codec is unknown or not installed"""
+
+    if codec is not None and codec not in CODECS:
+        raise ValueError("Unknown compression {}, expected one of {}".format(codec, ", ".join(CODECS)))
+    if codec in ('zstd', 'lz4', 'blosc'):
+        _numcodec(codec)
+
+
+def compress(rows: np.ndarray, codec: str) -> bytes:
+    """Compress an array of rows as one block"""
+
+    if codec in ('zlib', 'lzma'):
+        # group the bytes of each value by significance (like blosc's shuffle),
+        # the high order bytes of neighbouring features are similar
+        shuffled = np.ascontiguousarray(rows).view(np.uint8).reshape(-1, rows.itemsize).T.tobytes()
+        return zlib.compress(shuffled, 6) if codec == 'zlib' else lzma.compress(shuffled)
+    return bytes(_numcodec(codec).encode(np.ascontiguousarray(rows)))
+
+
+def decompress(block: bytes, codec: str, dtype: np.dtype, shape: Tuple[int, int]) -> np.ndarray:
+    """Decompress a block written by `compress`"""
+
+    if codec in ('zlib', 'lzma'):
+        shuffled = zlib.decompress(block) if codec == 'zlib' else lzma.decompress(block)
+        values = np.frombuffer(shuffled, dtype=np.uint8).reshape(dtype.itemsize, -1).T.copy()
+        return values.view(dtype).reshape(shape)
+    return np.frombuffer(_numcodec(codec).decode(block), dtype=dtype).reshape(shape)
+
+
+class NpyWriter:
+    """Write features as one .npy file per epoch (the original layout),
+    optionally as float32 or float16 rather than float64"""
+
+    def __init__(self, path: str, dtype: str = 'float64'):
+        if dtype not in ('float64', 'float32', 'float16'):
+            raise ValueError(".npy files can be stored as float64, float32 or float16, not {}".format(dtype))
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.bytes_written = 0
+
+    def write(self, subject: str, run: Optional[int], features: List[np.ndarray],
+              epochs: Optional[List[int]] = None) -> List[str]:
+        written = []
+        for epoch, feature in zip(epochs or range(len(features)), features):
+            fname = os.path.join(self.path, make_id(subject, epoch, run) + ".npy")
+            np.save(fname, np.asarray(feature, dtype=self.dtype))
+            self.bytes_written += os.path.getsize(fname)
+            written.append(fname)
+        return written
+
+    def exists(self, names: List[str]) -> bool:
+        """True if all of the named outputs have been written"""
+
+        return all(os.path.exists(name) for name in names)
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class StoreWriter:
+    """Append features to a consolidated store, creating it if needed.
+    The dtype and compression of an existing store are kept."""
+
+    def __init__(self, path: str, dtype: str = 'float64', compression: Optional[str] = None):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, STORE_META)
+        if os.path.exists(meta_path):
+            with open(meta_path) as fd:
+                self.meta = json.load(fd)
+        else:
+            if dtype not in STORAGE_DTYPES:
+                raise ValueError("Unknown storage dtype {}, expected one of {}".format(
+                    dtype, ", ".join(STORAGE_DTYPES)))
+            self.meta = {'dtype': dtype, 'n_freq': None, 'compression': compression}
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.compression = self.meta.get('compression')
+        check_codec(self.compression)
+        self.bytes_written = 0
+        index_path = os.path.join(path, STORE_INDEX)
+        new_index = not os.path.exists(index_path)
+        records = [] if new_index else read_index(path)
+        if not self.compression:
+            self._truncate(records)
+        self.data = open(os.path.join(path, STORE_DATA), 'ab')
+        # first row (or byte, if compressed) of every record in the store, by id
+        self.offsets: Dict[str, int] = {r['id']: r['offset'] for r in records}
+        fields = INDEX_FIELDS
+        if not new_index:
+            # stores written before nbytes, scale and zero were added keep their columns
+            with open(index_path, newline='') as fd:
+                fields = next(csv.reader(fd), INDEX_FIELDS)
+        self.index = open(index_path, 'a', newline='')
+        self.writer = csv.DictWriter(self.index, fields, extrasaction='ignore')
+        if new_index:
+            self.writer.writeheader()
+
+    def _truncate(self, records: List[Dict]) -> None:
+        """Cut data left after the last indexed record by a crash, which may end in a
+        partial row and would misalign the row offsets of the records appended next.
+        Raises ValueError if the index refers to rows the data file doesn't hold."""
+
+        data_path = os.path.join(self.path, STORE_DATA)
+        if not os.path.exists(data_path):
+            return
+        size = os.path.getsize(data_path)
+        end = 0
+        if records:
+            end = max(r['offset'] + r['channels'] for r in records) * self.dtype.itemsize * self.meta['n_freq']
+        if size < end:
+            raise ValueError("{} holds {} bytes, its index refers to {}".format(data_path, size, end))
+        if size > end:
+            logger.warning("Truncating {} from {} to {} bytes, the end of its last indexed record".format(
+                data_path, size, end))
+            os.truncate(data_path, end)
+
+    def _write_meta(self) -> None:
+        with open(os.path.join(self.path, STORE_META), 'w') as fd:
+            json.dump(self.meta, fd)
+
+    def write(self, subject: str, run: Optional[int], features: List[np.ndarray],
+              epochs: Optional[List[int]] = None) -> List[str]:
+        """Append the features of one recording, return the ids written"""
+
+        written = []
+        for epoch, feature in zip(epochs or range(len(features)), features):
+            rows = np.asarray(feature).reshape(-1, feature.shape[-1])
+            if self.meta['n_freq'] is None:
+                self.meta['n_freq'] = rows.shape[1]
+                self._write_meta()
+            elif rows.shape[1] != self.meta['n_freq']:
+                raise ValueError("Expected {} frequency bins, got {}".format(self.meta['n_freq'], rows.shape[1]))
+            scale, zero = '', ''
+            if self.dtype == np.int16:
+                rows, scale, zero = quantize(rows)
+            else:
+                rows = np.ascontiguousarray(rows, dtype=self.dtype)
+            block = compress(rows, self.compression) if self.compression else rows.tobytes()
+            # offsets come from the file size so that data orphaned by a crash is never referenced
+            offset = self.data.tell()
+            if not self.compression:
+                offset //= self.dtype.itemsize * rows.shape[1]
+            self.data.write(block)
+            self.bytes_written += len(block)
+            record_id = make_id(subject, epoch, run)
+            self.writer.writerow({'id': record_id, 'subject': subject, 'run': '' if run is None else run,
+                                  'epoch': epoch, 'offset': offset, 'channels': rows.shape[0],
+                                  'nbytes': len(block), 'scale': scale, 'zero': zero})
+            written.append(record_id)
+            self.offsets[record_id] = offset
+        # data before index, so every index row points at complete data
+        self.data.flush()
+        self.index.flush()
+        return written
+
+    def exists(self, names: List[str]) -> bool:
+        """True if all of the named records are in the store"""
+
+        return all(name in self.offsets for name in names)
+
+    def append_store(self, path: str) -> Dict[str, int]:
+        """Append all the records of another store with the same dtype, compression
+        and number of frequency bins, copying the data without decoding it.
+        Records whose id is already in this store are skipped, and nothing is
+        copied if all of them are. Returns the new offset of each record copied."""
+
+        with open(os.path.join(path, STORE_META)) as fd:
+            meta = json.load(fd)
+        if (meta['dtype'], meta.get('compression')) != (self.meta['dtype'], self.compression):
+            raise ValueError("Can't append a {} store to a {} store".format(
+                meta['dtype'] + (':' + meta['compression'] if meta.get('compression') else ''),
+                self.meta['dtype'] + (':' + self.compression if self.compression else '')))
+        if meta['n_freq'] is None:
+            return {}
+        if self.meta['n_freq'] is None:
+            self.meta['n_freq'] = meta['n_freq']
+            self._write_meta()
+        elif meta['n_freq'] != self.meta['n_freq']:
+            raise ValueError("Expected {} frequency bins, got {}".format(self.meta['n_freq'], meta['n_freq']))
+
+        records = [record for record in read_index(path) if record['id'] not in self.offsets]
+        if not records:
+            return {}
+        base = self.data.tell()
+        with open(os.path.join(path, STORE_DATA), 'rb') as fd:
+            shutil.copyfileobj(fd, self.data, 1024 * 1024)
+        self.bytes_written += self.data.tell() - base
+        if not self.compression:
+            base //= self.dtype.itemsize * self.meta['n_freq']
+        offsets = {}
+        for record in records:
+            record = dict(record, offset=record['offset'] + base)
+            record['run'] = '' if record['run'] is None else record['run']
+            self.writer.writerow({k: '' if v is None else v for k, v in record.items()})
+            self.offsets[record['id']] = offsets[record['id']] = record['offset']
+        self.data.flush()
+        self.index.flush()
+        return offsets
+
+    def close(self) -> None:
+        self.data.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_index(path: str) -> List[Dict]:
+    """Read the index of a store, later entries for an id replace earlier ones"""
+
+    records: Dict = {}
+    with open(os.path.join(path, STORE_INDEX), newline='') as fd:
+        for row in csv.DictReader(fd):
+            row['run'] = int(row['run']) if row['run'] else None
+            row['epoch'] = int(row['epoch'])
+            row['offset'] = int(row['offset'])
+            row['channels'] = int(row['channels'])
+            row['nbytes'] = int(row['nbytes']) if row.get('nbytes') else None
+            row['scale'] = float(row['scale']) if row.get('scale') else None
+            row['zero'] = float(row['zero']) if row.get('zero') else None
+            records[row['id']] = row
+    return list(records.values())
+
+
+class CompressedBlocks:
+    """The data of a compressed store, one compressed block per record"""
+
+    def __init__(self, path: str, meta: Dict):
+        self.dtype = np.dtype(meta['dtype'])
+        self.n_freq = meta['n_freq']
+        self.compression = meta['compression']
+        check_codec(self.compression)
+        size = os.path.getsize(path)
+        self.buffer = np.memmap(path, dtype=np.uint8, mode='r') if size else np.empty(0, dtype=np.uint8)
+
+    def block(self, record: Dict) -> np.ndarray:
+        """Decompress the (channels, n_freq) rows of one record"""
+
+        block = self.buffer[record['offset']:record['offset'] + record['nbytes']].tobytes()
+        return decompress(block, self.compression, self.dtype, (record['channels'], self.n_freq))
+
+
+def open_store(path: str) -> Tuple[np.ndarray, List[Dict]]:
+    """Open a store read-only, return the (rows, n_freq) memmap, or the
+    CompressedBlocks of a compressed store, and the index"""
+
+    with open(os.path.join(path, STORE_META)) as fd:
+        meta = json.load(fd)
+    index = read_index(path)
+    dtype = np.dtype(meta['dtype'])
+    data_path = os.path.join(path, STORE_DATA)
+    if meta.get('compression'):
+        return CompressedBlocks(data_path, meta), index
+    n_rows = os.path.getsize(data_path) // (dtype.itemsize * meta['n_freq']) if meta['n_freq'] else 0
+    if n_rows == 0:
+        return np.empty((0, meta['n_freq'] or 0), dtype=dtype), index
+    data = np.memmap(data_path, dtype=dtype, mode='r', shape=(n_rows, meta['n_freq']))
+    return data, index
+
+
+def record_data(data: np.ndarray, record: Dict) -> np.ndarray:
+    """One record, shaped (1, channels, n_freq) like the .npy files. For
+    floating point stores this is a zero-copy view of the memmap, compressed
+    and int16 stores are decoded."""
+
+    if isinstance(data, CompressedBlocks):
+        rows = data.block(record)
+    else:
+        rows = data[record['offset']:record['offset'] + record['channels']]
+    if rows.dtype == np.int16:
+        rows = dequantize(rows, record['scale'], record['zero'])
+    return rows[np.newaxis]
+
+
+def load_store(path: str, subjects: Dict) -> Dict:
+    """Load the records of the given subjects from a store, in the same format
+    as make_dataset.load_dataset. The 'data' arrays are views of the memmap so
+    nothing is read until the values are used, except in int16 or compressed
+    stores where each record is decoded. 'store' and 'offsets' hold the
+    memmap (None if records are decoded) and the first row of each record."""
+
+    result: Dict = {
+        'id': [],
+        'age': [],
+        'gender': [],
+        'data': [],
+        'offsets': [],
+    }
+    data, index = open_store(path)
+    # lets src.features.assemble gather a design matrix straight from the memmap
+    result['store'] = data if isinstance(data, np.ndarray) and data.dtype.kind == 'f' else None
+    by_subject: Dict = {}
+    for record in index:
+        by_subject.setdefault(record['subject'], []).append(record)
+
+    for subject in subjects:
+        for record in by_subject.get(subject, []):
+            result['id'].append(record['id'])
+            if 'age' in subjects[subject]:
+                result['age'].append(subjects[subject]['age'])
+                result['gender'].append(subjects[subject]['gender'])
+            result['data'].append(record_data(data, record))
+            result['offsets'].append(record['offset'])
+
+    return result
+
+
+def consolidate(data_folder: str, subjects: Dict, path: str, dtype: str = 'float64',
+                compression: Optional[str] = None) -> int:
+    """Copy a folder of per-epoch .npy files for the given subjects into a store,
+    return the number of records written"""
+
+    count = 0
+    with StoreWriter(path, dtype, compression) as writer:
+        for subject in subjects:
+            runs: Dict = {}
+            for filename in glob.glob(os.path.join(data_folder, glob.escape(subject) + "-*.npy")):
+                parsed = parse_id(os.path.splitext(os.path.basename(filename))[0], subject)
+                if parsed is None:
+                    continue
+                _, epoch, run = parsed
+                runs.setdefault(run, {})[epoch] = filename
+            for run in sorted(runs, key=lambda r: -1 if r is None else r):
+                epochs = sorted(runs[run])
+                features = [np.load(runs[run][epoch]) for epoch in epochs]
+                count += len(writer.write(subject, run, features, epochs))
+    return count
+
+
+@click.command()
+@click.argument('data_folder', type=click.Path(exists=True))
+@click.argument('csvfile', type=click.Path(exists=True))
+@click.argument('store_path', type=click.Path())
+@click.option('--dtype', type=click.Choice(STORAGE_DTYPES), default='float64', help='Storage type of the features')
+@click.option('--compress', 'compression', type=click.Choice(CODECS), help='Compress each record')
+def main(data_folder, csvfile, store_path, dtype, compression):
+    """Copy the .npy files of the subjects in CSVFILE from DATA_FOLDER into a store"""
+
+    from src.data.make_dataset import load_subjects
+
+    count = consolidate(data_folder, load_subjects(csvfile), store_path, dtype, compression)
+    print("Wrote {} records to {}".format(count, store_path))
+
+
+if __name__ == '__main__':
+
+    main()
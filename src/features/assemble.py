@@ -0,0 +1,105 @@
+"""
+    Assemble feature records into a design matrix for a model.
+
+    Each record is a (1, channels, freqs) array of log PSDs. A model takes a
+    subset of channels (and optionally of frequency bins) from each record,
+    flattened into one row of an (n_records, n_channels * n_freqs) matrix.
+    The matrix is allocated once, contiguous and of the requested dtype, and
+    filled by slicing, rather than by building a list of raveled copies that
+    sklearn then copies again.
+
+    channels is either a count (the first N channels) or a list of channel
+    indices; freqs is None (all bins), a slice or a list of bin indices.
+"""
+import numpy as np
+from typing import Dict, Optional, Sequence, Union
+
+Selection = Union[int, slice, Sequence[int], None]
+
+
+def selection(select: Selection):
+    """Turn a channel or frequency selection into an index usable on an array axis"""
+
+    if select is None:
+        return slice(None)
+    if isinstance(select, (int, np.integer)):
+        return slice(0, int(select))
+    if isinstance(select, slice):
+        return select
+    return np.asarray(select, dtype=np.intp)
+
+
+def _selected(size: int, select) -> int:
+    return len(range(size)[select]) if isinstance(select, slice) else len(select)
+
+
+def design_matrix(records: Union[np.ndarray, Sequence[np.ndarray]], channels: Selection, freqs: Selection = None,
+                  dtype=np.float32, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Build the design matrix for a set of records.
+
+    records is a list of (1, channels, freqs) arrays (eg. from load_dataset) or
+    a single stacked or memory-mapped (n, 1, channels, freqs) array, which is
+    sliced in one operation. Records in a list must all have enough channels
+    and the same number of frequency bins. If out is given it is filled and
+    returned, otherwise a new C-contiguous array of dtype is returned.
+    """
+
+    chans = selection(channels)
+    bins = selection(freqs)
+    if isinstance(records, np.ndarray):
+        tensor = records.reshape((records.shape[0],) + records.shape[-2:])
+        n, n_channels, n_freqs = tensor.shape
+    else:
+        n = len(records)
+        n_channels, n_freqs = records[0].shape[-2:] if n else (0, 0)
+    shape = (n, _selected(n_channels, chans), _selected(n_freqs, bins))
+    if out is None:
+        out = np.empty((n, shape[1] * shape[2]), dtype=dtype)
+    block = out.reshape(shape)
+
+    if isinstance(records, np.ndarray):
+        # slices give views, so the only copy is the assignment into out
+        block[...] = tensor[:, chans][:, :, bins]
+    else:
+        for i, record in enumerate(records):
+            block[i] = record[0, chans][:, bins]
+    return out
+
+
+def gather_store(data: np.ndarray, offsets: Sequence[int], channels: Selection, freqs: Selection = None,
+                 dtype=np.float32, counts: Optional[Sequence[int]] = None) -> np.ndarray:
+    """Build the design matrix for records in a feature store in a single gather.
+
+    data is the (rows, freqs) array from open_store, offsets the first row of
+    each record and counts its number of channels (see src.data.store). Every
+    record must have at least the selected channels, a ValueError is raised if
+    one doesn't (or, without counts, if the rows run past the end of the store).
+    """
+
+    chans = selection(channels)
+    if isinstance(chans, slice):
+        if chans.stop is None:
+            raise ValueError("Records in a store can have different channel counts, select channels explicitly")
+        chans = np.arange(chans.stop)[chans]
+    bins = selection(freqs)
+    rows = np.asarray(offsets, dtype=np.intp)[:, np.newaxis] + chans[np.newaxis, :]
+    if len(chans) and len(rows):
+        if counts is not None:
+            short = np.flatnonzero(np.asarray(counts) <= chans.max())
+            if len(short):
+                raise ValueError("Record {} has {} channels, channel {} was selected".format(
+                    short[0], counts[short[0]], chans.max()))
+        elif rows.max() >= len(data):
+            raise ValueError("The selected channels run past the end of the store")
+    selected = data[rows.ravel()][:, bins]
+    return np.ascontiguousarray(selected, dtype=dtype).reshape(len(rows), rows.shape[1] * selected.shape[1])
+
+
+def dataset_matrix(dataset: Dict, channels: Selection, freqs: Selection = None, dtype=np.float32) -> np.ndarray:
+    """Design matrix for a dataset from load_dataset, reading directly from the
+    store in one gather when the dataset was loaded from one"""
+
+    if dataset.get('store') is not None:
+        counts = [record.shape[-2] for record in dataset['data']]
+        return gather_store(dataset['store'], dataset['offsets'], channels, freqs, dtype, counts)
+    return design_matrix(dataset['data'], channels, freqs, dtype)
@@ -1,30 +1,235 @@
 import os
 import numpy as np
 import mne
-import hcp
+from numpy.lib.stride_tricks import sliding_window_view
+from typing import Dict, Iterator, List, Optional, Tuple
 
-def spectral_features(raw: mne.io.Raw, max_freq: int = 100, n_fft: int = 48, filter=True) -> np.array: 
+from src.data.instrument import stage
+from src.features import kernels
+from src.features.filters import lowpass, resample
+from src.features.spectral import log_spectrum
+
+
+def spectral_features(raw: mne.io.Raw, max_freq: int = 100, n_fft: int = 48, filter=True,
+                      estimator: str = 'welch', estimator_options: Optional[Dict] = None) -> np.array:
     """Compute flattened spectral features given a cropped raw recording.
 
     If the `filter` argument is True data is low-pass filtered to max_freq (default 100Hz)
     and downsampled to 2*max_freq before features are
-    computed. 
+    computed.
 
     Computes a n_fft (default 48) point FFT. Takes the log to compute the final features which
     are then concatenated into a one dimensional feature vector.
 
-    Returns a N x 24 np.array where N is the number of channels"""
+    `estimator` is one of the estimators in `src.features.spectral` (default 'welch'),
+    `estimator_options` are passed to it.
+
+    Returns a N x F np.array where N is the number of channels, F is 24 for the default
+    48 point Welch PSD"""
 
     if filter:
-        raw.filter(None, max_freq, h_trans_bandwidth=0.5, filter_length='10s', phase='zero-double', fir_design='firwin2')
-        raw.resample(2*max_freq, npad="auto")
+        with stage('filter'):
+            raw.filter(None, max_freq, h_trans_bandwidth=0.5, filter_length='10s', phase='zero-double',
+                       fir_design='firwin2')
+        with stage('resample'):
+            raw.resample(2*max_freq, npad="auto")
 
-    psds, _freqs = mne.time_frequency.psd_welch(raw, fmin=1, n_fft=n_fft)
+    if estimator != 'welch' or estimator_options:
+        picks = mne.pick_types(raw.info, meg=True, eeg=True, seeg=True, ecog=True, ref_meg=False, exclude='bads')
+        with stage('psd'):
+            return log_spectrum(raw.get_data(picks), raw.info['sfreq'], estimator, n_fft, options=estimator_options)
 
-    #return np.ravel(np.log(psds))
+    with stage('psd'):
+        psds, _freqs = mne.time_frequency.psd_welch(raw, fmin=1, n_fft=n_fft)
+
+    # return np.ravel(np.log(psds))
     return np.log(psds)
 
-def spectral_epochs(label: str, raw: mne.io.Raw, epoch_size: int, max_freq: int = 100, n_fft: int = 48, filter=True) -> np.array: 
+
+def epoch_windows(raw: mne.io.Raw, epoch_size: int, decim: int = 1) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Find the fixed length epochs that mne.Epochs would extract from a recording.
+
+    mne.Epochs reads a window that runs past the end of the recording truncated,
+    and keeps it if every sample that survives decimation by `decim` is there.
+    So the last epoch can be a few samples short of n_samples.
+
+    Returns: picks, starts, n_samples
+    picks: the data channels used by psd_welch (MEG/EEG, no reference or bad channels)
+    starts: the first sample of each epoch
+    n_samples: the number of samples in each epoch
+    """
+
+    picks = mne.pick_types(raw.info, meg=True, eeg=True, seeg=True, ecog=True, ref_meg=False, exclude='bads')
+    events = mne.make_fixed_length_events(raw, id=1, duration=epoch_size)
+    starts = events[:, 0] - raw.first_samp
+    n_samples = int(round(epoch_size * raw.info['sfreq'])) + 1   # tmax is inclusive
+    # samples up to the last one kept after decimation
+    n_needed = (n_samples - 1) // decim * decim + 1
+    starts = starts[starts + n_needed <= raw.n_times]
+    return picks, starts, n_samples
+
+
+def has_bad_annotations(raw: mne.io.Raw) -> bool:
+    return any(desc.lower().startswith('bad') for desc in raw.annotations.description)
+
+
+def good_windows(raw: mne.io.Raw, picks: np.ndarray, starts: np.ndarray, n_samples: int) -> np.ndarray:
+    """The starts of the epochs that don't overlap a BAD annotation, the epochs
+    that mne.Epochs keeps with reject_by_annotation=True"""
+
+    if not has_bad_annotations(raw):
+        return starts
+    # one channel is enough, annotated samples are NaN on every channel
+    bad = np.isnan(raw.get_data(picks[:1], reject_by_annotation='NaN')[0])
+    bad_before = np.concatenate([[0], np.cumsum(bad)])
+    return starts[bad_before[np.minimum(starts + n_samples, len(bad))] == bad_before[starts]]
+
+
+def epoch_views(data: np.ndarray, starts: np.ndarray, n_samples: int) -> np.ndarray:
+    """Fixed length windows of a (channels, times) array as an (epochs, channels,
+    samples) array.
+
+    When the starts are evenly spaced, as they are for fixed length events with
+    a whole number of samples per epoch, this is a strided view of data and no
+    samples are copied. Otherwise the windows are gathered into a new array.
+    """
+
+    windows = sliding_window_view(data, n_samples, axis=-1)
+    step = starts[1] - starts[0] if len(starts) > 1 else 1
+    if len(starts) and step > 0 and np.all(np.diff(starts) == step):
+        windows = windows[:, starts[0]::step][:, :len(starts)]
+    else:
+        windows = windows[:, starts]
+    return windows.transpose(1, 0, 2)
+
+
+def detrend_decimate(epoch: np.ndarray, decim: int, out: np.ndarray = None) -> np.ndarray:
+    """Remove the linear trend from (..., samples) epochs and decimate them.
+
+    The least squares fit is computed in closed form and only evaluated at the
+    samples that are kept, rather than detrending every sample. The mean and
+    slope are reductions over the last axis, so a strided view of the raw data
+    (see epoch_views) is read in place and only the decimated samples are written.
+    """
+
+    n_samples = epoch.shape[-1]
+    t = np.arange(n_samples) - (n_samples - 1) / 2
+    offset = epoch.mean(axis=-1, keepdims=True)
+    slope = np.dot(epoch, t / np.dot(t, t))[..., np.newaxis]
+    return np.subtract(epoch[..., ::decim], offset + slope * t[::decim], out=out)
+
+
+def antialias_filter(data: np.ndarray, sfreq: float, decim: int) -> np.ndarray:
+    """Low-pass filter data along the last axis before decimating by decim.
+
+    The filter (a cached zero-double FIR, see src.features.filters) passes up to
+    sfreq / (2.5 * decim) and stops at the Nyquist frequency after decimation.
+    """
+
+    h_freq = sfreq / (2.5 * decim)
+    return lowpass(data, sfreq, h_freq, h_trans_bandwidth=h_freq / 4, filter_length='auto', fir_design='firwin')
+
+
+def epoch_array(raw: mne.io.Raw, epoch_size: int, decim: int = 8, antialias: bool = False) -> Tuple[np.ndarray, float]:
+    """Cut a raw recording into fixed length epochs as a single array.
+
+    Gives the same data as
+    mne.Epochs(raw, events, tmin=0., tmax=epoch_size, baseline=None, detrend=1, decim=decim)
+    for the data channels used by psd_welch (MEG/EEG, no reference or bad channels):
+    each epoch is linearly detrended and then decimated, incomplete epochs
+    at the end of the recording and epochs overlapping BAD annotations are dropped.
+
+    The epochs are strided views of the continuous data (see epoch_views) and
+    are detrended and decimated for all epochs and channels at once, so the only
+    copy made is the decimated output. A last epoch that is truncated by the end
+    of the recording (see epoch_windows) is detrended over the samples it has,
+    as mne.Epochs does. With `antialias` each epoch is low-pass
+    filtered (with edge padding) before it is decimated, which mne.Epochs does
+    not do. This changes the features and needs a copy of the epochs at the
+    full sampling rate.
+
+    Returns: data, sfreq
+    data: an (epochs, channels, samples) np.array
+    sfreq: the sampling frequency after decimation
+    """
+
+    blocks = raw_epochs(raw, epoch_size, decim)
+    n_samples = blocks[0].shape[-1]
+    epochs = np.empty((sum(len(block) for block in blocks), blocks[0].shape[1], len(range(0, n_samples, decim))))
+    start = 0
+    with stage('epoch'):
+        for block in blocks:
+            if antialias and decim > 1:
+                block = antialias_filter(block, raw.info['sfreq'], decim)
+            detrend_decimate(block, decim, out=epochs[start:start + len(block)])
+            start += len(block)
+
+    return epochs, raw.info['sfreq'] / decim
+
+
+def raw_epochs(raw: mne.io.Raw, epoch_size: int, decim: int = 1) -> List[np.ndarray]:
+    """The epochs of epoch_array before they are detrended and decimated, as a
+    list of (epochs, channels, samples) blocks: a strided view of the data (see
+    epoch_views) for the complete epochs, then the last epoch on its own if it
+    is truncated by the end of the recording (see epoch_windows)"""
+
+    picks, starts, n_samples = epoch_windows(raw, epoch_size, decim)
+    starts = good_windows(raw, picks, starts, n_samples)
+    with stage('read'):
+        data = raw.get_data(picks)
+    with stage('epoch'):
+        complete = starts + n_samples <= data.shape[-1]
+        if complete.any():
+            blocks = [epoch_views(data, starts[complete], n_samples)]
+        else:
+            blocks = [np.empty((0, len(picks), n_samples))]
+        blocks.extend(data[np.newaxis, :, start:] for start in starts[~complete])
+        return blocks
+
+
+def compiled_welch(backend: str, estimator: str, estimator_options: Optional[Dict]) -> bool:
+    """Return True if the log Welch PSD is computed by the compiled kernel
+    (see src.features.kernels), only the default estimator has one"""
+
+    return estimator == 'welch' and not estimator_options and kernels.resolve_backend(backend) == 'numba'
+
+
+def batch_spectral_features(data: np.ndarray, sfreq: float, max_freq: int = 100, n_fft: int = 48, filter=True,
+                            estimator: str = 'welch', estimator_options: Optional[Dict] = None,
+                            backend: str = 'numpy') -> np.array:
+    """Compute spectral features for all epochs of a recording at once.
+
+    `data` is an (epochs, channels, samples) array as returned by `epoch_array`.
+    This is the batched equivalent of calling `spectral_features` on each epoch:
+    the low-pass filter kernel and resampling plan come from the caches in
+    `src.features.filters` and are applied to every epoch in one call, and the
+    spectrum of every epoch and channel is computed with a single FFT call
+    (see `src.features.spectral`). Filtering is still applied per epoch (with
+    edge padding) so results match `spectral_features` to within floating point
+    rounding (|difference| < 1e-6 in the log domain). With backend 'numba' the
+    default Welch PSD is computed by the compiled kernel in `src.features.kernels`.
+
+    Returns an (epochs, channels, F) np.array of log PSDs (or band powers),
+    F is 24 for the default 48 point Welch PSD.
+    """
+
+    if filter:
+        with stage('filter'):
+            data = lowpass(data, sfreq, max_freq, h_trans_bandwidth=0.5, filter_length='10s', fir_design='firwin2')
+        with stage('resample'):
+            data = resample(data, 2*max_freq, sfreq)
+        sfreq = 2*max_freq
+
+    # the default is the same estimator as psd_welch: hamming window, no overlap, segment mean removed
+    with stage('psd'):
+        if compiled_welch(backend, estimator, estimator_options):
+            return kernels.log_welch(data, sfreq, n_fft)
+        return log_spectrum(data, sfreq, estimator, n_fft, options=estimator_options)
+
+
+def spectral_epochs(label: str, raw: mne.io.Raw, epoch_size: int, max_freq: int = 100, n_fft: int = 48, filter=True,
+                    decim: int = 8, batch=True, estimator: str = 'welch', estimator_options: Optional[Dict] = None,
+                    antialias: bool = False, backend: str = 'numpy') -> Tuple[List[str], List[np.array]]:
     """Read raw data and split into epochs of a given size (s), compute features
     over each one
     label: subject identifier
@@ -32,77 +237,178 @@ def spectral_epochs(label: str, raw: mne.io.Raw, epoch_size: int, max_freq: int
     data_folder: location of source data
     max_freq: max frequency for FFT (default 100)
     n_fft: FFT size (default 48)
+    decim: decimation applied when epoching (default 8)
+    batch: compute features for all epochs at once from `epoch_array` with
+           `batch_spectral_features` (default True), otherwise cut the recording
+           with mne.Epochs and call `spectral_features` on each epoch in turn.
+           Both drop epochs that overlap BAD annotations.
+    estimator: spectral estimator, 'welch' (default), 'multitaper' or 'bandpower'
+    estimator_options: passed to the estimator, see `src.features.spectral`
+    antialias: low-pass filter each epoch before decimating it (default False,
+           only with batch, see `epoch_array`)
+    backend: 'numpy' (default) or 'numba' for the compiled Welch kernel (see
+           `src.features.kernels`), only with batch. Without filter or antialias
+           the kernel also detrends and decimates the epochs, in the same pass.
 
     Returns: labels, features
     labels: a list of labels with the format <subject>-<run_index>-<N>
     features: a list of np.arrays one per epoch containing the features
     """
 
+    if batch:
+        if compiled_welch(backend, estimator, estimator_options) and not filter and not antialias:
+            blocks = raw_epochs(raw, epoch_size, decim)
+            with stage('psd'):
+                psds = np.concatenate([kernels.log_welch(block, raw.info['sfreq'], n_fft, decim, detrend=True)
+                                       for block in blocks])
+        else:
+            data, sfreq = epoch_array(raw, epoch_size, decim=decim, antialias=antialias)
+            psds = batch_spectral_features(data, sfreq, max_freq=max_freq, n_fft=n_fft, filter=filter,
+                                           estimator=estimator, estimator_options=estimator_options,
+                                           backend=backend)
+        print('|', end='', flush=True)
+        # keep the (1, channels, freqs) shape of the per-epoch features
+        return ["{}-{}".format(label, N) for N in range(len(psds))], [psds[N:N+1] for N in range(len(psds))]
+
+    if antialias:
+        raise ValueError("antialias is only supported with batch=True")
+
     features = []
     labels = []
 
     events = mne.make_fixed_length_events(raw, id=1, duration=epoch_size)
-    epochs = mne.Epochs(raw, events, tmin=0., tmax=epoch_size, baseline=None,
-                        detrend=1, decim=8, preload=True)
+    with stage('epoch'):
+        epochs = mne.Epochs(raw, events, tmin=0., tmax=epoch_size, baseline=None,
+                            detrend=1, decim=decim, preload=True)
 
-    
     for N in range(len(epochs)):
-        features.append(spectral_features(epochs[N], max_freq=max_freq, n_fft=n_fft, filter=filter))
+        features.append(spectral_features(epochs[N], max_freq=max_freq, n_fft=n_fft, filter=filter,
+                                          estimator=estimator, estimator_options=estimator_options))
         labels.append("{}-{}".format(label, N))
         print('.', end='', flush=True)
-    print('|', end='', flush=True)        
+    print('|', end='', flush=True)
     return labels, features
 
 
+def stream_spectral_epochs(label: str, raw: mne.io.Raw, epoch_size: int, max_freq: int = 100, n_fft: int = 48,
+                           filter=True, decim: int = 8, estimator: str = 'welch',
+                           estimator_options: Optional[Dict] = None,
+                           antialias: bool = False, backend: str = 'numpy') -> Iterator[Tuple[str, np.array]]:
+    """Generate (label, features) for each epoch of a recording, one at a time.
+
+    Takes the same arguments as `spectral_epochs` and gives the same features, but
+    only one epoch of raw data is read at a time, so with a raw opened with
+    preload=False peak memory is bounded by the epoch length rather than the
+    length of the recording. Each epoch is filtered on its own with edge padding,
+    as in `spectral_features`, so no samples outside the epoch window (which
+    already overlaps the next one by a sample) are needed. This is also true of
+    the anti-alias filter.
+    """
+
+    picks, starts, n_samples = epoch_windows(raw, epoch_size, decim)
+    starts = good_windows(raw, picks, starts, n_samples)
+    sfreq = raw.info['sfreq'] / decim
+    fused = compiled_welch(backend, estimator, estimator_options) and not filter and not antialias
+    for N, start in enumerate(starts):
+        with stage('read'):
+            epoch = raw.get_data(picks, start=start, stop=start + n_samples)
+        if fused:
+            with stage('psd'):
+                psds = kernels.log_welch(epoch[np.newaxis], raw.info['sfreq'], n_fft, decim, detrend=True)
+            yield "{}-{}".format(label, N), psds
+            print('.', end='', flush=True)
+            continue
+        with stage('epoch'):
+            if antialias and decim > 1:
+                epoch = antialias_filter(epoch, raw.info['sfreq'], decim)
+            data = detrend_decimate(epoch, decim)[np.newaxis]
+        yield "{}-{}".format(label, N), batch_spectral_features(data, sfreq, max_freq=max_freq, n_fft=n_fft,
+                                                                filter=filter, estimator=estimator,
+                                                                estimator_options=estimator_options,
+                                                                backend=backend)
+        print('.', end='', flush=True)
+    print('|', end='', flush=True)
+
+
+def hcp_files(subject: str, data_folder: str, run_index: int) -> List[str]:
+    """
+    Return the paths of the files read by read_hcp
+    """
+
+    from hcp.io.file_mapping import get_file_paths
+
+    return get_file_paths(subject=subject, data_type='rest', output='raw', run_index=run_index, hcp_path=data_folder)
+
+
+def mous_files(subject: str, data_folder: str) -> List[str]:
+    """
+    Return the paths of the files read by read_mous
+    """
+
+    return [os.path.join(data_folder, 'Resting/{}/sub-{}_task-rest_meg.ds'.format(subject, subject))]
+
+
+def camcan_files(subject: str, data_folder: str) -> List[str]:
+    """
+    Return the paths of the files read by read_camcan
+    """
+
+    return [os.path.join(data_folder, '{}/rest/rest_raw.fif'.format(subject))]
+
+
 def read_hcp(subject: str, data_folder: str, run_index: int) -> mne.io.Raw:
     """
     Read a data file from the HCP dataset, return a Raw instance
     """
 
+    import hcp
+
     raw = hcp.read_raw(subject=subject, data_type='rest', hcp_path=data_folder, run_index=run_index)
 
     return raw
 
 
-def read_mous(subject: str, data_folder: str) -> mne.io.Raw:
+def read_mous(subject: str, data_folder: str, preload=True) -> mne.io.Raw:
     """
     Read a data file from the MOUS dataset, return a Raw instance
+    With preload=False data is read from disk as it is needed
     """
 
     try:
-        raw_path = os.path.join(data_folder, 'Resting/{}/sub-{}_task-rest_meg.ds'.format(subject, subject))
+        raw_path = mous_files(subject, data_folder)[0]
 
-        raw = mne.io.read_raw_ctf(raw_path, preload=True)
+        raw = mne.io.read_raw_ctf(raw_path, preload=preload)
 
-        picks = mne.pick_types(raw.info, meg=True, eeg=False, stim=False, eog=True, exclude='bads') 
+        picks = mne.pick_types(raw.info, meg=True, eeg=False, stim=False, eog=True, exclude='bads')
         raw.pick(picks)
         return raw
 
-    except:
+    except Exception:
         return None
 
-def read_camcan(subject: str, data_folder: str) -> mne.io.Raw:
+
+def read_camcan(subject: str, data_folder: str, preload=True) -> mne.io.Raw:
     """
-    Read a data file from the MOUS dataset, return a Raw instance
+    Read a data file from the CAMCAN dataset, return a Raw instance
+    With preload=False data is read from disk as it is needed
     """
 
     try:
-        raw_path = os.path.join(data_folder, '{}/rest/rest_raw.fif'.format(subject))
+        raw_path = camcan_files(subject, data_folder)[0]
 
         print("READING", raw_path)
 
-        raw = mne.io.read_raw_fif(raw_path, preload=True)
+        raw = mne.io.read_raw_fif(raw_path, preload=preload)
 
-        picks = mne.pick_types(raw.info, meg=True, eeg=False, stim=False, eog=True, exclude='bads') 
+        picks = mne.pick_types(raw.info, meg=True, eeg=False, stim=False, eog=True, exclude='bads')
         raw.pick(picks)
         return raw
 
-    except:
+    except Exception:
         return None
 
 
-
-if __name__=='__main__': 
+if __name__ == '__main__':
 
     mne.set_log_level('ERROR')
 
@@ -121,5 +427,3 @@ if __name__=='__main__':
 
     for i in range(len(labels)):
         print(labels[i], features[i].shape)
-
-    
\ No newline at end of file
@@ -0,0 +1,162 @@
+"""
+    Cached low-pass filter kernels and resampling plans.
+
+    The features for every epoch of every subject use the same FIR filter and
+    resampling setup, which only depend on the sampling rate, cutoff, transition
+    band, filter length and design. Rather than have MNE redesign them for each
+    call, kernels and plans are kept in LRU caches for the life of the process
+    and, if a cache directory is set (`set_cache_dir` or the FILTER_CACHE
+    environment variable), FIR kernels are also saved to disk between runs.
+
+    `lowpass` and `resample` apply them to an array of any shape along the last
+    axis, in one call for all epochs and channels, and give the same result as
+    mne.filter.filter_data(..., pad='edge') and
+    mne.filter.resample(..., npad='auto', window='boxcar', pad='edge').
+"""
+import hashlib
+import os
+import numpy as np
+from functools import lru_cache
+from scipy.fft import irfft, next_fast_len, rfft
+from typing import Dict, Optional, Tuple
+
+CACHE_SIZE = 32
+
+_cache_dir: Dict = {'path': os.environ.get('FILTER_CACHE')}
+
+
+def set_cache_dir(path: Optional[str]) -> None:
+    """Save FIR kernels in path between runs (None to only cache in memory).
+    Sets FILTER_CACHE so that worker processes use the same directory."""
+
+    _cache_dir['path'] = path
+    if path:
+        os.makedirs(path, exist_ok=True)
+        os.environ['FILTER_CACHE'] = path
+    else:
+        os.environ.pop('FILTER_CACHE', None)
+
+
+def _design(sfreq: float, h_freq: float, h_trans_bandwidth: float, filter_length: str, fir_design: str) -> np.ndarray:
+    import mne
+
+    return mne.filter.create_filter(None, sfreq, None, h_freq, filter_length=filter_length,
+                                    h_trans_bandwidth=h_trans_bandwidth, method='fir', phase='zero-double',
+                                    fir_window='hamming', fir_design=fir_design, verbose=False)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def fir_kernel(sfreq: float, h_freq: float, h_trans_bandwidth: float = 0.5, filter_length: str = '10s',
+               fir_design: str = 'firwin2') -> Tuple[np.ndarray, np.ndarray]:
+    """Design (or fetch from the cache) a zero-double low-pass FIR filter.
+
+    Returns: h, h2
+    h: the filter kernel as designed by mne.filter.create_filter
+    h2: h convolved with its reverse, the kernel actually applied for phase='zero-double'
+    """
+    import mne
+
+    key = (float(sfreq), float(h_freq), float(h_trans_bandwidth), str(filter_length), fir_design, mne.__version__)
+    path = None
+    if _cache_dir['path']:
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        path = os.path.join(_cache_dir['path'], 'fir-{}.npy'.format(digest))
+    if path and os.path.exists(path):
+        h = np.load(path)
+    else:
+        h = _design(sfreq, h_freq, h_trans_bandwidth, filter_length, fir_design)
+        if path:
+            # write then rename so concurrent workers never read a partial file
+            os.makedirs(_cache_dir['path'], exist_ok=True)
+            tmp = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp, 'wb') as fd:
+                np.save(fd, h)
+            os.replace(tmp, path)
+    h2 = np.convolve(h, h[::-1])
+    h.flags.writeable = False
+    h2.flags.writeable = False
+    return h, h2
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def filter_plan(n_times: int, sfreq: float, h_freq: float, h_trans_bandwidth: float = 0.5,
+                filter_length: str = '10s', fir_design: str = 'firwin2') -> Dict:
+    """Edge padding, FFT length and kernel spectrum for filtering n_times samples.
+
+    Only the middle n_times samples of the convolution are kept, so the FFT
+    only needs to be long enough that wrap-around does not reach them, which
+    is shorter than the full linear convolution.
+    """
+
+    h, h2 = fir_kernel(sfreq, h_freq, h_trans_bandwidth, filter_length, fir_design)
+    n_edge = max(min(len(h), n_times) - 1, 0)
+    shift = (len(h2) - 1) // 2 + n_edge
+    n_fft = next_fast_len(max(n_times + 2 * n_edge + len(h2) - 1 - shift, n_times + 2 * n_edge), real=True)
+    kernel = rfft(h2, n_fft)
+    kernel.flags.writeable = False
+    return {'n_edge': n_edge, 'shift': shift, 'n_fft': n_fft, 'kernel': kernel}
+
+
+def lowpass(data: np.ndarray, sfreq: float, h_freq: float, h_trans_bandwidth: float = 0.5,
+            filter_length: str = '10s', fir_design: str = 'firwin2') -> np.ndarray:
+    """Low-pass filter data along the last axis with a cached zero-double FIR kernel.
+
+    Each row is edge padded and filtered independently, as by
+    mne.filter.filter_data(..., phase='zero-double', pad='edge'), but the
+    convolution is done with one rfft/irfft call for all rows.
+    """
+
+    n_times = data.shape[-1]
+    plan = filter_plan(n_times, sfreq, h_freq, h_trans_bandwidth, filter_length, fir_design)
+    n_edge = plan['n_edge']
+    padded = np.pad(data, [(0, 0)] * (data.ndim - 1) + [(n_edge, n_edge)], mode='edge')
+    spectrum = rfft(padded, plan['n_fft'], axis=-1)
+    spectrum *= plan['kernel']
+    return irfft(spectrum, plan['n_fft'], axis=-1)[..., plan['shift']:plan['shift'] + n_times]
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def resample_plan(n_times: int, up: float, down: float) -> Dict:
+    """Padding, lengths and spectral window for resampling n_times samples by up/down,
+    as computed by mne.filter.resample with npad='auto' and window='boxcar'"""
+
+    ratio = float(up) / down
+    final_len = max(int(round(ratio * n_times)), 1)
+    min_add = min(n_times // 8, 100) * 2
+    npad = 2 ** int(np.ceil(np.log2(n_times + min_add))) - n_times
+    npad, extra = divmod(npad, 2)
+    npads = (npad, npad + extra)
+    orig_len = n_times + sum(npads)
+    new_len = max(int(round(ratio * orig_len)), 1)
+    to_remove = int(round(ratio * npads[0]))
+    to_removes = (to_remove, new_len - final_len - to_remove)
+
+    # a boxcar window is flat, so the folded rfft window is a constant gain
+    window = np.full(orig_len // 2 + 1, new_len / orig_len)
+    shorter = new_len < orig_len
+    use_len = new_len if shorter else orig_len
+    if use_len % 2 == 0:
+        window[min(use_len // 2, len(window) - 1)] *= 2. if shorter else 0.5
+    window.flags.writeable = False
+    return {'npads': npads, 'new_len': new_len, 'to_removes': to_removes, 'window': window}
+
+
+def resample(data: np.ndarray, up: float, down: float) -> np.ndarray:
+    """Resample data along the last axis by a factor of up/down using a cached plan,
+    with one rfft/irfft call for all rows"""
+
+    plan = resample_plan(data.shape[-1], up, down)
+    padded = np.pad(data, [(0, 0)] * (data.ndim - 1) + [plan['npads']], mode='edge')
+    spectrum = rfft(padded, axis=-1)
+    spectrum *= plan['window']
+    resampled = irfft(spectrum, plan['new_len'], axis=-1)
+    start, end = plan['to_removes']
+    return resampled[..., start:plan['new_len'] - end]
+
+
+def clear_cache() -> None:
+    """Forget all kernels and plans held in memory"""
+
+    fir_kernel.cache_clear()
+    filter_plan.cache_clear()
+    resample_plan.cache_clear()
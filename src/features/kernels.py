@@ -0,0 +1,158 @@
+"""
+    Compiled kernels for the default features, with numba.
+
+    log_welch computes the log Welch PSD of every (epoch, channel) row in a single
+    parallel pass (numba prange over epochs * channels). For each row it can first
+    remove the linear trend of the epoch and decimate it, as epoch_array does. It
+    then removes the mean of each n_fft point segment, applies the Hamming window,
+    sums the segments' power, scales the sum and takes the log. The only per-row
+    allocations are an n_fft point segment and the bins' power sums. The DFT is a
+    product with a cached cosine and sine basis of the kept bins, which is cheaper
+    than an FFT call for the 48 point segments used here but grows with n_fft
+    squared.
+
+    numba is optional. BACKENDS lists the choices for make_dataset --backend, and
+    resolve_backend falls back to 'numpy' (the implementations in build_features
+    and spectral) with a warning if numba isn't installed. The kernel is compiled
+    on its first call and cached in __pycache__ next to this file, so later
+    processes load it instead of compiling it again (about 0.5s instead of 2.5s).
+"""
+import numpy as np
+import warnings
+from functools import lru_cache
+from typing import Tuple
+
+from src.features.spectral import CACHE_SIZE, window
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
+
+BACKENDS = ('numpy', 'numba')
+
+
+def available() -> bool:
+    """Return True if numba can be imported"""
+
+    return njit is not None
+
+
+def resolve_backend(backend: str) -> str:
+    """The backend to use for `backend`, 'numpy' if it is 'numba' and numba isn't installed"""
+
+    if backend not in BACKENDS:
+        raise ValueError("Unknown backend {}, expected one of {}".format(backend, ', '.join(BACKENDS)))
+    if backend == 'numba' and not available():
+        warnings.warn("numba is not installed, using the numpy backend")
+        return 'numpy'
+    return backend
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def dft_basis(n_fft: int, sfreq: float, fmin: float = 1., window_name: str = 'hamming'
+              ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """The window, the windowed cosine and sine bases of the bins of an n_fft point DFT with
+    frequency >= fmin, shape (bins, n_fft), and the scale of each bin's power that
+    gives the one-sided PSD as in spectral.welch_psd.
+
+    Returns: window, cos, sin, scale
+    """
+
+    win = window(window_name, n_fft)
+    freqs = np.fft.rfftfreq(n_fft, 1 / sfreq)
+    bins = np.flatnonzero(freqs >= fmin)
+    angle = 2 * np.pi * np.outer(bins, np.arange(n_fft)) / n_fft
+    scale = np.full(len(bins), 2 / (sfreq * np.dot(win, win)))
+    # DC and (for even n_fft) Nyquist have no negative frequency counterpart
+    scale[(bins == 0) | ((n_fft % 2 == 0) & (bins == n_fft // 2))] /= 2
+    result = (np.ascontiguousarray(win), np.cos(angle) * win, -np.sin(angle) * win, scale)
+    for array in result:
+        array.flags.writeable = False
+    return result
+
+
+def _jit(**options):
+    """numba.njit(**options), or a decorator that leaves the function as it is if numba
+    isn't installed (resolve_backend doesn't choose it then)"""
+
+    return njit(**options) if njit is not None else lambda func: func
+
+
+# the kernels behind log_welch are defined at module level so that numba can cache them
+@_jit(cache=True)
+def _trend(x):
+    """Offset and least squares slope of x about its centre sample"""
+    n_samples = len(x)
+    centre = (n_samples - 1) / 2.
+    # sum of (t - centre)**2 over the samples
+    tt = n_samples * (n_samples * n_samples - 1) / 12.
+    offset = 0.
+    slope = 0.
+    for i in range(n_samples):
+        offset += x[i]
+        slope += x[i] * (i - centre)
+    return offset / n_samples, slope / tt if tt > 0 else 0.
+
+
+@_jit(cache=True)
+def _add_segment_power(segment, cos, sin, power):
+    """Remove the mean of segment and add the power of its windowed DFT bins to power"""
+    n_fft = len(segment)
+    mean = 0.
+    for k in range(n_fft):
+        mean += segment[k]
+    mean /= n_fft
+    for k in range(n_fft):
+        segment[k] -= mean
+    for b in range(len(power)):
+        re = 0.
+        im = 0.
+        for k in range(n_fft):
+            re += segment[k] * cos[b, k]
+            im += segment[k] * sin[b, k]
+        power[b] += re * re + im * im
+
+
+@_jit(parallel=True, cache=True)
+def log_welch_kernel(data, decim, detrend, n_fft, cos, sin, scale, out):
+    n_epochs, n_channels, n_samples = data.shape
+    n_segments = ((n_samples + decim - 1) // decim) // n_fft
+    centre = (n_samples - 1) / 2.
+    for row in prange(n_epochs * n_channels):
+        x = data[row // n_channels, row % n_channels]
+        offset, slope = _trend(x) if detrend else (0., 0.)
+        segment = np.empty(n_fft)
+        power = np.zeros(len(scale))
+        for s in range(n_segments):
+            for k in range(n_fft):
+                i = (s * n_fft + k) * decim
+                segment[k] = x[i] - offset - slope * (i - centre)
+            _add_segment_power(segment, cos, sin, power)
+        for b in range(len(scale)):
+            out[row // n_channels, row % n_channels, b] = np.log(power[b] * scale[b] / n_segments)
+
+
+def log_welch(data: np.ndarray, sfreq: float, n_fft: int = 48, decim: int = 1, detrend: bool = False,
+              fmin: float = 1., window_name: str = 'hamming') -> np.ndarray:
+    """Log Welch PSD at frequencies >= fmin of (epochs, channels, samples) data, the
+    same as spectral.log_spectrum(data, sfreq, 'welch', n_fft). Strided views are
+    read in place.
+
+    With `detrend` each row is first linearly detrended and then decimated by
+    `decim`, as build_features.detrend_decimate, in the same pass. sfreq is the
+    sampling rate of data before decimation.
+
+    Returns an (epochs, channels, bins) array.
+    """
+
+    if data.ndim != 3:
+        raise ValueError("Expected (epochs, channels, samples) data, got shape {}".format(data.shape))
+    if (data.shape[-1] + decim - 1) // decim < n_fft:
+        raise ValueError("n_fft ({}) is longer than the data ({} samples after decimation)".format(
+            n_fft, (data.shape[-1] + decim - 1) // decim))
+    win, cos, sin, scale = dft_basis(n_fft, float(sfreq / decim), fmin, window_name)
+    out = np.empty(data.shape[:2] + (len(scale),))
+    log_welch_kernel(np.asarray(data, dtype=np.float64), decim, detrend, n_fft, cos, sin, scale, out)
+    return out
@@ -0,0 +1,192 @@
+"""
+    Spectral estimators for the features of each epoch.
+
+    welch       Welch's method: the mean periodogram of n_fft point segments with
+                a Hamming window (the original features, as mne psd_welch)
+    multitaper  the mean over n_fft point segments (the whole epoch if n_fft is
+                None) of the eigenvalue-weighted periodograms with DPSS tapers,
+                as mne.time_frequency.psd_array_multitaper(adaptive=False,
+                normalization='full')
+    bandpower   the mean power in each frequency band (BANDS by default) of a
+                Welch or multitaper PSD, one feature per band and channel
+
+    Every estimator works on an array of any shape along the last axis, so all
+    epochs and channels of a recording go through one FFT call. The windows,
+    DPSS tapers and band averaging matrices only depend on the segment length,
+    sampling rate and bandwidth, so they are kept in LRU caches for the life of
+    the process, and scipy.fft reuses its plan for the segment length across
+    calls. A 1Hz resolution therefore costs about the same as the original 48
+    point FFT: the same samples are transformed in fewer, longer segments.
+"""
+import numpy as np
+from functools import lru_cache
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.fft import rfft, rfftfreq
+from typing import Dict, Optional, Sequence, Tuple
+
+CACHE_SIZE = 32
+
+ESTIMATORS = ('welch', 'multitaper', 'bandpower')
+
+# (low, high) Hz: delta, theta, alpha, beta, gamma
+BANDS = [[1, 4], [4, 8], [8, 13], [13, 30], [30, 60]]
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def window(name: str, n: int) -> np.ndarray:
+    """A periodic window of n samples (as used by scipy.signal.welch)"""
+    from scipy.signal import get_window
+
+    win = get_window(name, n)
+    win.flags.writeable = False
+    return win
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def dpss_tapers(n: int, half_nbw: float, low_bias: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    """DPSS tapers of n samples with time-half-bandwidth product half_nbw, as
+    mne.time_frequency.dpss_windows. With low_bias only the tapers with a
+    concentration above 0.9 are kept.
+
+    Returns: tapers, weights
+    tapers: a (tapers, n) np.array
+    weights: the square root of each taper's concentration, shape (tapers, 1)
+    """
+    from scipy.signal.windows import dpss
+
+    tapers, ratios = dpss(n, half_nbw, max(int(2 * half_nbw), 1), return_ratios=True)
+    if low_bias:
+        keep = ratios > 0.9
+        if not keep.any():
+            keep = ratios == ratios.max()
+        tapers, ratios = tapers[keep], ratios[keep]
+    weights = np.sqrt(ratios)[:, np.newaxis]
+    tapers.flags.writeable = False
+    weights.flags.writeable = False
+    return tapers, weights
+
+
+def segments(data: np.ndarray, n_fft: int) -> np.ndarray:
+    """Consecutive n_fft sample segments of data along the last axis, with the
+    mean of each removed. Trailing samples that don't fill a segment are dropped.
+    Returns an array of shape data.shape[:-1] + (segments, n_fft)."""
+
+    if data.shape[-1] < n_fft:
+        raise ValueError("n_fft ({}) is longer than the data ({} samples)".format(n_fft, data.shape[-1]))
+    # a view, the only copy is the one made by removing the mean
+    view = sliding_window_view(data, n_fft, axis=-1)[..., ::n_fft, :]
+    return view - view.mean(axis=-1, keepdims=True)
+
+
+def welch_psd(data: np.ndarray, sfreq: float, n_fft: int = 48,
+              window_name: str = 'hamming') -> Tuple[np.ndarray, np.ndarray]:
+    """Welch PSD of data along the last axis with non-overlapping n_fft point
+    segments, the same as scipy.signal.welch(data, sfreq, window_name, n_fft, noverlap=0)
+
+    Returns: freqs, psds
+    """
+
+    win = window(window_name, n_fft)
+    x = segments(data, n_fft)
+    x *= win
+    spectrum = rfft(x, axis=-1)
+    psds = (spectrum.real ** 2 + spectrum.imag ** 2).mean(axis=-2)
+    psds *= 2 / (sfreq * np.dot(win, win))
+    # DC and (for even n_fft) Nyquist have no negative frequency counterpart
+    psds[..., 0] /= 2
+    if n_fft % 2 == 0:
+        psds[..., -1] /= 2
+    return rfftfreq(n_fft, 1 / sfreq), psds
+
+
+def multitaper_psd(data: np.ndarray, sfreq: float, n_fft: Optional[int] = None, bandwidth: Optional[float] = None,
+                   low_bias: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    """Multitaper PSD of data along the last axis, averaged over n_fft point
+    segments (one segment of the whole length if n_fft is None).
+
+    bandwidth is the full bandwidth of the tapers in Hz, by default a
+    time-half-bandwidth product of 4 as in mne.time_frequency.psd_array_multitaper.
+    With n_fft None this gives the same result as
+    psd_array_multitaper(data, sfreq, bandwidth, adaptive=False, low_bias=low_bias,
+    normalization='full').
+
+    Returns: freqs, psds
+    """
+
+    n_fft = n_fft or data.shape[-1]
+    half_nbw = bandwidth * n_fft / (2. * sfreq) if bandwidth else 4.
+    tapers, weights = dpss_tapers(n_fft, float(half_nbw), low_bias)
+    x = segments(data, n_fft)
+    spectrum = rfft(x[..., np.newaxis, :] * tapers, axis=-1)
+    spectrum *= weights
+    psds = (spectrum.real ** 2 + spectrum.imag ** 2).sum(axis=-2).mean(axis=-2)
+    psds *= 2 / (sfreq * np.sum(weights ** 2))
+    psds[..., 0] /= 2
+    if n_fft % 2 == 0:
+        psds[..., -1] /= 2
+    return rfftfreq(n_fft, 1 / sfreq), psds
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def band_matrix(n_fft: int, sfreq: float, bands: Tuple[Tuple[float, float], ...]) -> np.ndarray:
+    """A (bands, freqs) matrix averaging the PSD bins with low <= f < high in each band"""
+
+    freqs = rfftfreq(n_fft, 1 / sfreq)
+    matrix = np.zeros((len(bands), len(freqs)))
+    for i, (low, high) in enumerate(bands):
+        in_band = (freqs >= low) & (freqs < high)
+        if not in_band.any():
+            raise ValueError("No frequency bins in band {}-{}Hz with n_fft={} at {}Hz, use a larger n_fft"
+                             .format(low, high, n_fft, sfreq))
+        matrix[i, in_band] = 1. / in_band.sum()
+    matrix.flags.writeable = False
+    return matrix
+
+
+def band_power(data: np.ndarray, sfreq: float, n_fft: Optional[int] = None, bands: Sequence = BANDS,
+               method: str = 'welch', **options) -> np.ndarray:
+    """Mean power in each band of the Welch or multitaper (`method`) PSD of data
+    along the last axis, options are passed to the PSD estimator.
+    Returns an array of shape data.shape[:-1] + (bands,)."""
+
+    if method not in ('welch', 'multitaper'):
+        raise ValueError("Unknown band power method {}".format(method))
+    if method == 'welch':
+        # 1Hz bins by default, fine enough for the narrowest band
+        n_fft = n_fft or int(round(sfreq))
+        freqs, psds = welch_psd(data, sfreq, n_fft, **options)
+    else:
+        n_fft = n_fft or data.shape[-1]
+        freqs, psds = multitaper_psd(data, sfreq, n_fft, **options)
+    matrix = band_matrix(n_fft, float(sfreq), tuple(tuple(band) for band in bands))
+    return np.dot(psds, matrix.T)
+
+
+def log_spectrum(data: np.ndarray, sfreq: float, estimator: str = 'welch', n_fft: Optional[int] = 48,
+                 fmin: float = 1., options: Optional[Dict] = None) -> np.ndarray:
+    """Log spectral features of data along the last axis with one of ESTIMATORS.
+
+    For welch and multitaper these are the log PSD at frequencies >= fmin, for
+    bandpower the log mean power in each band. `options` are passed to the
+    estimator (eg. {'bandwidth': 2.} for multitaper, {'bands': [[1, 4], [4, 8]]}
+    for bandpower).
+    """
+
+    options = options or {}
+    if estimator == 'welch':
+        freqs, psds = welch_psd(data, sfreq, n_fft, **options)
+    elif estimator == 'multitaper':
+        freqs, psds = multitaper_psd(data, sfreq, n_fft, **options)
+    elif estimator == 'bandpower':
+        return np.log(band_power(data, sfreq, n_fft, **options))
+    else:
+        raise ValueError("Unknown spectral estimator {}, expected one of {}".format(estimator, ', '.join(ESTIMATORS)))
+    return np.log(psds[..., freqs >= fmin])
+
+
+def clear_cache() -> None:
+    """Forget all windows, tapers and band matrices held in memory"""
+
+    window.cache_clear()
+    dpss_tapers.cache_clear()
+    band_matrix.cache_clear()
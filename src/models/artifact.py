@@ -0,0 +1,235 @@
+"""
+    Versioned model artifacts.
+
+    A trained SVM is saved as a folder instead of a pickle:
+
+    meta.json               format version, model type, gamma, classes and the
+                            number of support vectors of each class, the feature
+                            parameters, feature code version, channels and number
+                            of features the model was trained on, and the
+                            reduction (see src.data.preprocess), if any
+    support_vectors.npy     (support vectors, features) array
+    dual_coef.npy           (classes - 1, support vectors) array
+    intercept.npy           one intercept per pair of classes
+    reduction_*.npy         mean, components and explained variance of the reduction
+
+    The arrays are memory-mapped when the artifact is loaded. Several inference
+    processes loading the same artifact share its pages through the page cache, and
+    loading takes about the same time for any model size. Predictions come from a
+    numpy one-vs-one RBF decision function that gives the same results as
+    sklearn.svm.SVC.predict, so loading an artifact doesn't import sklearn or
+    unpickle anything.
+
+    When it is loaded, the feature parameters in the artifact are compared with those
+    make_dataset uses now for the same dataset (FEATURE_PARAMS). A mismatch raises a
+    ValueError, because the model would get features it wasn't trained on. A change
+    to the feature code only warns.
+"""
+import json
+import os
+import shutil
+import time
+import warnings
+import numpy as np
+from typing import Dict, Optional
+
+from src.data.make_dataset import FEATURE_PARAMS
+from src.data.manifest import code_version
+from src.data.preprocess import Reduction
+
+FORMAT_VERSION = 1
+META = 'meta.json'
+
+MODEL_ARRAYS = ('support_vectors', 'dual_coef', 'intercept')
+REDUCTION_ARRAYS = ('mean', 'components', 'explained_variance')
+
+
+def is_artifact(path: str) -> bool:
+    """Return True if path is a model artifact folder"""
+
+    return os.path.isfile(os.path.join(path, META))
+
+
+class Artifact:
+    """An RBF kernel SVM, with an optional reduction applied to its input, that
+    predicts from (records, channels * freqs) design matrices"""
+
+    def __init__(self, meta: Dict, arrays: Dict[str, np.ndarray], reduction: Optional[Reduction] = None):
+        self.meta = meta
+        self.reduction = reduction
+        self.support_vectors = arrays['support_vectors']
+        self.dual_coef = arrays['dual_coef']
+        self.intercept = arrays['intercept']
+        model = meta['model']
+        self.gamma = model['gamma']
+        self.classes = np.array(model['classes'])
+        # the support vectors of class i are support_vectors[bounds[i]:bounds[i + 1]]
+        self.bounds = np.concatenate([[0], np.cumsum(model['n_support'])])
+        self.sv_norms = np.einsum('ij,ij->i', self.support_vectors, self.support_vectors)
+
+    @property
+    def channels(self) -> int:
+        return self.meta['features']['channels']
+
+    @property
+    def n_features(self) -> int:
+        return self.meta['features']['n_features']
+
+    def kernel(self, X: np.ndarray) -> np.ndarray:
+        """RBF kernel between the rows of X and the support vectors"""
+
+        distances = np.dot(X, self.support_vectors.T)
+        distances *= -2
+        distances += np.einsum('ij,ij->i', X, X)[:, np.newaxis]
+        distances += self.sv_norms
+        np.maximum(distances, 0, out=distances)
+        distances *= -self.gamma
+        return np.exp(distances, out=distances)
+
+    def decision(self, X: np.ndarray) -> np.ndarray:
+        """The one-vs-one decision values of libsvm, (records, pairs) with
+        the pairs in the order (0, 1), (0, 2), ... (1, 2), ..., positive for the first class"""
+
+        K = self.kernel(X)
+        n_classes = len(self.classes)
+        result = np.empty((len(X), n_classes * (n_classes - 1) // 2))
+        pair = 0
+        for i in range(n_classes):
+            si = slice(self.bounds[i], self.bounds[i + 1])
+            for j in range(i + 1, n_classes):
+                sj = slice(self.bounds[j], self.bounds[j + 1])
+                result[:, pair] = (np.dot(K[:, si], self.dual_coef[j - 1, si]) +
+                                   np.dot(K[:, sj], self.dual_coef[i, sj]) + self.intercept[pair])
+                pair += 1
+        return result
+
+    def predict(self, X: np.ndarray, batch_size: int = 1024) -> np.ndarray:
+        """Predict the rows of a design matrix by one-vs-one votes, ties going to
+        the first class as in libsvm. Records are processed batch_size at a time
+        to bound the size of the kernel matrix."""
+
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError("The model expects {} features per record ({} channels), got an array of shape {}"
+                             .format(self.n_features, self.channels, X.shape))
+        n_classes = len(self.classes)
+        first, second = np.triu_indices(n_classes, 1)
+        labels = np.empty(len(X), dtype=int)
+        for start in range(0, len(X), batch_size):
+            block = X[start:start + batch_size]
+            if self.reduction is not None:
+                block = self.reduction.transform(block)
+            winners = np.where(self.decision(block) > 0, first, second)
+            votes = np.zeros((len(block), n_classes), dtype=int)
+            np.add.at(votes, (np.arange(len(block))[:, np.newaxis], winners), 1)
+            labels[start:start + batch_size] = votes.argmax(axis=1)
+        return self.classes[labels]
+
+
+def _write_array(folder: str, name: str, array: np.ndarray) -> Dict:
+    array = np.ascontiguousarray(array, dtype=np.float64)
+    np.save(os.path.join(folder, name + '.npy'), array)
+    return {'shape': list(array.shape), 'dtype': array.dtype.str}
+
+
+def save_artifact(folder: str, model, channels: int, dataset: str = 'hcp', params: Optional[Dict] = None,
+                  reduction: Optional[Reduction] = None) -> None:
+    """Save a fitted sklearn.svm.SVC with an RBF kernel as an artifact in folder,
+    replacing any artifact there.
+
+    channels is the number of channels of each record used to train it,
+    params the feature parameters of the data (default FEATURE_PARAMS[dataset])
+    and reduction the Reduction its input was projected with, if any.
+    """
+
+    if getattr(model, 'kernel', None) != 'rbf':
+        raise ValueError("Only SVC models with an RBF kernel can be saved as artifacts")
+    gamma = model._gamma if isinstance(model.gamma, str) else model.gamma
+    dual_coef, intercept = model.dual_coef_, model.intercept_
+    if len(model.classes_) == 2:
+        # sklearn flips the signs of libsvm's coefficients for binary problems
+        dual_coef, intercept = -dual_coef, -intercept
+    n_features = len(reduction.mean) if reduction is not None else model.support_vectors_.shape[1]
+
+    folder = folder.rstrip(os.sep)
+    staging = folder + '.tmp'
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    arrays = {}
+    for name, array in zip(MODEL_ARRAYS, (model.support_vectors_, dual_coef, intercept)):
+        arrays[name] = _write_array(staging, name, array)
+    if reduction is not None:
+        for name in REDUCTION_ARRAYS:
+            arrays['reduction_' + name] = _write_array(staging, 'reduction_' + name, getattr(reduction, name))
+
+    meta = {
+        'format': FORMAT_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'model': {'type': 'svc', 'kernel': 'rbf', 'gamma': float(gamma),
+                  'classes': [str(label) for label in model.classes_],
+                  'n_support': [int(n) for n in model.n_support_]},
+        'features': {'dataset': dataset, 'params': params or FEATURE_PARAMS[dataset],
+                     'code_version': code_version(), 'channels': channels, 'n_features': n_features},
+        'reduction': None if reduction is None else {'method': reduction.method, 'channels': reduction.channels},
+        'arrays': arrays,
+    }
+    with open(os.path.join(staging, META), 'w') as fd:
+        json.dump(meta, fd, indent=2)
+
+    # swap the complete folder in, so a reader never sees half an artifact
+    if os.path.exists(folder):
+        old = folder + '.old'
+        shutil.rmtree(old, ignore_errors=True)
+        os.replace(folder, old)
+        os.replace(staging, folder)
+        shutil.rmtree(old)
+    else:
+        os.replace(staging, folder)
+
+
+def check_features(meta: Dict, params: Optional[Dict] = None) -> None:
+    """Raise ValueError if the artifact's feature parameters differ from params
+    (default those make_dataset uses now), warn if the feature code has changed"""
+
+    features = meta['features']
+    dataset = features['dataset']
+    if params is None:
+        if dataset not in FEATURE_PARAMS:
+            raise ValueError("The model was trained on features of an unknown dataset {}".format(dataset))
+        params = FEATURE_PARAMS[dataset]
+    # compare as JSON, the artifact's lists and numbers came from JSON
+    expected = json.loads(json.dumps(params))
+    stored = features['params']
+    changed = sorted(key for key in set(stored) | set(expected) if stored.get(key) != expected.get(key))
+    if changed:
+        raise ValueError("The model was trained on {} features with different parameters: {}".format(
+            dataset, ", ".join("{} {} (now {})".format(key, stored.get(key), expected.get(key)) for key in changed)))
+    if features['code_version'] != code_version():
+        warnings.warn("The feature code has changed since the model was trained")
+
+
+def load_artifact(folder: str, params: Optional[Dict] = None, check: bool = True, mmap: bool = True) -> Artifact:
+    """Load an artifact, with its arrays memory-mapped unless mmap is False.
+
+    Unless check is False, its feature parameters must match params (by default
+    the current FEATURE_PARAMS of the dataset it was trained on)."""
+
+    with open(os.path.join(folder, META)) as fd:
+        meta = json.load(fd)
+    if meta.get('format') != FORMAT_VERSION:
+        raise ValueError("{} has artifact format {}, this version reads format {}".format(
+            folder, meta.get('format'), FORMAT_VERSION))
+    if check:
+        check_features(meta, params)
+
+    arrays = {}
+    for name, info in meta['arrays'].items():
+        array = np.load(os.path.join(folder, name + '.npy'), mmap_mode='r' if mmap else None, allow_pickle=False)
+        if list(array.shape) != info['shape']:
+            raise ValueError("{} in {} has shape {}, expected {}".format(name, folder, array.shape, info['shape']))
+        arrays[name] = array
+
+    reduction = None
+    if meta['reduction'] is not None:
+        reduction = Reduction(*(arrays['reduction_' + name] for name in REDUCTION_ARRAYS), **meta['reduction'])
+    return Artifact(meta, arrays, reduction)
@@ -0,0 +1,116 @@
+"""
+    Check that a compact storage format doesn't change the classifier.
+
+    Each storage encoding (dtype and compression) is applied to the training
+    and evaluation features by writing them to a temporary store and reading
+    them back. For each encoding we report the size of the store, the largest
+    error in the decoded features and the accuracy of the SVM from
+    train_model trained and evaluated on the decoded features, so it can be
+    compared with float64.
+
+    python -m src.models.check_storage --encoding float32 --encoding int16:zlib
+"""
+import click
+import os
+import tempfile
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+
+from src.data.make_dataset import load_dataset
+from src.data.shared import DataFolder
+from src.data.store import CODECS, STORAGE_DTYPES, STORE_DATA, StoreWriter, check_codec, load_store, parse_id
+from src.models.train_model import CHANNELS, transform_data
+
+ENCODINGS = ['float64', 'float32', 'float16', 'int16', 'float32:zlib', 'int16:zlib']
+
+
+def parse_encoding(encoding: str) -> Tuple[str, Optional[str]]:
+    """Parse DTYPE or DTYPE:CODEC"""
+
+    dtype, _, compression = encoding.partition(':')
+    if dtype not in STORAGE_DTYPES or (compression and compression not in CODECS):
+        raise ValueError("Invalid encoding {}, expected DTYPE or DTYPE:CODEC".format(encoding))
+    return dtype, compression or None
+
+
+def round_trip(dataset: Dict, path: str, dtype: str, compression: Optional[str]) -> Tuple[Dict, int]:
+    """Write a dataset to a store with the given encoding and load it again,
+    returns the decoded dataset and the size of the store data"""
+
+    subjects: Dict = {}
+    with StoreWriter(path, dtype, compression) as writer:
+        for record_id, age, gender, data in zip(dataset['id'], dataset['age'], dataset['gender'], dataset['data']):
+            subject, epoch, run = parse_id(record_id)
+            writer.write(subject, run, data, [epoch])
+            subjects[subject] = {'age': age, 'gender': gender}
+    return load_store(path, subjects), os.path.getsize(os.path.join(path, STORE_DATA))
+
+
+def max_error(original: Dict, decoded: Dict) -> float:
+    """Largest absolute difference between the finite features of two datasets"""
+
+    error = 0.
+    for a, b in zip(original['data'], decoded['data']):
+        finite = np.isfinite(a)
+        if not np.array_equal(finite, np.isfinite(b)):
+            return float('inf')
+        if finite.any():
+            error = max(error, float(np.abs(a[finite] - b[finite]).max()))
+    return error
+
+
+def check_encodings(train: Dict, evaluate: Dict, encodings: List[str], channels: int = CHANNELS,
+                    gamma: float = 0.01, C: float = 10.) -> List[Dict]:
+    """Score the SVM on each encoding of the data, return one dictionary per encoding"""
+    from sklearn import svm
+    from sklearn.metrics import accuracy_score
+
+    results = []
+    first = None
+    for encoding in encodings:
+        dtype, compression = parse_encoding(encoding)
+        with tempfile.TemporaryDirectory() as folder:
+            decoded_train, size = round_trip(train, os.path.join(folder, 'train'), dtype, compression)
+            decoded_eval, _ = round_trip(evaluate, os.path.join(folder, 'eval'), dtype, compression)
+            model = svm.SVC(gamma=gamma, C=C).fit(transform_data(decoded_train, channels), decoded_train['age'])
+            predicted = model.predict(transform_data(decoded_eval, channels))
+            error = max(max_error(train, decoded_train), max_error(evaluate, decoded_eval))
+        results.append({'encoding': encoding, 'bytes': size, 'error': error,
+                        'accuracy': accuracy_score(decoded_eval['age'], predicted),
+                        # fraction of predictions that are the same as with the first encoding
+                        'agreement': float(np.mean(predicted == first)) if first is not None else 1.})
+        if first is None:
+            first = predicted
+    return results
+
+
+@click.command()
+@click.option('--data', 'data_folder', default='data/processed/hcp', type=DataFolder(exists=True),
+              help='Features, a folder of .npy files, a float64 store or shm:NAME')
+@click.option('--train', 'train_csv', default='data/hcp-train.csv', type=click.Path(exists=True),
+              help='Training subjects')
+@click.option('--eval', 'eval_csv', default='data/hcp-eval-dist.csv', type=click.Path(exists=True),
+              help='Evaluation subjects')
+@click.option('--encoding', 'encodings', multiple=True, default=ENCODINGS,
+              help='DTYPE or DTYPE:CODEC to check, can be repeated')
+@click.option('--channels', default=CHANNELS, help='Channels used from each record')
+def main(data_folder, train_csv, eval_csv, encodings, channels):
+    """Compare the SVM trained on each storage encoding with the first one"""
+
+    try:
+        for encoding in encodings:
+            check_codec(parse_encoding(encoding)[1])
+    except (ValueError, ImportError) as exc:
+        raise click.BadParameter(str(exc), param_hint='--encoding')
+
+    train = load_dataset(data_folder, train_csv)
+    evaluate = load_dataset(data_folder, eval_csv)
+
+    print("encoding,bytes,max_error,accuracy,agreement")
+    for result in check_encodings(train, evaluate, list(encodings), channels):
+        print("{encoding},{bytes},{error:.3g},{accuracy:.4f},{agreement:.4f}".format(**result))
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,307 @@
+"""
+    Predict age from precomputed features with a trained model.
+
+    The model is an artifact folder written by train_model (see
+    src.models.artifact), which is memory-mapped and checked against the current
+    feature parameters, or a pickled sklearn model such as train_incremental's.
+    Features can come from a folder of .npy files, a consolidated feature store or
+    a list of .npy files on stdin. The model is loaded once and records are
+    predicted in batches:
+
+    python -m src.models.predict_model data/processed/hcp > predictions.csv
+
+    With --serve or --socket the model stays loaded in a long-lived HTTP server
+    that accepts POST /predict requests whose body is an .npy array of one record,
+    (1, channels, freqs), or a stack of records, (n, 1, channels, freqs).
+    Concurrent requests are combined into micro-batches before calling the model.
+"""
+import click
+import glob
+import io
+import json
+import os
+import pickle
+import queue
+import socketserver
+import sys
+import threading
+import numpy as np
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from src.data.manifest import MANIFEST, build_params
+from src.data.store import is_store, open_store, record_data
+from src.models.artifact import is_artifact, load_artifact
+from src.models.train_model import transform_data, CHANNELS, MODEL_FILE
+
+
+def load_model(model_file: str = MODEL_FILE, check: bool = True, params: Optional[Dict] = None):
+    """Load a trained model, an artifact folder (checking its feature parameters
+    against params, by default make_dataset's, unless check is False) or a pickle"""
+
+    if is_artifact(model_file):
+        return load_artifact(model_file, params, check=check)
+    with open(model_file, 'rb') as fd:
+        return pickle.load(fd)
+
+
+def iter_features(source: str) -> Iterator[Tuple[str, np.ndarray]]:
+    """Generate (id, features) from a store, a folder of .npy files or,
+    if source is '-', .npy filenames read from stdin"""
+
+    if source == '-':
+        filenames: Iterable[str] = (line.strip() for line in sys.stdin if line.strip())
+    elif is_store(source):
+        data, index = open_store(source)
+        for record in index:
+            yield record['id'], record_data(data, record)
+        return
+    else:
+        filenames = sorted(glob.glob(os.path.join(source, '*.npy')))
+
+    for filename in filenames:
+        yield os.path.splitext(os.path.basename(filename))[0], np.load(filename)
+
+
+def predict_batches(model, records: Iterable[Tuple[str, np.ndarray]], batch_size: int = 256,
+                    channels: int = CHANNELS) -> Iterator[Tuple[str, str]]:
+    """Generate (id, prediction) for a stream of (id, features), calling the
+    model once per batch of `batch_size` records"""
+
+    ids: List[str] = []
+    batch: List[np.ndarray] = []
+    for record_id, features in records:
+        ids.append(record_id)
+        batch.append(features)
+        if len(batch) == batch_size:
+            yield from zip(ids, model.predict(transform_data({'data': batch}, channels)))
+            ids, batch = [], []
+    if batch:
+        yield from zip(ids, model.predict(transform_data({'data': batch}, channels)))
+
+
+class MicroBatcher:
+    """Collect records from concurrent requests and predict them together.
+
+    A single thread takes requests from a queue, waits up to `max_wait` seconds
+    for more to arrive (or until `batch_size` records are pending), then calls
+    the model once and hands each request its share of the predictions. If the
+    batch fails each request is predicted on its own, so only the requests that
+    fail get the exception.
+    """
+
+    def __init__(self, model, channels: int = CHANNELS, batch_size: int = 256, max_wait: float = 0.005):
+        self.model = model
+        self.channels = channels
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.requests: queue.Queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def predict(self, records: List[np.ndarray]) -> List:
+        """Predict a list of records, blocking until the batch they join is done"""
+
+        future: Future = Future()
+        self.requests.put((records, future))
+        return future.result()
+
+    def _run(self) -> None:
+        while True:
+            self._answer(self._collect())
+
+    def _collect(self) -> List[Tuple[List[np.ndarray], Future]]:
+        """Wait for a request, then take more until max_wait passes or batch_size records are pending"""
+
+        pending = [self.requests.get()]
+        count = len(pending[0][0])
+        while count < self.batch_size:
+            try:
+                request = self.requests.get(timeout=self.max_wait)
+            except queue.Empty:
+                break
+            pending.append(request)
+            count += len(request[0])
+        return pending
+
+    def _answer(self, pending: List[Tuple[List[np.ndarray], Future]]) -> None:
+        """Predict the records of the pending requests in one batch, or one request at a time if it fails"""
+
+        batch = [record for records, future in pending for record in records]
+        try:
+            predicted = self._predict(batch)
+        except Exception:
+            for records, future in pending:
+                try:
+                    future.set_result(self._predict(records))
+                except Exception as exc:
+                    future.set_exception(exc)
+            return
+        start = 0
+        for records, future in pending:
+            future.set_result(predicted[start:start + len(records)])
+            start += len(records)
+
+    def _predict(self, records: List[np.ndarray]) -> List:
+        return list(self.model.predict(transform_data({'data': records}, self.channels)))
+
+
+def parse_records(body: bytes, content_type: str, channels: int = CHANNELS,
+                  n_freqs: Optional[int] = None) -> List[np.ndarray]:
+    """Decode a request body, either an .npy array or JSON {"features": [...]},
+    into (1, channels, freqs) records. Raises ValueError if it is empty or the
+    records have fewer than `channels` channels or not `n_freqs` bins (if given)."""
+
+    if not body:
+        raise ValueError("empty request body")
+    if content_type.startswith('application/json'):
+        array = np.asarray(json.loads(body.decode('utf-8'))['features'], dtype=float)
+    else:
+        array = np.load(io.BytesIO(body), allow_pickle=False)
+    if array.ndim == 3:
+        # a single (1, channels, freqs) record
+        array = array[np.newaxis]
+    if array.ndim != 4 or array.shape[1] != 1:
+        raise ValueError("expected (1, channels, freqs) or (n, 1, channels, freqs) records, got shape {}"
+                         .format(array.shape))
+    if len(array) == 0:
+        raise ValueError("no records in the request")
+    if array.shape[2] < channels:
+        raise ValueError("records have {} channels, the model uses {}".format(array.shape[2], channels))
+    if n_freqs is not None and array.shape[3] != n_freqs:
+        raise ValueError("records have {} frequency bins, the model expects {}".format(array.shape[3], n_freqs))
+    return list(array)
+
+
+def model_freqs(model, channels: int) -> Optional[int]:
+    """The number of frequency bins per channel the model expects, if it is known"""
+
+    n_features = getattr(model, 'n_features', None) or getattr(model, 'n_features_in_', None)
+    return n_features // channels if n_features else None
+
+
+class PredictHandler(BaseHTTPRequestHandler):
+    """POST /predict returns {"age": [...]}, GET /health returns {"status": "ok"}"""
+
+    batcher: MicroBatcher
+    n_freqs: Optional[int] = None
+
+    def _reply(self, status: int, result) -> None:
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply(200, {'status': 'ok'})
+        else:
+            self._reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._reply(404, {'error': 'not found'})
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            records = parse_records(body, self.headers.get('Content-Type', ''), self.batcher.channels,
+                                    self.n_freqs)
+        except (ValueError, KeyError) as exc:
+            self._reply(400, {'error': str(exc)})
+            return
+        try:
+            predicted = self.batcher.predict(records)
+        except ValueError as exc:
+            self._reply(400, {'error': str(exc)})
+            return
+        except Exception as exc:
+            self._reply(500, {'error': str(exc)})
+            return
+        self._reply(200, {'age': [str(age) for age in predicted]})
+
+    def address_string(self):
+        # client_address is not a (host, port) pair for Unix sockets
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def make_server(model, address: str, channels: int = CHANNELS, batch_size: int = 256, max_wait: float = 0.005,
+                unix: bool = False) -> socketserver.BaseServer:
+    """Create a prediction server on host:port, or on a Unix socket path if `unix`"""
+
+    handler = type('Handler', (PredictHandler,), {'batcher': MicroBatcher(model, channels, batch_size, max_wait),
+                                                  'n_freqs': model_freqs(model, channels)})
+    if unix:
+        if os.path.exists(address):
+            os.unlink(address)
+        return ThreadingUnixHTTPServer(address, handler)
+    host, port = address.rsplit(':', 1)
+    return ThreadingHTTPServer((host, int(port)), handler)
+
+
+@click.command()
+@click.argument('source', required=False)
+@click.option('--model', 'model_file', default=MODEL_FILE, type=click.Path(exists=True), help='Trained model')
+@click.option('--batch-size', default=256, type=click.IntRange(min=1), help='Records per call to the model')
+@click.option('--channels', type=int,
+              help='Channels used by the model (default from the artifact, or {})'.format(CHANNELS))
+@click.option('--serve', metavar='HOST:PORT', help='Run an HTTP prediction server')
+@click.option('--socket', 'socket_path', type=click.Path(), help='Run the prediction server on a Unix socket')
+@click.option('--max-wait', default=5.0, help='Milliseconds to wait for a micro-batch to fill when serving')
+@click.option('--no-check', is_flag=True, help="Don't check the artifact's feature parameters against make_dataset's")
+def main(source, model_file, batch_size, channels, serve, socket_path, max_wait, no_check):
+    """Predict age for the records in SOURCE: a feature store, a folder of
+    .npy files or - to read .npy filenames from stdin"""
+
+    try:
+        # check against the parameters SOURCE was built with, if it has a build manifest
+        params = None
+        if source not in (None, '-') and os.path.exists(os.path.join(source, MANIFEST)):
+            params = build_params(source)[1]
+        model = load_model(model_file, check=not no_check, params=params)
+    except ValueError as exc:
+        raise click.ClickException("{}: {}".format(model_file, exc))
+    if channels is None:
+        channels = getattr(model, 'channels', CHANNELS)
+    elif channels != getattr(model, 'channels', channels):
+        raise click.UsageError("The model was trained on {} channels".format(model.channels))
+
+    if serve or socket_path:
+        server = make_server(model, socket_path or serve, channels, batch_size, max_wait / 1000.,
+                             unix=socket_path is not None)
+        print("Serving predictions on", socket_path or serve, file=sys.stderr)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+        return
+
+    if source is None:
+        raise click.UsageError("SOURCE is required unless --serve or --socket is given")
+
+    print("id,age")
+    for record_id, age in predict_batches(model, iter_features(source), batch_size, channels):
+        print("{},{}".format(record_id, age))
+
+
+if __name__ == '__main__':
+
+    main()
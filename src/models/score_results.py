@@ -1,21 +1,221 @@
-from sklearn.metrics import confusion_matrix, accuracy_score
-import sys
+"""
+    Score files of predictions (id,age) against the ages of the subjects in a CSV file.
+
+    Every file is read in one go into arrays and scored with vectorized group-bys
+    at two levels: each prediction (epoch), and each subject by a majority vote of
+    its predictions (ties go to the first band in sorted order). For each level the accuracy,
+    balanced accuracy and the recall, precision and F1 of each age band are given,
+    with bootstrap confidence intervals. Subjects are resampled, rather than
+    predictions, since the epochs of a subject are not independent. Replicates
+    are computed in parallel with --jobs threads, and every file uses the same
+    resamples so intervals of different models are comparable.
+
+    Only the CSV reader and numpy are needed, so this doesn't import MNE or sklearn:
+
+    python -m src.models.score_results hcp-prediction-results.csv
+    python -m src.models.score_results --subjects data/hcp-eval-dist.csv --confusion models/*.csv > scores.csv
+"""
+import click
 import csv
-from src.data.make_dataset import load_subjects, load_dataset
+import os
+import warnings
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from src.data.catalog import Catalog, has_catalog
+from src.data.make_dataset import load_subjects
+
+FIELDS = ['file', 'level', 'metric', 'band', 'value', 'low', 'high']
+
+# bootstrap replicates drawn by each task, the random streams only depend on the seed
+CHUNK = 100
+
+
+def read_predictions(csvfile: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Read a file of predictions, return the id and age columns as arrays"""
+
+    with open(csvfile, newline='') as fd:
+        reader = csv.reader(fd)
+        header = next(reader)
+        rows = np.array(list(reader), dtype=str).reshape(-1, len(header))
+    return rows[:, header.index('id')], rows[:, header.index('age')]
+
+
+def subject_ages(csvfile: str, data_folder: Optional[str] = None) -> Dict[str, str]:
+    """The age band of each subject in csvfile, from the catalog in data_folder if it has one"""
+
+    if data_folder is not None and has_catalog(data_folder):
+        with Catalog(data_folder) as catalog:
+            subjects = catalog.subjects(csvfile)
+    else:
+        subjects = load_subjects(csvfile)
+    return {subject: value['age'] for subject, value in subjects.items() if 'age' in value}
+
+
+def subject_ids(ids: np.ndarray) -> np.ndarray:
+    """The subject of each record id (the part before the first '-'), vectorized
+    by blanking the characters from the first '-' on"""
+
+    width = max(ids.dtype.itemsize // 4, 1)
+    chars = ids.astype('U{}'.format(width)).view('U1').reshape(len(ids), width).copy()
+    chars[np.cumsum(chars == '-', axis=1) > 0] = ''
+    return chars.view('U{}'.format(width)).ravel()
+
+
+def encode(ids: np.ndarray, predicted: np.ndarray, ages: Dict[str, str],
+           bands: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+    """Map predictions to integer codes.
+
+    Returns: subject, true, predicted, n_subjects
+    subject: the index of each prediction's subject
+    true, predicted: the index in bands of the true and predicted age band
+    """
+
+    subjects, subject = np.unique(subject_ids(ids), return_inverse=True)
+    missing = [name for name in subjects if name not in ages]
+    if missing:
+        raise ValueError("No age for {} subjects, eg. {}".format(len(missing), ", ".join(missing[:5])))
+    true = np.searchsorted(bands, [ages[name] for name in subjects])[subject]
+    labels, label = np.unique(predicted, return_inverse=True)
+    return subject, true, np.searchsorted(bands, labels)[label], len(subjects)
+
+
+def subject_tables(subject: np.ndarray, true: np.ndarray, predicted: np.ndarray, n_subjects: int,
+                   n_bands: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Confusion counts of each subject, flattened to (subjects, bands * bands),
+    for its epochs and for its majority vote"""
+
+    k = n_bands
+    epochs = np.bincount((subject * k + true) * k + predicted, minlength=n_subjects * k * k).reshape(n_subjects, k * k)
+    votes = epochs.reshape(n_subjects, k, k).sum(axis=1)
+    # every epoch of a subject has the same true band
+    subject_true = np.zeros(n_subjects, int)
+    subject_true[subject] = true
+    subjects = np.zeros((n_subjects, k * k))
+    subjects[np.arange(n_subjects), subject_true * k + votes.argmax(axis=1)] = 1
+    return epochs.astype(float), subjects
+
+
+def metrics(confusion: np.ndarray) -> Dict[str, np.ndarray]:
+    """Accuracy, balanced accuracy and per band recall, precision and F1 from
+    (..., bands, bands) confusion matrices (rows true, columns predicted)"""
+
+    correct = np.diagonal(confusion, axis1=-2, axis2=-1)
+    support = confusion.sum(axis=-1)
+    predicted = confusion.sum(axis=-2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        recall = correct / support
+        # the mean recall over the bands with any subjects
+        balanced = np.nansum(recall, axis=-1) / np.sum(support > 0, axis=-1)
+        result = {
+            'accuracy': correct.sum(axis=-1) / support.sum(axis=-1),
+            'balanced_accuracy': balanced,
+            'recall': recall,
+            'precision': correct / predicted,
+            'f1': 2 * correct / (support + predicted),
+        }
+    return result
+
+
+def bootstrap(tables: List[np.ndarray], replicates: int, jobs: int = 1, seed: int = 0) -> List[np.ndarray]:
+    """Bootstrap sums over the rows (subjects) of each table.
+
+    Each replicate draws as many subjects as there are, with replacement, and
+    sums their rows. Chunks of CHUNK replicates are drawn by `jobs` threads with
+    their own random streams spawned from the seed, so the result doesn't
+    depend on the number of jobs. Returns a (replicates, columns) array per table.
+    """
+
+    n_subjects = tables[0].shape[0]
+    streams = np.random.SeedSequence(seed).spawn((replicates + CHUNK - 1) // CHUNK)
+
+    def draw(chunk: int) -> List[np.ndarray]:
+        rng = np.random.default_rng(streams[chunk])
+        size = min(CHUNK, replicates - chunk * CHUNK)
+        draws = rng.integers(0, n_subjects, size=(size, n_subjects))
+        # how many times each subject was drawn in each replicate
+        counts = np.bincount((np.arange(size)[:, np.newaxis] * n_subjects + draws).ravel(),
+                             minlength=size * n_subjects).reshape(size, n_subjects).astype(float)
+        return [np.dot(counts, table) for table in tables]
+
+    with ThreadPoolExecutor(max(jobs, 1)) as pool:
+        chunks = list(pool.map(draw, range(len(streams))))
+    return [np.concatenate([chunk[i] for chunk in chunks]) for i in range(len(tables))]
+
+
+def score(ids: np.ndarray, predicted: np.ndarray, ages: Dict[str, str], replicates: int = 1000,
+          confidence: float = 0.95, jobs: int = 1, seed: int = 0, confusion: bool = False) -> List[Dict]:
+    """Score one set of predictions, return rows of FIELDS (without 'file')"""
+
+    bands = np.unique(np.concatenate([np.array(list(ages.values()), dtype=str), predicted]))
+    subject, true, predicted_band, n_subjects = encode(ids, predicted, ages, bands)
+    k = len(bands)
+    tables = subject_tables(subject, true, predicted_band, n_subjects, k)
+    samples = bootstrap(tables, replicates, jobs, seed) if replicates else [None, None]
+    tail = 50 * (1 - confidence)
+
+    rows = []
+    for level, table, sample in zip(('epoch', 'subject'), tables, samples):
+        matrix = table.sum(axis=0).reshape(k, k)
+        values = metrics(matrix)
+        bounds = {}
+        if sample is not None:
+            # a band missing from every replicate has no interval
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                bounds = {name: np.nanpercentile(value, [tail, 100 - tail], axis=0)
+                          for name, value in metrics(sample.reshape(-1, k, k)).items()}
+        rows.append({'level': level, 'metric': 'n', 'band': '', 'value': int(matrix.sum()), 'low': '', 'high': ''})
+        for name, value in values.items():
+            low, high = bounds.get(name, (np.full_like(value, np.nan),) * 2)
+            if np.ndim(value) == 0:
+                rows.append({'level': level, 'metric': name, 'band': '', 'value': value, 'low': low, 'high': high})
+            else:
+                rows.extend({'level': level, 'metric': name, 'band': band, 'value': value[i], 'low': low[i],
+                             'high': high[i]} for i, band in enumerate(bands))
+        if confusion:
+            rows.extend({'level': level, 'metric': 'confusion', 'band': '{}:{}'.format(bands[i], bands[j]),
+                         'value': int(matrix[i, j]), 'low': '', 'high': ''} for i in range(k) for j in range(k))
+    return rows
+
+
+def format_value(value) -> str:
+    if isinstance(value, (float, np.floating)):
+        return '' if np.isnan(value) else '{:.4f}'.format(value)
+    return str(value)
+
 
-csvfile = sys.argv[1]
+@click.command()
+@click.argument('prediction_files', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('--subjects', 'csvfile', default='data/hcp-eval.csv', type=click.Path(exists=True),
+              help='CSV file with the age of each subject')
+@click.option('--data', 'data_folder', type=click.Path(exists=True),
+              help='Read the subjects from the catalog in this folder instead of parsing the CSV file')
+@click.option('--bootstrap', 'replicates', default=1000, type=click.IntRange(min=0),
+              help='Bootstrap replicates for the confidence intervals (0 for none)')
+@click.option('--confidence', default=0.95, type=click.FloatRange(0, 1, min_open=True, max_open=True),
+              help='Confidence level of the intervals')
+@click.option('--jobs', '-j', default=-1, help='Threads for the bootstrap (default all cores)')
+@click.option('--seed', default=0, help='Random seed for the bootstrap')
+@click.option('--confusion', is_flag=True, help='Also print the confusion matrices')
+def main(prediction_files, csvfile, data_folder, replicates, confidence, jobs, seed, confusion):
+    """Score PREDICTION_FILES (id,age), print the metrics of each as csv"""
 
-subjects = load_subjects('data/hcp-eval.csv')
+    ages = subject_ages(csvfile, data_folder)
+    jobs = (os.cpu_count() or 1) if jobs < 1 else jobs
+    print(",".join(FIELDS))
+    for path in prediction_files:
+        ids, predicted = read_predictions(path)
+        try:
+            rows = score(ids, predicted, ages, replicates, confidence, jobs, seed, confusion)
+        except ValueError as exc:
+            raise click.ClickException("{}: {}".format(path, exc))
+        for row in rows:
+            row['file'] = path
+            print(",".join(format_value(row[field]) for field in FIELDS))
 
-with open(csvfile) as fd:
-    reader = csv.DictReader(fd)
-    ageref = []
-    agepredicted = []
-    for row in reader:
-        id = row['id'].split('-')[0]
-        ageref.append(subjects[id]['age'])
-        agepredicted.append(row['age'])
 
-score = accuracy_score(ageref, agepredicted)
+if __name__ == '__main__':
 
-print(score)
\ No newline at end of file
+    main()
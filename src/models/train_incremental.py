@@ -0,0 +1,171 @@
+"""
+    Out-of-core training.
+
+    train_model.py loads every record into memory before fitting an SVM, which
+    limits training to datasets that fit in RAM. Here records are only listed up
+    front and their features are read in mini-batches (from .npy files or a
+    memory-mapped store) that are fed to incremental learners, so memory use
+    depends on the batch size rather than the size of the data:
+
+    StandardScaler (partial_fit) -> IncrementalPCA (optional, partial_fit)
+        -> RBFSampler or Nystroem kernel approximation (optional)
+        -> SGDClassifier (partial_fit, several passes over shuffled batches)
+
+    Each step is fitted in its own pass over the data. The result is an sklearn
+    Pipeline that can be used with predict_model like the SVM.
+
+    python -m src.models.train_incremental --data data/processed/hcp data/hcp-train.csv \\
+        --data data/processed/mous data/Donders_MEG/participants.csv \\
+        --eval data/processed/hcp data/hcp-eval-dist.csv > predictions.csv
+"""
+import click
+import pickle
+import sys
+import numpy as np
+from typing import TYPE_CHECKING, Iterable, Iterator, List, Optional, Tuple
+
+from src.data.records import Record, dataset_records
+from src.data.shared import DataFolder
+from src.features.assemble import design_matrix
+from src.models.train_model import CHANNELS
+
+if TYPE_CHECKING:
+    from sklearn.pipeline import Pipeline
+
+MODEL_FILE = 'models/sgd-age.dat'
+
+
+def iter_batches(records: List[Record], batch_size: int = 256, channels: int = CHANNELS,
+                 seed: Optional[int] = None) -> Iterator[Tuple[np.ndarray, List]]:
+    """Generate (X, ages) mini-batches, reading the features of one batch at a time.
+    If seed is given the records are visited in a random order."""
+
+    order = np.arange(len(records))
+    if seed is not None:
+        np.random.default_rng(seed).shuffle(order)
+    for start in range(0, len(order), batch_size):
+        batch = [records[i] for i in order[start:start + batch_size]]
+        X = design_matrix([loader() for _, _, loader in batch], channels, dtype=np.float32)
+        yield X, [age for _, age, _ in batch]
+
+
+def partial_fit(step, batches: Iterable[Tuple[np.ndarray, List]], min_size: int = 1, **fit_params) -> None:
+    """Fit a step one batch at a time. Batches smaller than min_size (IncrementalPCA
+    needs at least n_components rows) are merged into the next one; a short final
+    batch is dropped if the step has already seen some data."""
+
+    pending: Optional[Tuple[np.ndarray, List]] = None
+    fitted = False
+    for X, y in batches:
+        if pending is not None:
+            X, y = np.concatenate([pending[0], X]), pending[1] + y
+            pending = None
+        if len(X) < min_size:
+            pending = (X, y)
+            continue
+        step.partial_fit(X, y, **fit_params)
+        fitted = True
+    if not fitted:
+        raise ValueError("Need at least {} records to fit {}".format(min_size, type(step).__name__))
+
+
+def make_pipeline(n_components: Optional[int] = None, kernel: str = 'nystroem', kernel_features: int = 1000,
+                  gamma: float = 0.01, alpha: float = 1e-4, seed: int = 0) -> 'Pipeline':
+    """Build the (unfitted) incremental pipeline"""
+    from sklearn.decomposition import IncrementalPCA
+    from sklearn.kernel_approximation import Nystroem, RBFSampler
+    from sklearn.linear_model import SGDClassifier
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    steps: List = [('scale', StandardScaler())]
+    if n_components:
+        steps.append(('pca', IncrementalPCA(n_components=n_components)))
+    if kernel == 'rbf':
+        steps.append(('kernel', RBFSampler(gamma=gamma, n_components=kernel_features, random_state=seed)))
+    elif kernel == 'nystroem':
+        steps.append(('kernel', Nystroem(gamma=gamma, n_components=kernel_features, random_state=seed)))
+    steps.append(('classify', SGDClassifier(alpha=alpha, random_state=seed)))
+    return Pipeline(steps)
+
+
+def train_incremental(pipeline: 'Pipeline', records: List[Record], channels: int = CHANNELS, batch_size: int = 256,
+                      passes: int = 5, seed: int = 0) -> 'Pipeline':
+    """Fit each step of the pipeline in turn from mini-batches of records"""
+
+    classes = np.array(sorted(set(age for _, age, _ in records)))
+    fitted: List = []
+
+    def batches(size: int = batch_size, shuffle: Optional[int] = None):
+        for X, y in iter_batches(records, size, channels, shuffle):
+            for _, step in fitted:
+                X = step.transform(X)
+            yield X, y
+
+    for name, step in pipeline.steps:
+        if name == 'kernel':
+            # RBFSampler only needs the number of features, Nystroem uses the
+            # rows of one random batch as its landmarks
+            X, _ = next(batches(max(batch_size, step.n_components), seed))
+            step.fit(X)
+        elif name == 'classify':
+            for epoch in range(passes):
+                partial_fit(step, batches(shuffle=seed + epoch), classes=classes)
+        else:
+            partial_fit(step, batches(), min_size=getattr(step, 'n_components', None) or 1)
+        fitted.append((name, step))
+    return pipeline
+
+
+def predict_records(model, records: List[Record], channels: int = CHANNELS,
+                    batch_size: int = 256) -> Iterator[Tuple[str, str]]:
+    """Generate (id, prediction) for each record, one batch at a time"""
+
+    ids = [record_id for record_id, _, _ in records]
+    start = 0
+    for X, _ in iter_batches(records, batch_size, channels):
+        yield from zip(ids[start:start + len(X)], model.predict(X))
+        start += len(X)
+
+
+@click.command()
+@click.option('--data', 'train', nargs=2, multiple=True, required=True, type=DataFolder(exists=True),
+              metavar='FOLDER CSVFILE', help='Training features and subjects, can be repeated to combine datasets')
+@click.option('--eval', 'evaluate', nargs=2, type=DataFolder(exists=True), metavar='FOLDER CSVFILE',
+              help='Predict these records after training')
+@click.option('--channels', default=CHANNELS, help='Channels used from each record')
+@click.option('--batch-size', default=256, type=click.IntRange(min=1), help='Records per mini-batch')
+@click.option('--pca', 'n_components', type=click.IntRange(min=1),
+              help='Reduce to this many components with IncrementalPCA')
+@click.option('--kernel', type=click.Choice(['nystroem', 'rbf', 'none']), default='nystroem',
+              help='Kernel approximation before the linear model')
+@click.option('--kernel-features', default=1000, help='Dimension of the kernel approximation')
+@click.option('--gamma', default=0.01, help='RBF kernel gamma (on standardised features)')
+@click.option('--alpha', default=1e-4, help='SGDClassifier regularisation')
+@click.option('--passes', default=5, type=click.IntRange(min=1), help='Passes over the data for SGDClassifier')
+@click.option('--seed', default=0, help='Random seed for shuffling and the kernel approximation')
+@click.option('--model', 'model_file', default=MODEL_FILE, type=click.Path(), help='Where to save the model')
+def main(train, evaluate, channels, batch_size, n_components, kernel, kernel_features, gamma, alpha, passes, seed,
+         model_file):
+    """Train an age classifier from mini-batches of features with bounded memory"""
+
+    records: List[Record] = []
+    for data_folder, csvfile in train:
+        records.extend(record for record in dataset_records(data_folder, csvfile) if record[1] is not None)
+    print("Training on {} records".format(len(records)), file=sys.stderr)
+
+    pipeline = make_pipeline(n_components, kernel, kernel_features, gamma, alpha, seed)
+    model = train_incremental(pipeline, records, channels, batch_size, passes, seed)
+
+    with open(model_file, 'wb') as out:
+        pickle.dump(model, out)
+
+    if evaluate:
+        print("id,age")
+        for record_id, age in predict_records(model, dataset_records(*evaluate), channels, batch_size):
+            print("{},{}".format(record_id, age))
+
+
+if __name__ == '__main__':
+
+    main()
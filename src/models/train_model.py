@@ -1,37 +1,78 @@
-from src.data.preprocess import run_pca
-from src.data.make_dataset import load_dataset, load_subjects
-from sklearn import svm
-from sklearn.metrics import confusion_matrix, accuracy_score
-from sklearn.ensemble import RandomForestClassifier
+from src.data.make_dataset import FEATURE_PARAMS, load_dataset, load_subjects
+from src.data.manifest import MANIFEST, build_params
+from src.data.preprocess import METHODS, fit_reduction
+from src.data.shared import DataFolder, source_folder
+from src.features.assemble import dataset_matrix
+from src.models.artifact import load_artifact, save_artifact
+import click
+import logging
 import numpy as np
-import pickle
+import os
 
-def transform_data(data, channels):
-    """Select a number of channels from each data record and concatenate them into a single vector"""
-    
-    return [np.ravel(d[0][:channels]) for d in data['data']] 
+CHANNELS = 10
+# an artifact folder, see src.models.artifact
+MODEL_FILE = 'models/svm-age'
 
+logger = logging.getLogger(__name__)
+# make_dataset only shows errors from the root logger
+logger.setLevel(logging.WARNING)
 
-dataset = load_dataset('data/processed/hcp', 'data/hcp-train.csv')
-testdataset = load_dataset('data/processed/hcp', 'data/hcp-eval-dist.csv')
 
-channels = 10
+def transform_data(data, channels, freqs=None, dtype=np.float64):
+    """Select a number of channels from each data record and concatenate them into a single vector,
+    returns a contiguous (records, channels * freqs) matrix (see src.features.assemble).
 
-dd = transform_data(dataset, channels)
-td = transform_data(testdataset, channels)
+    The default dtype is float64 because libsvm would otherwise copy the matrix."""
 
-model = svm.SVC(gamma=0.01, C=10.)
-model.fit(dd, dataset['age'])
+    return dataset_matrix(data, channels, freqs, dtype)
 
-with open('models/svm-age.dat', 'wb') as out:
-    pickle.dump(model, out)
 
-predicted = model.predict(td)
+@click.command()
+@click.option('--data', 'data_folder', default='data/processed/hcp', type=DataFolder(exists=True),
+              help='Features, a folder of .npy files, a store or shm:NAME (see src.data.shared)')
+@click.option('--reduce', 'method', type=click.Choice(METHODS),
+              help='Project the features onto principal components first')
+@click.option('--components', 'n_components', type=click.IntRange(min=1),
+              help='Number of components (default chosen by --variance)')
+@click.option('--variance', default=0.95, type=click.FloatRange(0, 1, min_open=True),
+              help='Fraction of the variance the components explain')
+def main(data_folder, method, n_components, variance):
+    """Train the SVM on the HCP training subjects, print predictions for the evaluation subjects"""
+    from sklearn import svm
 
-print("id,age")
-for pair in zip(testdataset['id'], predicted):
-    print("{},{}".format(pair[0], pair[1]))
+    # the feature parameters the training records were built with, saved in the artifact. Folders
+    # built before make_dataset kept a manifest are assumed to use the current hcp parameters
+    try:
+        source = source_folder(data_folder)
+        if os.path.exists(os.path.join(source, MANIFEST)):
+            dataset_name, params = build_params(source, load_subjects('data/hcp-train.csv'))
+        else:
+            logger.warning("No {} in {}, assuming the current hcp feature parameters".format(MANIFEST, source))
+            dataset_name, params = 'hcp', FEATURE_PARAMS['hcp']
+    except ValueError as exc:
+        raise click.ClickException(str(exc))
 
+    dataset = load_dataset(data_folder, 'data/hcp-train.csv')
+    testdataset = load_dataset(data_folder, 'data/hcp-eval-dist.csv')
 
+    channels = CHANNELS
 
+    dd = transform_data(dataset, channels)
+    td = transform_data(testdataset, channels)
 
+    reduction = fit_reduction(dd, channels, method, n_components, variance) if method else None
+    model = svm.SVC(gamma=0.01, C=10.)
+    model.fit(reduction.transform(dd) if reduction else dd, dataset['age'])
+
+    save_artifact(MODEL_FILE, model, channels, dataset_name, params, reduction=reduction)
+
+    predicted = load_artifact(MODEL_FILE, params).predict(td)
+
+    print("id,age")
+    for pair in zip(testdataset['id'], predicted):
+        print("{},{}".format(pair[0], pair[1]))
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,203 @@
+"""
+    Hyperparameter search for the SVM age classifier.
+
+    train_model.py fits one fixed configuration. Here the features of the
+    training and evaluation subjects are loaded once and a grid (or successive
+    halving) search is run over C, gamma, the number of channels and PCA on/off,
+    scoring each configuration by its accuracy on the evaluation subjects, the
+    same subject-level split that train_model uses (hcp-train.csv/hcp-eval-dist.csv).
+
+    The RBF kernel only depends on gamma through exp(-gamma * D) where D holds
+    the squared distances between records, so D is computed once for each channel
+    count and PCA setting and saved in a memory-mapped file that all worker
+    processes share. Each job computes one kernel matrix for a gamma and fits
+    an SVC with kernel='precomputed' for every C, and successive halving rounds
+    take sub-blocks of the same matrices.
+
+    python -m src.models.tune_model --jobs 16 > tuning.csv
+"""
+import click
+import itertools
+import math
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from src.data.make_dataset import load_dataset
+from src.data.preprocess import fit_reduction
+from src.data.shared import DataFolder
+from src.models.train_model import transform_data
+
+
+def squared_distances(A: np.ndarray, B: np.ndarray) -> np.ndarray:
+    """Squared euclidean distances between the rows of A and the rows of B"""
+
+    distances = np.einsum('ij,ij->i', A, A)[:, np.newaxis] + np.einsum('ij,ij->i', B, B)[np.newaxis, :]
+    distances -= 2 * np.dot(A, B.T)
+    return np.maximum(distances, 0, out=distances)
+
+
+def cache_distances(train: np.ndarray, evaluate: np.ndarray, channels: int, n_freq: int, pca: bool,
+                    cache_dir: str) -> Tuple[str, str]:
+    """Compute the train/train and eval/train squared distances using the first
+    `channels` channels, optionally after PCA fitted on the training records,
+    and save them in cache_dir. Returns the two filenames."""
+
+    train = train[:, :channels * n_freq]
+    evaluate = evaluate[:, :channels * n_freq]
+    if pca:
+        # randomized PCA with the components explaining 95% of the variance, as run_pca
+        reduce = fit_reduction(train)
+        train, evaluate = reduce.transform(train), reduce.transform(evaluate)
+    names = []
+    for name, rows in (('train', train), ('eval', evaluate)):
+        filename = os.path.join(cache_dir, '{}-{}-{}.npy'.format(name, channels, 'pca' if pca else 'raw'))
+        np.save(filename, squared_distances(rows, train))
+        names.append(filename)
+    return names[0], names[1]
+
+
+def score_gamma(distances: Tuple[str, str], y_train: np.ndarray, y_eval: np.ndarray, gamma: float,
+                Cs: Sequence[float], subset: Optional[np.ndarray] = None) -> List[Tuple[float, float, float]]:
+    """Fit an SVC for every C from one precomputed RBF kernel, training on the
+    records in subset (default all), return (C, accuracy, seconds) for each"""
+    from sklearn import svm
+
+    train_distances = np.load(distances[0], mmap_mode='r')
+    eval_distances = np.load(distances[1], mmap_mode='r')
+    if subset is None:
+        subset = np.arange(len(y_train))
+    kernel = np.exp(-gamma * train_distances[np.ix_(subset, subset)])
+    eval_kernel = np.exp(-gamma * eval_distances[:, subset])
+
+    results = []
+    for C in Cs:
+        start = time.perf_counter()
+        model = svm.SVC(kernel='precomputed', C=C).fit(kernel, y_train[subset])
+        accuracy = float(np.mean(model.predict(eval_kernel) == y_eval))
+        results.append((C, accuracy, time.perf_counter() - start))
+    return results
+
+
+def halving_rounds(n_configs: int, factor: int) -> int:
+    return int(math.floor(math.log(n_configs, factor))) + 1 if n_configs > 1 else 1
+
+
+def subject_subset(ids: Sequence[str], ages: Sequence[str], fraction: float, seed: int) -> np.ndarray:
+    """Indices of the records of a random fraction of the subjects of each age,
+    keeping at least one subject for every age"""
+
+    by_age: Dict = {}
+    for record_id, age in zip(ids, ages):
+        by_age.setdefault(age, set()).add(record_id.split('-')[0])
+    rng = np.random.default_rng(seed)
+    chosen = set()
+    for age in sorted(by_age):
+        subjects = sorted(by_age[age])
+        chosen.update(rng.choice(subjects, max(1, int(round(fraction * len(subjects)))), replace=False))
+    return np.array([i for i, record_id in enumerate(ids) if record_id.split('-')[0] in chosen])
+
+
+def search(train: Dict, evaluate: Dict, channels: Sequence[int], pca: Sequence[bool], gammas: Sequence[float],
+           Cs: Sequence[float], halving: bool = False, factor: int = 3, jobs: int = 1, seed: int = 0) -> List[Dict]:
+    """Score every configuration, return a list of results, one dictionary per
+    configuration (and per round for successive halving)"""
+    from joblib import Parallel, delayed
+
+    n_freq = train['data'][0].shape[-1]
+    # one design matrix with the most channels, smaller counts are a prefix of each row
+    X_train = transform_data(train, max(channels))
+    X_eval = transform_data(evaluate, max(channels))
+    y_train = np.array(train['age'])
+    y_eval = np.array(evaluate['age'])
+
+    configs = list(itertools.product(channels, pca, gammas, Cs))
+    rounds = halving_rounds(len(configs), factor) if halving else 1
+    results: List[Dict] = []
+
+    with tempfile.TemporaryDirectory() as cache_dir, Parallel(n_jobs=jobs) as parallel:
+        distances = dict(zip(itertools.product(channels, pca), parallel(
+            delayed(cache_distances)(X_train, X_eval, n, n_freq, p, cache_dir)
+            for n, p in itertools.product(channels, pca))))
+
+        for round_index in range(rounds):
+            fraction = float(factor) ** (round_index - rounds + 1)
+            subset = subject_subset(train['id'], train['age'], fraction, seed + round_index) if fraction < 1 else None
+            groups: Dict = {}
+            for n, p, gamma, C in configs:
+                groups.setdefault((n, p, gamma), []).append(C)
+            scores = parallel(delayed(score_gamma)(distances[(n, p)], y_train, y_eval, gamma, group_Cs, subset)
+                              for (n, p, gamma), group_Cs in groups.items())
+
+            round_results = []
+            for (n, p, gamma), group in zip(groups, scores):
+                for C, accuracy, seconds in group:
+                    round_results.append({'round': round_index,
+                                          'records': len(y_train) if subset is None else len(subset),
+                                          'channels': n, 'pca': p, 'gamma': gamma, 'C': C,
+                                          'accuracy': accuracy, 'seconds': seconds})
+            results.extend(round_results)
+
+            round_results.sort(key=lambda r: -r['accuracy'])
+            keep = max(1, int(math.ceil(len(round_results) / factor)))
+            configs = [(r['channels'], r['pca'], r['gamma'], r['C']) for r in round_results[:keep]]
+
+    return results
+
+
+def _numbers(kind):
+    def parse(ctx, param, value):
+        try:
+            return [kind(v) for v in value.split(',')]
+        except ValueError:
+            raise click.BadParameter("expected a comma separated list, eg. 1,10,100")
+    return parse
+
+
+def _flags(ctx, param, value):
+    choices = {'on': True, 'off': False}
+    try:
+        return [choices[v] for v in value.split(',')]
+    except KeyError:
+        raise click.BadParameter("expected on, off or on,off")
+
+
+@click.command()
+@click.option('--data', 'data_folder', default='data/processed/hcp', type=DataFolder(exists=True),
+              help='Features, a folder of .npy files, a store or shm:NAME (see src.data.shared)')
+@click.option('--train', 'train_csv', default='data/hcp-train.csv', type=click.Path(exists=True),
+              help='Training subjects')
+@click.option('--eval', 'eval_csv', default='data/hcp-eval-dist.csv', type=click.Path(exists=True),
+              help='Evaluation subjects, configurations are scored on these')
+@click.option('--C', 'Cs', default='1,10,100', callback=_numbers(float), help='Values of C')
+@click.option('--gamma', 'gammas', default='0.001,0.01,0.1', callback=_numbers(float), help='Values of gamma')
+@click.option('--channels', default='5,10,20', callback=_numbers(int), help='Channel counts')
+@click.option('--pca', default='off,on', callback=_flags, help='PCA settings, on, off or both')
+@click.option('--halving', is_flag=True, help='Successive halving instead of a full grid')
+@click.option('--factor', default=3, type=click.IntRange(min=2), help='Reduction factor for --halving')
+@click.option('--jobs', '-j', default=-1, help='Parallel jobs (default all cores)')
+@click.option('--seed', default=0, help='Random seed for the halving subsets')
+def main(data_folder, train_csv, eval_csv, Cs, gammas, channels, pca, halving, factor, jobs, seed):
+    """Search SVM hyperparameters, print the score of every configuration as csv"""
+
+    train = load_dataset(data_folder, train_csv)
+    evaluate = load_dataset(data_folder, eval_csv)
+
+    results = search(train, evaluate, channels, pca, gammas, Cs, halving, factor, jobs, seed)
+
+    fields = ['round', 'records', 'channels', 'pca', 'gamma', 'C', 'accuracy', 'seconds']
+    print(",".join(fields))
+    for result in results:
+        print(",".join(str(result[field]) for field in fields))
+
+    best = max((r for r in results if r['round'] == results[-1]['round']), key=lambda r: r['accuracy'])
+    print("Best: channels={channels} pca={pca} gamma={gamma} C={C} accuracy={accuracy:.4f}".format(**best),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+
+    main()